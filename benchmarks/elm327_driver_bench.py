@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Cost of reading coolant temperature in F through python-obd (query plus the pint
+conversion ObdReader does) against the lean Elm327 driver, from a simulated
+ELM327 on a pty.
+
+The emulator runs in a forked process, so the CPU time reported is only the
+driver's. With no ECU latency the wall clock rate is bound by the host side too.
+
+    PYTHONPATH=. python benchmarks/elm327_driver_bench.py [seconds] [ecu_latency_ms]
+"""
+import logging
+import multiprocessing
+import sys
+import time
+
+import obd
+
+from rpi_ble.elm327 import Elm327
+from rpi_ble.elm327_emulator import Elm327Emulator
+
+
+def measure(name: str, read, seconds: float):
+    reads = 0
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        read()
+        reads += 1
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    print(f"{name:10s} {reads / elapsed:7.1f} pids/sec  {cpu / reads * 1e6:7.1f} us cpu/pid")
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    ecu_latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.0
+    logging.getLogger('obd').setLevel(logging.WARNING)
+    emulator = Elm327Emulator(ecu_latency=ecu_latency)
+    process = multiprocessing.get_context('fork').Process(target=emulator.run, daemon=True)
+    process.start()
+    try:
+        connection = obd.OBD(emulator.port, fast=True)
+        measure('python-obd',
+                lambda: int(connection.query(obd.commands.COOLANT_TEMP).value.to('degF').magnitude), seconds)
+        connection.close()
+
+        elm = Elm327(emulator.port)
+        elm.open()
+        measure('elm327', lambda: elm.read_pids([0x05])[0x05], seconds)
+        elm.close()
+    finally:
+        process.terminate()
+
+
+if __name__ == '__main__':
+    main()
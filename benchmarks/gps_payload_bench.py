@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Compare the JSON gps payload against the compact binary payload : bytes on air
+and encode cost per fix.
+
+    PYTHONPATH=. python benchmarks/gps_payload_bench.py
+"""
+import math
+import time
+import timeit
+
+from rpi_ble import gps_codec
+from rpi_ble.gps_gatt_service import GpsPos
+
+# default ATT MTU is 23, 3 bytes are taken by the notification header
+ATT_PAYLOAD = 20
+ITERATIONS = 50000
+
+
+def sample_fix(i: int):
+    angle = i * 0.01
+    return (37.7749 + 0.01 * math.sin(angle), -122.4194 + 0.01 * math.cos(angle),
+            int(angle * 57.3) % 360, time.time(), 95, 1.23, 0.98)
+
+
+def report(name: str, payload_len: int, seconds: float):
+    per_fix_us = seconds / ITERATIONS * 1e6
+    packets = -(-payload_len // ATT_PAYLOAD)
+    print(f"{name:8s} {payload_len:4d} bytes  {packets} packet(s)/fix  {per_fix_us:6.2f} us/fix")
+
+
+def main():
+    fixes = [sample_fix(i) for i in range(ITERATIONS)]
+
+    def json_path():
+        for fix in fixes:
+            GpsPos(*fix).toJSON().encode()
+
+    def binary_path():
+        for fix in fixes:
+            gps_codec.encode(*fix)
+
+    json_len = len(GpsPos(*fixes[0]).toJSON().encode())
+    binary_len = len(gps_codec.encode(*fixes[0]))
+    report("json", json_len, min(timeit.repeat(json_path, number=1, repeat=3)))
+    report("binary", binary_len, min(timeit.repeat(binary_path, number=1, repeat=3)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Fix-to-notification latency and CPU cost of the two gps sources : GpsReader on
+its own thread, and GpsdSocketReader on the GLib main loop.
+
+A fake gpsd streams TPV reports at a fixed rate. Each fix is stamped when it is
+written to the socket, and again when the notification callback it schedules
+(GLib.idle_add, as the NotificationPublisher does) runs on the main loop. CPU is
+process time per fix, which includes the fake gpsd thread, the same for both.
+
+    PYTHONPATH=. python benchmarks/gps_source_bench.py [fixes] [rate_hz]
+"""
+import socket
+import statistics
+import sys
+import threading
+import time
+
+from gi.repository import GLib
+
+from rpi_ble.gps_reader import GpsReader
+from rpi_ble.gpsd_socket_reader import GpsdSocketReader
+from rpi_ble.interfaces import GpsReceiver
+
+VERSION = b'{"class":"VERSION","release":"3.22","rev":"3.22","proto_major":3,"proto_minor":14}\r\n'
+DEVICES = b'{"class":"DEVICES","devices":[{"class":"DEVICE","path":"/dev/ttyACM0","driver":"u-blox","native":0}]}\r\n'
+WATCH = b'{"class":"WATCH","enable":true,"json":true}\r\n'
+SKY = b'{"class":"SKY","device":"/dev/ttyACM0","gdop":1.23,"pdop":0.98,"satellites":[]}\r\n'
+TPV = ('{{"class":"TPV","device":"/dev/ttyACM0","mode":3,"time":"2024-05-01T12:{:02d}:{:02d}.{:03d}Z",'
+       '"lat":{:.7f},"lon":-122.4194000,"track":271.5,"speed":42.5}}\r\n')
+BASE_LAT = 37.0
+
+
+class FakeGpsd(threading.Thread):
+
+    def __init__(self, fixes: int, rate_hz: float):
+        threading.Thread.__init__(self, daemon=True)
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        self.fixes = fixes
+        self.rate_hz = rate_hz
+        self.sent = {}
+        self.stop = threading.Event()
+
+    def run(self):
+        conn, _ = self.server.accept()
+        with conn:
+            conn.sendall(VERSION)
+            commands = b''
+            while b'?WATCH' not in commands:
+                command = conn.recv(1024)
+                commands += command
+                if b'?DEVICES' in command:
+                    conn.sendall(DEVICES)
+            conn.sendall(DEVICES + WATCH)
+            next_send = time.perf_counter()
+            for i in range(self.fixes):
+                next_send += 1 / self.rate_hz
+                time.sleep(max(0.0, next_send - time.perf_counter()))
+                ms = i * 40
+                report = SKY + TPV.format(ms // 60000 % 60, ms // 1000 % 60, ms % 1000,
+                                          BASE_LAT + i * 1e-6).encode()
+                self.sent[i] = time.perf_counter()
+                conn.sendall(report)
+            self.stop.wait(5)
+        self.server.close()
+
+
+class Probe(GpsReceiver):
+
+    def __init__(self, gpsd: FakeGpsd, loop):
+        self.gpsd = gpsd
+        self.loop = loop
+        self.latencies = []
+
+    def set_gps_position(self, lat: float, long: float, heading: float, tstamp: float,
+                         speed: int, gdop: float, pdop: float) -> None:
+        GLib.idle_add(self.notified, round((lat - BASE_LAT) * 1e6))
+
+    def notified(self, i: int):
+        self.latencies.append(time.perf_counter() - self.gpsd.sent[i])
+        if len(self.latencies) == self.gpsd.fixes:
+            self.loop.quit()
+        return False
+
+
+def run(source: str, fixes: int, rate_hz: float):
+    gpsd = FakeGpsd(fixes, rate_hz)
+    gpsd.start()
+    loop = GLib.MainLoop()
+    probe = Probe(gpsd, loop)
+    if source == 'thread':
+        reader = GpsReader(probe, port=gpsd.port)
+        reader.start()
+    else:
+        reader = GpsdSocketReader(probe, port=gpsd.port)
+        GLib.idle_add(reader.start)
+    # give up if fixes go missing
+    GLib.timeout_add(int(fixes / rate_hz * 1000) + 10000, loop.quit)
+    cpu_start = time.process_time()
+    loop.run()
+    cpu = time.process_time() - cpu_start
+    reader.finished = True
+    gpsd.stop.set()
+    if source == 'socket':
+        reader.close()
+
+    latencies = sorted(probe.latencies)
+    if not latencies:
+        print(f"{source:7s} no fixes received")
+        return
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{source:7s} {len(latencies):5d} fixes  latency p50 {statistics.median(latencies) * 1000:6.3f} ms  "
+          f"p95 {p95 * 1000:6.3f} ms  max {latencies[-1] * 1000:6.3f} ms  "
+          f"cpu {cpu / len(latencies) * 1e6:6.1f} us/fix")
+
+
+def main():
+    fixes = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rate_hz = float(sys.argv[2]) if len(sys.argv) > 2 else 200
+    for source in ('thread', 'socket'):
+        run(source, fixes, rate_hz)
+
+
+if __name__ == '__main__':
+    main()
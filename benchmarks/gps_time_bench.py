@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Cost of turning a gpsd timestamp into epoch time : dateutil's isoparse as the
+readers used to do it, against gps_time_ms.
+
+The corpus is either a capture from gpsd (e.g. `gpspipe -w -n 5000 > corpus.json`,
+TPV times are pulled out of it, or a file with one timestamp per line) or, with
+no argument, an hour of 10Hz timestamps.
+
+    PYTHONPATH=. python benchmarks/gps_time_bench.py [corpus]
+"""
+import json
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from dateutil import parser
+
+from rpi_ble.gps_time import gps_time_ms
+
+
+def load_corpus(path: str):
+    corpus = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('{'):
+                report = json.loads(line)
+                if report.get('class') == 'TPV' and 'time' in report:
+                    corpus.append(report['time'])
+            elif line:
+                corpus.append(line)
+    return corpus
+
+
+def generated_corpus():
+    start = datetime(2024, 5, 1, 11, 30, tzinfo=timezone.utc)
+    corpus = []
+    for i in range(36000):
+        t = start + timedelta(milliseconds=100 * i)
+        corpus.append(t.strftime('%Y-%m-%dT%H:%M:%S.') + f"{t.microsecond // 1000:03d}Z")
+    return corpus
+
+
+def dateutil_ms(value: str) -> int:
+    return round(parser.isoparse(value).astimezone().timestamp() * 1000)
+
+
+def run(name: str, convert, corpus):
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        for value in corpus:
+            convert(value)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{name:9s} {best / len(corpus) * 1e6:6.2f} us/timestamp")
+
+
+def main():
+    corpus = load_corpus(sys.argv[1]) if len(sys.argv) > 1 else generated_corpus()
+    mismatches = sum(1 for value in corpus if dateutil_ms(value) != gps_time_ms(value))
+    print(f"{len(corpus)} timestamps, {mismatches} mismatches")
+    run('dateutil', dateutil_ms, corpus)
+    run('gps_time', gps_time_ms, corpus)
+
+
+if __name__ == '__main__':
+    main()
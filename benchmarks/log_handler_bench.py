@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Cost to the logging thread of each log record going to the rotating log file,
+as on the GPS fix path : the old handler that flushed after every record, the
+same again with an fsync so it's as safe against power cuts, and the batching
+background writer. Also how long the batching writer took to get everything
+on disk after the last record.
+
+    PYTHONPATH=. python benchmarks/log_handler_bench.py
+"""
+import logging
+import os
+import shutil
+import tempfile
+import time
+from logging.handlers import RotatingFileHandler
+
+from rpi_ble.log_writer import BatchingFileHandler
+
+RECORDS = 5000
+FORMAT = logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+
+class FlushingRotatingFileHandler(RotatingFileHandler):
+    # what main.py used to use
+    def emit(self, record):
+        super().emit(record)
+        self.flush()
+
+
+class SyncingRotatingFileHandler(FlushingRotatingFileHandler):
+    def flush(self):
+        super().flush()
+        if self.stream:
+            os.fsync(self.stream.fileno())
+
+
+def run(handler) -> float:
+    handler.setFormatter(FORMAT)
+    log = logging.getLogger('bench')
+    log.propagate = False
+    log.handlers = [handler]
+    start = time.perf_counter()
+    for i in range(RECORDS):
+        log.warning("position handling took %d ms", i % 50)
+    return (time.perf_counter() - start) / RECORDS
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'bench.log')
+    try:
+        for name, make in (('flush per record', FlushingRotatingFileHandler),
+                           ('flush+fsync per record', SyncingRotatingFileHandler),
+                           ('batching writer', BatchingFileHandler)):
+            handler = make(path, maxBytes=1024 * 1024, backupCount=2)
+            per_record = run(handler)
+            start = time.perf_counter()
+            handler.close()
+            drain = time.perf_counter() - start
+            line = f"{name:24s} {per_record * 1e6:7.1f} us/record on the logging thread"
+            if isinstance(handler, BatchingFileHandler):
+                stats = handler.stats()
+                line += f", {stats['syncs']} fsyncs, on disk {drain * 1000:.0f} ms after the last record"
+            print(line)
+            for f in os.listdir(directory):
+                os.remove(os.path.join(directory, f))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
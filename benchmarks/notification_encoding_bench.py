@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Cost of building a gps characteristic value for a notification : the old list of
+dbus.Byte objects built one character at a time, against a single dbus.Array
+built from a bytes buffer and cached until the fix changes.
+
+Reports memory blocks / bytes held per encoded value (tracemalloc) and
+microseconds per notification.
+
+    PYTHONPATH=. python benchmarks/notification_encoding_bench.py
+"""
+import time
+import timeit
+import tracemalloc
+
+import dbus
+
+from rpi_ble.gps_gatt_service import GpsPos
+from rpi_ble.service import CachedValue
+
+GATT_CHRC_IFACE = 'org.bluez.GattCharacteristic1'
+ITERATIONS = 20000
+RETAINED = 1000
+
+
+def legacy_value(gps_pos: GpsPos):
+    value = []
+    for c in gps_pos.toJSON():
+        value.append(dbus.Byte(c.encode()))
+    return value
+
+
+class Source:
+
+    def __init__(self):
+        self.gps_pos = GpsPos(37.7749, -122.4194, 271, time.time(), 95, 1.23, 0.98)
+        self.cached_value = CachedValue(self.get_value_bytes)
+
+    def get_value_bytes(self) -> bytes:
+        return self.gps_pos.toJSON().encode()
+
+    def set_fix(self, i: int):
+        self.gps_pos = GpsPos(37.7749 + i * 1e-6, -122.4194, 271, time.time(), 95, 1.23, 0.98)
+        self.cached_value.invalidate()
+
+
+def allocations_per_value(build):
+    values = []
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(RETAINED):
+        values.append(build(i))
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    blocks = sum(s.count_diff for s in stats)
+    size = sum(s.size_diff for s in stats)
+    return blocks / RETAINED, size / RETAINED
+
+
+def main():
+    source = Source()
+
+    def legacy_notification(i):
+        source.set_fix(i)
+        # the old code snapshotted the value at schedule time, then a client read
+        # rebuilt it again
+        value = legacy_value(source.gps_pos)
+        legacy_value(source.gps_pos)
+        return {'Value': value}
+
+    def cached_notification(i):
+        source.set_fix(i)
+        value = source.cached_value.get()
+        source.cached_value.get()
+        return {'Value': value}
+
+    for name, build in (('before', legacy_notification), ('after', cached_notification)):
+        blocks, size = allocations_per_value(build)
+        seconds = min(timeit.repeat(lambda: [build(i) for i in range(ITERATIONS)], number=1, repeat=3))
+        print(f"{name:7s} {blocks:6.1f} blocks  {size:7.0f} bytes  "
+              f"{seconds / ITERATIONS * 1e6:6.2f} us/notification (incl. one read)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Coolant temperature queries over a simulated hour's drive - ten minutes of
+warm-up, steady running, then a climb towards overheating - with the fixed 10s
+period against the adaptive one. Also reports how late each poll schedule
+noticed the overheat alert level.
+
+    PYTHONPATH=. python benchmarks/obd_adaptive_bench.py
+"""
+import obd
+
+from rpi_ble.obd_reader import ObdReader, PollSchedule
+
+ALERT = 230
+
+
+def coolant(t: float) -> float:
+    if t < 600:
+        return 60 + 130 * t / 600
+    if t < 3005:
+        # the thermostat keeps it within a couple of degrees
+        return 190 + 2 * ((t // 97) % 2)
+    return 192 + (t - 3005) * 0.1
+
+
+def simulate(adaptive):
+    now = [0.0]
+    schedule = PollSchedule(clock=lambda: now[0])
+    poll = schedule.add(obd.commands.COOLANT_TEMP, 10, adaptive=adaptive)
+    # warm-up, steady, climbing
+    queries = [0, 0, 0]
+    alerted = None
+    while now[0] < 3600:
+        if schedule.next_due():
+            queries[0 if now[0] < 600 else 1 if now[0] < 3005 else 2] += 1
+            value = int(coolant(now[0]))
+            if alerted is None and value >= ALERT:
+                alerted = now[0]
+            schedule.succeeded(poll, value)
+        now[0] += schedule.time_until_next()
+    # the first moment the value was over the alert level
+    crossed = next(t / 10 for t in range(36000) if coolant(t / 10) >= ALERT)
+    return queries, alerted - crossed
+
+
+def main():
+    for name, adaptive in (('fixed', None), ('adaptive', ObdReader.adaptive_rate[obd.commands.COOLANT_TEMP])):
+        queries, delay = simulate(adaptive)
+        print(f"{name:9s} {sum(queries):4d} queries (warm-up {queries[0]:3d}, steady {queries[1]:3d}, "
+              f"climbing {queries[2]:3d})  alert seen {delay:4.1f}s late")
+
+
+if __name__ == '__main__':
+    main()
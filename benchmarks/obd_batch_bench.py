@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+PIDs per second read through python-obd from a simulated ELM327 on a pty, one
+request per PID against all of them batched into a single mode 01 request.
+
+The emulator charges each request an ECU response time plus serial time at
+38400 baud, which is what dominates on a real adapter.
+
+    PYTHONPATH=. python benchmarks/obd_batch_bench.py [seconds] [ecu_latency_ms]
+"""
+import logging
+import sys
+import time
+
+import obd
+
+from rpi_ble.elm327_emulator import Elm327Emulator
+from rpi_ble.obd_reader import ObdReader, PollSchedule
+
+CMDS = (obd.commands.RPM, obd.commands.SPEED, obd.commands.THROTTLE_POS, obd.commands.COOLANT_TEMP)
+
+
+def run(name: str, reader: ObdReader, connection, seconds: float):
+    schedule = PollSchedule()
+    polls = [schedule.add(cmd, 0) for cmd in CMDS]
+    values = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        values += sum(1 for _, response in reader.query(connection, polls) if not response.is_null())
+    elapsed = time.perf_counter() - start
+    print(f"{name:8s} {values / elapsed:7.1f} pids/sec")
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    ecu_latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.03
+    logging.getLogger('obd').setLevel(logging.WARNING)
+    emulator = Elm327Emulator(ecu_latency=ecu_latency)
+    emulator.start()
+    connection = obd.OBD(emulator.port, fast=True)
+    try:
+        single = ObdReader(None)
+        single.batching = False
+        run('single', single, connection, seconds)
+        run('batched', ObdReader(None), connection, seconds)
+    finally:
+        connection.close()
+        emulator.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Time for ObdReader.connect to get from nothing to a connection that's ready to
+poll, with a full python-obd probe against the cached profile, on a simulated
+ELM327.
+
+    PYTHONPATH=. python benchmarks/obd_reconnect_bench.py [rounds] [ecu_latency_ms]
+"""
+import logging
+import os
+import sys
+import tempfile
+import time
+from unittest.mock import Mock, patch
+
+from rpi_ble.elm327_emulator import Elm327Emulator
+from rpi_ble.obd_profile import ObdProfileCache
+from rpi_ble.obd_reader import ObdReader
+
+
+def timed_connect(reader: ObdReader):
+    start = time.perf_counter()
+    connection = reader.connect(None)
+    elapsed = time.perf_counter() - start
+    connection.close()
+    return elapsed
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    ecu_latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.05
+    logging.getLogger('obd').setLevel(logging.WARNING)
+    emulator = Elm327Emulator(vin='1FA6P8CF5H5123456', ecu_latency=ecu_latency)
+    emulator.start()
+    path = os.path.join(tempfile.mkdtemp(), 'profiles.json')
+    with patch('rpi_ble.obd_reader.UsbDetector') as usb_detector:
+        usb_detector.detected.return_value = True
+        usb_detector.get.return_value = emulator.port
+        probe, cached = [], []
+        for _ in range(rounds):
+            if os.path.exists(path):
+                os.remove(path)
+            probe.append(timed_connect(ObdReader(Mock(), ObdProfileCache(path))))
+            cached.append(timed_connect(ObdReader(Mock(), ObdProfileCache(path))))
+    emulator.close()
+    print(f"full probe     {min(probe):6.2f} s")
+    print(f"cached profile {min(cached):6.2f} s")
+
+
+if __name__ == '__main__':
+    main()
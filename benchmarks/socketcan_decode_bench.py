@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Frames per second SocketCanReader.handle_frame gets through : broadcast signal
+frames, unrelated traffic, and multi frame ISO-TP OBD responses, with no
+interface needed. Pass a candump -L log to replay that instead.
+
+    PYTHONPATH=. python benchmarks/socketcan_decode_bench.py [seconds] [candump.log]
+"""
+import sys
+import time
+from unittest.mock import Mock
+
+import obd
+
+from rpi_ble.obd_reader import PollSchedule
+from rpi_ble.socketcan_reader import SocketCanReader, CanSignal, parse_candump_line
+
+SIGNAL_MAP = {
+    0x3D0: [CanSignal('coolant', 0x3D0, 1, 1, 'temp_f', 1.8, -40)],
+    0x3D1: [CanSignal('fuel', 0x3D1, 1, 1, 'fuel_percent', 0.392)],
+}
+
+FRAMES = [
+    (0x3D0, bytes.fromhex('0082000000000000')),
+    (0x123, bytes.fromhex('DEADBEEF')),
+    (0x3D1, bytes.fromhex('00BF')),
+    (0x7E8, bytes.fromhex('100A4105820C1AF8')),
+    (0x7E8, bytes.fromhex('210D322FBF000000')),
+]
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    frames = FRAMES
+    if len(sys.argv) > 2:
+        with open(sys.argv[2]) as f:
+            frames = [frame[1:] for frame in map(parse_candump_line, f) if frame]
+    reader = SocketCanReader(Mock(), signal_map=SIGNAL_MAP)
+    reader.sock = Mock()
+    reader.schedule = PollSchedule()
+    polls = [reader.schedule.add(cmd, 1) for cmd in (obd.commands.COOLANT_TEMP, obd.commands.FUEL_LEVEL)]
+
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        reader.pending = {poll.cmd.pid: poll for poll in polls}
+        for can_id, data in frames:
+            reader.handle_frame(can_id, data)
+        count += len(frames)
+    elapsed = time.perf_counter() - start
+    print(f"{count / elapsed:9.0f} frames/sec  {elapsed / count * 1e6:5.2f} us/frame  "
+          f"{reader.frames_decoded.value / elapsed:9.0f} values/sec")
+
+
+if __name__ == '__main__':
+    main()
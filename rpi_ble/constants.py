@@ -24,6 +24,8 @@ LE_ADVERTISEMENT_IFACE = "org.bluez.LEAdvertisement1"
 GPS_SERVICE_UUID = '28b82eb3-25cd-45ab-8601-3fff6ba3a200'
 GPS_DATA_CHRC_UUID = '28b82eb3-25cd-45ab-8601-3fff6ba3a201'
 GPS_DATA_DESCRIPTOR_UUID = '2901'
+GPS_BINARY_CHRC_UUID = '28b82eb3-25cd-45ab-8601-3fff6ba3a208'
+GPS_BINARY_DESCRIPTOR_UUID = '2901'
 
 OBD_SERVICE_UUID = '28b82eb3-25cd-45ab-8601-3fff6ba3a202'
 ENGINE_TEMP_CHRC_UUID = '28b82eb3-25cd-45ab-8601-3fff6ba3a203'
@@ -37,6 +39,12 @@ GPS_CONNECTED_DESCRIPTOR_UUID = '2901'
 
 NOTIFY_DESCRIPTOR_UUID = '2902'
 
+## Notification rate limits (per second)
+
+# the JSON fix takes ~6 packets at the default MTU, the binary one fits in one
+GPS_JSON_MAX_NOTIFY_RATE = 10
+GPS_BINARY_MAX_NOTIFY_RATE = 25
+
 # location : 0x2A5D
 # temperature : 0x2A6E
 # general summary data : 0x2B3D
@@ -1,13 +1,10 @@
-import dbus
 import logging
 
-from gi.repository import GLib
-
 from rpi_ble.constants import DEVICE_STATUS_SERVICE_UUID, OBD_CONNECTED_CHRC_UUID, GPS_CONNECTED_CHRC_UUID, \
     OBD_CONNECTED_DESCRIPTOR_UUID, GPS_CONNECTED_DESCRIPTOR_UUID
 from rpi_ble.event_defs import OBDConnectedEvent, OBDDisconnectedEvent, GPSDisconnectedEvent, GPSConnectedEvent
-from rpi_ble.events import EventHandler
-from rpi_ble.service import GattService, GattCharacteristic, GATT_CHRC_IFACE, Descriptor, NotifyDescriptor
+from rpi_ble.events import EventHandler, Delivery
+from rpi_ble.service import GattService, GattCharacteristic, Descriptor, NotifyDescriptor
 
 logger = logging.getLogger(__name__)
 
@@ -34,9 +31,8 @@ class ObdConnectedChrc(GattCharacteristic, EventHandler):
         self.add_descriptor(NotifyDescriptor(bus, 1, self))
         self.notifying = False
         self.obd_connected: bool = False
-        self.update_pending = False
-        OBDConnectedEvent.register_handler(self)
-        OBDDisconnectedEvent.register_handler(self)
+        OBDConnectedEvent.register_handler(self, Delivery.MAIN_LOOP)
+        OBDDisconnectedEvent.register_handler(self, Delivery.MAIN_LOOP)
 
     def handle_event(self, event, **kwargs):
         if event == OBDConnectedEvent:
@@ -45,19 +41,8 @@ class ObdConnectedChrc(GattCharacteristic, EventHandler):
             self.obd_connected = False
         else:
             logger.warning("unknown event")
-        # Schedule D-Bus call on main thread to avoid blocking
-        # Only schedule if no update is already pending
-        if not self.update_pending:
-            self.update_pending = True
-            logger.debug("Queueing OBD connection status property change notification to GLib main loop")
-            GLib.idle_add(self._notify_property_changed)
-
-    def _notify_property_changed(self):
-        logger.info("Executing OBD connection status property change notification")
-        value = self.ReadValue(None)
-        self.PropertiesChanged(GATT_CHRC_IFACE, {'Value': value}, [])
-        self.update_pending = False
-        return False  # Don't repeat this idle callback
+        logger.debug("OBD connection status changed")
+        self.notify_value_changed()
 
     def StartNotify(self):
         if self.notifying:
@@ -73,8 +58,8 @@ class ObdConnectedChrc(GattCharacteristic, EventHandler):
 
         self.notifying = False
 
-    def ReadValue(self, options):
-        return [dbus.Byte(1 if self.obd_connected else 0)]
+    def get_value_bytes(self) -> bytes:
+        return b'\x01' if self.obd_connected else b'\x00'
 
 class GpsConnectedChrc(GattCharacteristic, EventHandler):
 
@@ -88,9 +73,8 @@ class GpsConnectedChrc(GattCharacteristic, EventHandler):
         self.add_descriptor(NotifyDescriptor(bus, 1, self))
         self.notifying = False
         self.gps_connected: bool = False
-        self.update_pending = False
-        GPSConnectedEvent.register_handler(self)
-        GPSDisconnectedEvent.register_handler(self)
+        GPSConnectedEvent.register_handler(self, Delivery.MAIN_LOOP)
+        GPSDisconnectedEvent.register_handler(self, Delivery.MAIN_LOOP)
 
     def handle_event(self, event, **kwargs):
         if event == GPSConnectedEvent:
@@ -99,19 +83,8 @@ class GpsConnectedChrc(GattCharacteristic, EventHandler):
             self.gps_connected = False
         else:
             logger.warning("unknown event")
-        # Schedule D-Bus call on main thread to avoid blocking
-        # Only schedule if no update is already pending
-        if not self.update_pending:
-            self.update_pending = True
-            logger.debug("Queueing GPS connection status property change notification to GLib main loop")
-            GLib.idle_add(self._notify_property_changed)
-
-    def _notify_property_changed(self):
-        logger.info("Executing GPS connection status property change notification")
-        value = self.ReadValue(None)
-        self.PropertiesChanged(GATT_CHRC_IFACE, {'Value': value}, [])
-        self.update_pending = False
-        return False  # Don't repeat this idle callback
+        logger.debug("GPS connection status changed")
+        self.notify_value_changed()
 
     def StartNotify(self):
         logger.info("StartNotify called")
@@ -129,8 +102,8 @@ class GpsConnectedChrc(GattCharacteristic, EventHandler):
 
         self.notifying = False
 
-    def ReadValue(self, options):
-        return [dbus.Byte(1 if self.gps_connected else 0)]
+    def get_value_bytes(self) -> bytes:
+        return b'\x01' if self.gps_connected else b'\x00'
 
 class ObdConnectedDescriptor(Descriptor):
     OBD_CONNECTED_DESCRIPTOR_VALUE = "OBD Connection Status"
@@ -144,14 +117,8 @@ class ObdConnectedDescriptor(Descriptor):
             ["read"],
             characteristic)
 
-    def ReadValue(self, options):
-        value = []
-        desc = self.OBD_CONNECTED_DESCRIPTOR_VALUE
-
-        for c in desc:
-            value.append(dbus.Byte(c.encode()))
-
-        return value
+    def get_value_bytes(self) -> bytes:
+        return self.OBD_CONNECTED_DESCRIPTOR_VALUE.encode()
 
 class GpsConnectedDescriptor(Descriptor):
     GPS_CONNECTED_DESCRIPTOR_VALUE = "GPS Connection Status"
@@ -165,14 +132,8 @@ class GpsConnectedDescriptor(Descriptor):
             ["read"],
             characteristic)
 
-    def ReadValue(self, options):
-        value = []
-        desc = self.GPS_CONNECTED_DESCRIPTOR_VALUE
-
-        for c in desc:
-            value.append(dbus.Byte(c.encode()))
-
-        return value
+    def get_value_bytes(self) -> bytes:
+        return self.GPS_CONNECTED_DESCRIPTOR_VALUE.encode()
 
 
 
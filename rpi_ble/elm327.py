@@ -0,0 +1,256 @@
+import logging
+import time
+
+import obd
+import serial
+
+from rpi_ble.event_defs import OBDConnectedEvent, OBDDisconnectedEvent
+from rpi_ble.obd_reader import ObdReader
+from rpi_ble.usb_detector import UsbDetector, UsbDevice
+
+logger = logging.getLogger(__name__)
+
+# mode 01 pid : number of data bytes
+PID_LENGTHS = {
+    0x00: 4,
+    0x05: 1,
+    0x0C: 2,
+    0x0D: 1,
+    0x11: 1,
+    0x20: 4,
+    0x2F: 1,
+}
+
+# mode 01 pid : data bytes -> the integer we send over BLE
+PID_DECODERS = {
+    # coolant temp, in F
+    0x05: lambda d: int((d[0] - 40) * 9 / 5 + 32),
+    # rpm
+    0x0C: lambda d: (d[0] * 256 + d[1]) // 4,
+    # speed, km/h
+    0x0D: lambda d: d[0],
+    # throttle, %
+    0x11: lambda d: int(d[0] * 100 / 255),
+    # fuel level, %
+    0x2F: lambda d: int(d[0] * 100 / 255),
+}
+
+PROMPT = b'>'
+
+
+class Elm327Exception(Exception):
+    pass
+
+
+class Elm327:
+    """
+    A minimal ELM327 driver for polling the few mode 01 pids we use, without
+    python-obd's general purpose parsing and unit conversion.
+
+    Echo, spaces and headers are turned off once so responses are short and need
+    no parsing beyond hex decoding. An ELM327 abandons a request as soon as it
+    receives another character, so requests can't overlap : instead each one is
+    written the moment the prompt for the last one arrives, and once the number
+    of lines a request gets back is known it's appended to the request so the
+    adapter replies without waiting out its timeout.
+    """
+
+    SETTLE_TIME = 0.2
+
+    def __init__(self, port: str, baudrate: int = 38400, timeout: float = 5.0):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.serial = None
+        self._status = obd.OBDStatus.NOT_CONNECTED
+        # request : number of lines in the response
+        self.response_lines = {}
+
+    def open(self) -> bool:
+        try:
+            self.serial = serial.serial_for_url(self.port, baudrate=self.baudrate, timeout=self.timeout)
+            # reset, with echo still on. Whatever was last using the adapter may have
+            # left a response behind, so let things settle and drop anything stale
+            self.serial.reset_input_buffer()
+            self.send('ATZ')
+            time.sleep(self.SETTLE_TIME)
+            self.serial.reset_input_buffer()
+            for command in ('ATE0', 'ATL0', 'ATS0', 'ATH0', 'ATSP0'):
+                if 'OK' not in self.send(command):
+                    raise Elm327Exception(f"{command} did not return OK")
+            self._status = obd.OBDStatus.ELM_CONNECTED
+            # the first request makes the adapter search for the car's protocol
+            if self.query_pids([0x00]):
+                self._status = obd.OBDStatus.CAR_CONNECTED
+        except (serial.SerialException, OSError, Elm327Exception):
+            logger.exception("unable to open ELM327 on %s", self.port)
+            self.close()
+        return self._status == obd.OBDStatus.CAR_CONNECTED
+
+    def status(self):
+        return self._status
+
+    def close(self):
+        if self.serial:
+            try:
+                self.serial.close()
+            except (serial.SerialException, OSError):
+                logger.debug("Error closing ELM327 port")
+            self.serial = None
+        self._status = obd.OBDStatus.NOT_CONNECTED
+
+    def send(self, command: str) -> list:
+        """
+        Send a command and return the lines of the response
+        """
+        self.serial.write(command.encode() + b'\r')
+        buffer = b''
+        deadline = time.monotonic() + self.timeout
+        while not buffer.endswith(PROMPT):
+            data = self.serial.read(self.serial.in_waiting or 1)
+            if not data and time.monotonic() > deadline:
+                self._status = obd.OBDStatus.NOT_CONNECTED
+                raise Elm327Exception(f"no prompt after {command}")
+            buffer += data
+        return [line for line in buffer[:-1].decode('ascii', 'replace').replace('\n', '').split('\r')
+                if line and line != command]
+
+    def query_pids(self, pids: list) -> dict:
+        """
+        Request up to six mode 01 pids at once, returns {pid: data bytes} for those
+        that came back
+        """
+        request = '01' + ''.join(f"{pid:02X}" for pid in pids)
+        lines = self.send(request + str(self.response_lines.get(request, '')))
+        data = parse_response(lines)
+        if data:
+            self.response_lines.setdefault(request, response_line_count(lines))
+        return split_mode_01(data)
+
+    def read_pids(self, pids: list) -> dict:
+        """
+        As query_pids, but decoded : {pid: int}
+        """
+        return {pid: PID_DECODERS[pid](data) for pid, data in self.query_pids(pids).items() if pid in PID_DECODERS}
+
+
+def parse_response(lines: list) -> bytes:
+    """
+    Turn the lines an ELM327 sends back, with headers and spaces off, into the
+    data of the first ECU's response
+    """
+    if len(lines) > 1 and ':' in lines[1]:
+        # multi frame : a byte count, then numbered lines
+        length = int(lines[0], 16)
+        return bytes.fromhex(''.join(line.split(':', 1)[1] for line in lines[1:]))[:length]
+    for line in lines:
+        # skipping SEARCHING..., NO DATA, STOPPED and so on
+        if is_hex(line):
+            return bytes.fromhex(line)
+    return b''
+
+
+def response_line_count(lines: list) -> int:
+    if len(lines) > 1 and ':' in lines[1]:
+        return len(lines) - 1
+    return len([line for line in lines if is_hex(line)])
+
+
+def is_hex(line: str) -> bool:
+    try:
+        bytes.fromhex(line)
+        return True
+    except ValueError:
+        return False
+
+
+def split_mode_01(data: bytes) -> dict:
+    values = {}
+    if not data or data[0] != 0x41:
+        return values
+    i = 1
+    while i < len(data):
+        pid = data[i]
+        length = PID_LENGTHS.get(pid)
+        if length is None or i + 1 + length > len(data):
+            break
+        values[pid] = data[i + 1:i + 1 + length]
+        i += 1 + length
+    return values
+
+
+class Elm327Response:
+    """
+    Just enough of an OBDResponse for ObdReader.poll
+    """
+
+    __slots__ = ('command', 'value', 'time')
+
+    def __init__(self, command, value):
+        self.command = command
+        self.value = value
+        self.time = time.time()
+
+    def is_null(self):
+        return self.value is None
+
+
+class Elm327Reader(ObdReader):
+    """
+    ObdReader on the lean Elm327 driver, values arrive as integers with no pint
+    conversion
+    """
+
+    def connect(self, old_connection):
+        if not UsbDetector.detected(UsbDevice.OBD):
+            return None
+
+        port = UsbDetector.get(UsbDevice.OBD)
+        if not port:
+            return None
+
+        if old_connection:
+            OBDDisconnectedEvent.emit()
+            old_connection.close()
+
+        result = Elm327(port)
+        if not result.open():
+            if result.status() == obd.OBDStatus.NOT_CONNECTED:
+                # not even an ELM327 there
+                UsbDetector.reject(UsbDevice.OBD)
+            result.close()
+            return None
+        UsbDetector.confirm(UsbDevice.OBD)
+
+        logger.info("Car Connected")
+        OBDConnectedEvent.emit()
+        return result
+
+    def query(self, connection: Elm327, polls: list) -> list:
+        pids = [poll.cmd.pid for poll in polls]
+        values = connection.read_pids(pids)
+        if len(polls) > 1 and not values:
+            logger.info(f"no response to batched request for {pids}, querying one pid at a time")
+            self.batching = False
+            for pid in pids:
+                values.update(connection.read_pids([pid]))
+        return [(poll, Elm327Response(poll.cmd, values.get(poll.cmd.pid))) for poll in polls]
+
+    def process_result(self, cmd, response: Elm327Response):
+        if response.value is None:
+            return None
+        logger.debug(f"processing {cmd} at {response.value}")
+        if cmd == obd.commands.COOLANT_TEMP:
+            self.temp_f = response.value
+            self.temp_time = response.time
+            self.receiver.set_temp_f(self.temp_f)
+            return self.temp_f
+        elif cmd == obd.commands.FUEL_LEVEL:
+            if response.value:
+                self.fuel_level = response.value
+                self.fuel_level_time = response.time
+                self.receiver.set_fuel_percent_remaining(self.fuel_level)
+                return self.fuel_level
+            return None
+        else:
+            raise RuntimeWarning(f"no handler for {cmd}")
@@ -0,0 +1,177 @@
+import logging
+import os
+import select
+import time
+import tty
+from threading import Thread
+
+logger = logging.getLogger(__name__)
+
+# mode 01 pid : response data bytes
+DEFAULT_PIDS = {
+    0x05: bytes([130]),          # coolant temp, 90C
+    0x0C: bytes([0x1A, 0xF8]),   # rpm, 1726
+    0x0D: bytes([50]),           # speed, 50 km/h
+    0x11: bytes([64]),           # throttle, 25%
+    0x2F: bytes([191]),          # fuel level, 75%
+}
+
+ENGINE_HEADER = '7E8'
+
+
+class Elm327Emulator(Thread):
+    """
+    An ELM327 with a single CAN (11 bit) engine ECU behind it, on a pseudo
+    terminal, so the OBD code can be tested and benchmarked without a car.
+
+    It understands the AT commands python-obd and our own driver send, mode 01
+    requests for one or several pids, and mode 09 pid 02 (VIN). Requests take
+    ecu_latency seconds, plus the time the bytes would take on a serial line at
+    baudrate.
+    """
+
+    def __init__(self, pids: dict = None, vin: str = None, ecu_latency: float = 0.0,
+                 baudrate: int = 38400, multi_pid: bool = True, protocol: str = '6'):
+        Thread.__init__(self, daemon=True)
+        self.pids = dict(DEFAULT_PIDS if pids is None else pids)
+        self.vin = vin
+        self.ecu_latency = ecu_latency
+        self.baudrate = baudrate
+        # some adapters / ECUs only answer one pid per request
+        self.multi_pid = multi_pid
+        # the protocol the car talks, '6' is ISO 15765-4 CAN 11/500
+        self.protocol = protocol
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.finished = False
+        self.last_command = ''
+        self.requests = 0
+        self.reset()
+
+    def reset(self):
+        self.echo = True
+        self.headers = False
+        self.linefeeds = True
+        self.spaces = True
+        # '0' is automatic, anything else has to match the car's protocol
+        self.selected_protocol = '0'
+
+    def run(self):
+        buffer = b''
+        while not self.finished:
+            try:
+                readable, _, _ = select.select([self.master], [], [], 0.1)
+                if not readable:
+                    continue
+                data = os.read(self.master, 1024)
+            except OSError:
+                break
+            buffer += data
+            while b'\r' in buffer:
+                line, buffer = buffer.split(b'\r', 1)
+                self.handle(line.decode('ascii', 'replace'))
+
+    def close(self):
+        self.finished = True
+        self.join(1)
+        os.close(self.master)
+        os.close(self.slave)
+
+    def handle(self, line: str):
+        command = line.replace(' ', '').upper()
+        if command == '':
+            command = self.last_command
+        else:
+            self.last_command = command
+        if command.startswith('\x7f') or command == '':
+            lines = ['?']
+        elif command.startswith('AT'):
+            lines = self.at_command(command[2:])
+        else:
+            self.requests += 1
+            lines = self.obd_command(command)
+        eol = '\r\n' if self.linefeeds else '\r'
+        response = (line + '\r' if self.echo else '') + ''.join(l + eol for l in lines) + eol + '>'
+        out = response.encode()
+        time.sleep((len(line) + 1 + len(out)) * 10 / self.baudrate)
+        os.write(self.master, out)
+
+    def at_command(self, command: str) -> list:
+        if command in ('Z', 'WS', 'D'):
+            self.reset()
+            return ['', 'ELM327 v1.5']
+        if command == 'I':
+            return ['ELM327 v1.5']
+        if command == 'RV':
+            return ['12.6V']
+        if command == 'DPN':
+            return ['A' + self.protocol]
+        if command == 'DP':
+            return ['AUTO, ISO 15765-4 (CAN 11/500)']
+        if command[:1] in ('E', 'H', 'L', 'S') and command[1:] in ('0', '1'):
+            setting = {'E': 'echo', 'H': 'headers', 'L': 'linefeeds', 'S': 'spaces'}[command[0]]
+            setattr(self, setting, command[1:] == '1')
+            return ['OK']
+        if command[:2] in ('SP', 'TP'):
+            self.selected_protocol = command[2:].lstrip('A') or '0'
+            return ['OK']
+        if command[:2] in ('AT', 'ST', 'CA', 'SH', 'CF', 'CM', 'AL', 'M0', 'M1'):
+            return ['OK']
+        return ['?']
+
+    def obd_command(self, command: str) -> list:
+        try:
+            request = bytes.fromhex(command if len(command) % 2 == 0 else command[:-1])
+        except ValueError:
+            return ['?']
+        if len(request) < 2:
+            return ['?']
+        if self.selected_protocol not in ('0', self.protocol):
+            return ['UNABLE TO CONNECT']
+        time.sleep(self.ecu_latency)
+        mode, pids = request[0], request[1:]
+        if mode == 0x01:
+            if len(pids) > 6:
+                return ['?']
+            if len(pids) > 1 and not self.multi_pid:
+                return ['NO DATA']
+            data = bytearray([0x41])
+            for pid in pids:
+                value = self.supported(pid) if pid % 0x20 == 0 else self.pids.get(pid)
+                if value is not None:
+                    data.append(pid)
+                    data += value
+            if len(data) == 1:
+                return ['NO DATA']
+        elif mode == 0x09 and pids == b'\x02' and self.vin:
+            data = bytearray([0x49, 0x02, 0x01]) + self.vin.encode()
+        else:
+            return ['NO DATA']
+        return self.frames(data)
+
+    def supported(self, base: int):
+        bits = 0
+        for pid in list(self.pids) + [p for p in range(0x20, 0xE0, 0x20) if any(q > p for q in self.pids)]:
+            if base < pid <= base + 0x20:
+                bits |= 1 << (base + 0x20 - pid)
+        return bits.to_bytes(4, 'big') if bits else None
+
+    def frames(self, data: bytes) -> list:
+        if len(data) <= 7:
+            frames = [bytes([len(data)]) + data]
+        else:
+            frames = [bytes([0x10 | (len(data) >> 8), len(data) & 0xFF]) + data[:6]]
+            rest = data[6:]
+            for seq in range(1, (len(rest) + 6) // 7 + 1):
+                frames.append(bytes([0x20 | (seq & 0x0F)]) + rest[(seq - 1) * 7:seq * 7])
+        sep = ' ' if self.spaces else ''
+        if self.headers:
+            return [sep.join([ENGINE_HEADER] + [f"{b:02X}" for b in frame]) for frame in frames]
+        if len(frames) == 1:
+            return [sep.join(f"{b:02X}" for b in data)]
+        # without headers the ELM numbers the lines of a multi frame message
+        lines = [f"{len(data):03X}"]
+        for i, chunk in enumerate([data[:6]] + [data[j:j + 7] for j in range(6, len(data), 7)]):
+            lines.append(f"{i & 0x0F:X}:" + sep + sep.join(f"{b:02X}" for b in chunk))
+        return lines
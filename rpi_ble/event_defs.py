@@ -1,7 +1,10 @@
-from rpi_ble.events import Event
+from typing import NamedTuple
+
+from rpi_ble.events import Event, EventStatsLogger, ValueEvent
 
 # the application is exiting
 ExitApplicationEvent = Event("ExitApplication")
+ExitApplicationEvent.register_handler(EventStatsLogger())
 
 # OBD Events
 OBDConnectedEvent = Event("OBD-Connected")
@@ -12,3 +15,17 @@ GPSConnectedEvent = Event("GPS-Connected")
 GPSDisconnectedEvent = Event("GPS-Disconnected")
 
 
+class GpsFix(NamedTuple):
+    lat: float
+    long: float
+    heading: float
+    tstamp: float
+    speed: int
+    gdop: float
+    pdop: float
+
+
+# Sensor values
+CoolantTempEvent = ValueEvent("Coolant-Temp", int)
+FuelLevelEvent = ValueEvent("Fuel-Level", int)
+GpsFixEvent = ValueEvent("GPS-Fix", GpsFix)
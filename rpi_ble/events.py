@@ -1,5 +1,10 @@
 import logging
+import queue
+import threading
 import time
+from enum import Enum
+
+from rpi_ble import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -10,14 +15,185 @@ class EventHandler:
         pass
 
 
+class Delivery(Enum):
+    """
+    The thread a handler's events are delivered on
+    """
+    # synchronously, on whichever thread emitted the event
+    EMITTER = 'emitter'
+    # queued for the event dispatcher thread
+    DISPATCHER = 'dispatcher'
+    # queued for the GLib main loop, e.g. for handlers that talk to dbus
+    MAIN_LOOP = 'main_loop'
+
+
+class DeliveryQueue:
+    """
+    A bounded queue of (handler, event, kwargs) waiting to be delivered. When it's
+    full the delivery is dropped and counted rather than blocking the emitter.
+    """
+
+    # log the first overflow, then every this many
+    OVERFLOW_LOG_INTERVAL = 100
+
+    def __init__(self, name: str, max_size: int):
+        self.name = name
+        self.queue = queue.Queue(max_size)
+        self.queued = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def put(self, item) -> bool:
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % self.OVERFLOW_LOG_INTERVAL == 1:
+                logger.warning(f"{self.name} event queue full, dropped ({self.dropped}) deliveries")
+            return False
+        self.queued += 1
+        self.high_water = max(self.high_water, self.queue.qsize())
+        return True
+
+    def deliver(self, item):
+        handler, event, kwargs = item
+        event.call_handler(handler, kwargs)
+        self.delivered += 1
+
+    def stats(self) -> dict:
+        return {
+            'queued': self.queued,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'depth': self.queue.qsize(),
+            'high_water': self.high_water,
+        }
+
+
+class EventDispatcher:
+    """
+    Delivers events to handlers that don't want them on the emitting thread.
+
+    DISPATCHER handlers are run, in order, by a daemon thread started on first
+    use. MAIN_LOOP handlers are run from an idle callback once use_main_loop has
+    been given GLib.idle_add; until then, and after use_main_loop(None) at
+    shutdown, they're delivered on the emitting thread.
+    """
+
+    MAX_QUEUED = 256
+
+    def __init__(self, max_queued: int = MAX_QUEUED):
+        self.dispatcher_queue = DeliveryQueue('dispatcher', max_queued)
+        self.main_loop_queue = DeliveryQueue('main loop', max_queued)
+        self.thread = None
+        self.idle_add = None
+        self.drain_scheduled = False
+        self.lock = threading.Lock()
+
+    def use_main_loop(self, idle_add):
+        with self.lock:
+            self.idle_add = idle_add
+            self.drain_scheduled = False
+        if idle_add is None:
+            # whatever is still waiting goes out now
+            self._drain_main_loop()
+
+    def dispatch(self, handler, delivery: Delivery, event, kwargs: dict) -> bool:
+        """
+        Returns False if the delivery was dropped because its queue was full
+        """
+        item = (handler, event, kwargs)
+        if delivery == Delivery.DISPATCHER:
+            self._start_thread()
+            return self.dispatcher_queue.put(item)
+        if delivery == Delivery.MAIN_LOOP and self.idle_add:
+            with self.lock:
+                if not self.main_loop_queue.put(item):
+                    return False
+                if not self.drain_scheduled:
+                    self.drain_scheduled = True
+                    self.idle_add(self._drain_main_loop)
+            return True
+        self.main_loop_queue.deliver(item)
+        return True
+
+    def _start_thread(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="event-dispatcher", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            self.dispatcher_queue.deliver(self.dispatcher_queue.queue.get())
+
+    def _drain_main_loop(self):
+        while True:
+            try:
+                item = self.main_loop_queue.queue.get_nowait()
+            except queue.Empty:
+                with self.lock:
+                    # something may have been queued since, without scheduling us
+                    if self.main_loop_queue.queue.empty():
+                        self.drain_scheduled = False
+                        return False
+                continue
+            self.main_loop_queue.deliver(item)
+
+    def stats(self) -> dict:
+        return {
+            'dispatcher': self.dispatcher_queue.stats(),
+            'main_loop': self.main_loop_queue.stats(),
+        }
+
+
+dispatcher = EventDispatcher()
+metrics.registry.observe('events.dispatcher.dropped', lambda: dispatcher.dispatcher_queue.dropped)
+metrics.registry.observe('events.dispatcher.depth', lambda: dispatcher.dispatcher_queue.queue.qsize())
+metrics.registry.observe('events.main_loop.dropped', lambda: dispatcher.main_loop_queue.dropped)
+metrics.registry.observe('events.main_loop.depth', lambda: dispatcher.main_loop_queue.queue.qsize())
+
+
+class HandlerStats:
+    """
+    How often one class of handler has been called for an event, how long it
+    took and how often it raised, kept in the metrics registry as
+    events.<event>.<handler>.ms and .exceptions
+    """
+
+    def __init__(self, name: str):
+        self.histogram = metrics.registry.histogram(f"{name}.ms", metrics.TIME_BUCKETS_MS)
+        self.exceptions = metrics.registry.counter(f"{name}.exceptions")
+
+    def record(self, elapsed: float, failed: bool):
+        if failed:
+            self.exceptions.inc()
+        self.histogram.observe(elapsed * 1000)
+
+    def to_dict(self) -> dict:
+        histogram = self.histogram
+        return {
+            'calls': histogram.count,
+            'exceptions': self.exceptions.value,
+            'mean_ms': round(histogram.total / histogram.count, 3) if histogram.count else 0.0,
+            'max_ms': round(histogram.max, 3),
+            'histogram_ms': histogram.to_dict(),
+        }
+
+
 class Event:
 
     # stop the logs getting too full : suppress repeat events in info log
     last_event = None
     last_event_count = 0
     instances = []
+    # events are emitted from the reader threads as well as the main loop
+    lock = threading.Lock()
+    # warn about handlers taking longer than this, in seconds
+    slow_handler_threshold = 0.1
 
-    def __init__(self, name="", suppress_logs=False, debounce_time=0):
+    def __init__(self, name="", suppress_logs=False, debounce_time=0, slow_handler_threshold=None):
         self.name = name
         for e in Event.instances:
             if e.name == name:
@@ -29,10 +205,21 @@ class Event:
         self.debounce_time = debounce_time
         self.last_event_time: float = 0.0
         self.handlers = []
+        # handler : Delivery
+        self.deliveries = {}
+        # overrides the class wide threshold for this event's handlers
+        self.slow_handler_threshold = slow_handler_threshold
+        self.emitted = 0
+        self.debounced = 0
+        # handler class name : HandlerStats
+        self.handler_stats = {}
+        self.stats_lock = threading.Lock()
+        metrics.registry.observe(f"events.{name}.emitted", lambda: self.emitted)
 
-    def register_handler(self, handler: EventHandler):
+    def register_handler(self, handler: EventHandler, delivery: Delivery = Delivery.EMITTER):
         if handler not in self.handlers:
             self.handlers.append(handler)
+            self.deliveries[id(handler)] = delivery
         else:
             logger.error("{} attempted to register same handler twice {}", self.name, handler.__class__)
 
@@ -45,31 +232,187 @@ class Event:
                 break
         if target:
             self.handlers.remove(target)
+            self.deliveries.pop(id(target), None)
 
     def emit(self, **kwargs):
-        if self == Event.last_event and self.suppress_logs:
-            Event.last_event_count += 1
-        else:
-            if Event.last_event_count > 0:
-                logger.info(f"suppressed ({Event.last_event_count}) {Event.last_event.name}")
-            logger.info(f"emitting {self.name}")
-            Event.last_event_count = 0
-        # prevent repeat emitting events if they have just happened
-        now = time.time()
-        if now - self.last_event_time > self.debounce_time:
+        suppressed = None
+        with Event.lock:
+            repeat = self == Event.last_event and self.suppress_logs
+            if repeat:
+                Event.last_event_count += 1
+            elif Event.last_event_count > 0:
+                suppressed = (Event.last_event_count, Event.last_event.name)
+            if not repeat:
+                Event.last_event_count = 0
+            # prevent repeat emitting events if they have just happened
+            now = time.time()
+            fire = now - self.last_event_time > self.debounce_time
             # safest to leave these here to prevent re-entrant code
             self.last_event_time = now
             Event.last_event = self
-            # call all the registered handlers
-            for handler in self.handlers:
-                try:
-                    handler.handle_event(self, **kwargs)
-                except Exception:
-                    logger.exception("exception handling event")
-        else:
-            self.last_event_time = now
-            Event.last_event = self
+            handlers = list(self.handlers)
+            self.emitted += 1
+            if not fire:
+                self.debounced += 1
+        if suppressed:
+            logger.info(f"suppressed ({suppressed[0]}) {suppressed[1]}")
+        if not repeat:
+            logger.info(f"emitting {self.name}")
+        if fire:
+            # call all the registered handlers, or queue them for their thread
+            for handler in handlers:
+                delivery = self.deliveries.get(id(handler), Delivery.EMITTER)
+                if delivery == Delivery.EMITTER:
+                    self.call_handler(handler, kwargs)
+                else:
+                    dispatcher.dispatch(handler, delivery, self, kwargs)
+
+    def call_handler(self, handler: EventHandler, kwargs: dict):
+        failed = False
+        start = time.perf_counter()
+        try:
+            handler.handle_event(self, **kwargs)
+        except Exception:
+            failed = True
+            logger.exception("exception handling event")
+        name = getattr(handler, 'handler_name', None) or handler.__class__.__name__
+        self.record_handler(name, time.perf_counter() - start, failed)
+
+    def record_handler(self, name: str, elapsed: float, failed: bool):
+        with self.stats_lock:
+            stats = self.handler_stats.get(name)
+            if stats is None:
+                stats = self.handler_stats[name] = HandlerStats(f"events.{self.name}.{name}")
+            stats.record(elapsed, failed)
+        threshold = self.slow_handler_threshold
+        if threshold is None:
+            threshold = Event.slow_handler_threshold
+        if elapsed > threshold:
+            logger.warning(f"{name} took {elapsed * 1000:.0f} ms handling {self.name}")
+
+    def stats(self) -> dict:
+        with self.stats_lock:
+            return {
+                'emitted': self.emitted,
+                'debounced': self.debounced,
+                'handlers': {name: stats.to_dict() for name, stats in self.handler_stats.items()},
+            }
 
     @classmethod
     def instance_iterator(cls):
         return Event.instances.__iter__()
+
+
+class ValueSubscription(EventHandler):
+    """
+    One consumer of a ValueEvent. Samples queued for it wait in a single slot, so
+    a slow consumer gets the newest sample rather than a backlog.
+    """
+
+    def __init__(self, callback, delivery: Delivery):
+        self.callback = callback
+        self.delivery = delivery
+        func = getattr(callback, 'func', callback)
+        self.handler_name = getattr(func, '__qualname__', type(func).__name__)
+        self.value = None
+        self.pending = False
+        self.coalesced = 0
+        self.lock = threading.Lock()
+
+    def offer(self, value) -> bool:
+        """
+        Store value for delivery, returns whether a delivery needs queuing
+        """
+        with self.lock:
+            self.value = value
+            if self.pending:
+                self.coalesced += 1
+                return False
+            self.pending = True
+            return True
+
+    def cancel(self):
+        # the delivery was dropped, let the next sample queue another
+        with self.lock:
+            self.pending = False
+
+    def handle_event(self, event, **kwargs):
+        with self.lock:
+            value = self.value
+            self.pending = False
+        self.callback(value)
+
+
+class ValueEvent(Event):
+    """
+    A stream of samples of one sensor value, of value_type, fanned out to every
+    subscriber. Subscribers choose their Delivery as event handlers do; those
+    not on the emitter have at most one delivery queued, later samples replace
+    the one waiting, so a fast producer can't build up a queue.
+
+    Samples aren't logged and aren't debounced.
+    """
+
+    def __init__(self, name: str, value_type: type, slow_handler_threshold=None):
+        super().__init__(name, slow_handler_threshold=slow_handler_threshold)
+        self.value_type = value_type
+        # replaced rather than changed, so emit can iterate it without a lock
+        self.subscriptions = ()
+
+    def subscribe(self, callback, delivery: Delivery = Delivery.EMITTER):
+        """
+        callback(value) is called for each sample, or the latest sample
+        """
+        with Event.lock:
+            self.subscriptions = self.subscriptions + (ValueSubscription(callback, delivery),)
+
+    def unsubscribe(self, callback):
+        with Event.lock:
+            self.subscriptions = tuple(s for s in self.subscriptions if s.callback != callback)
+
+    def emit(self, value):
+        if not isinstance(value, self.value_type):
+            raise TypeError(f"{self.name} takes {self.value_type.__name__}, not {type(value).__name__}")
+        with self.stats_lock:
+            self.emitted += 1
+        for subscription in self.subscriptions:
+            if subscription.delivery == Delivery.EMITTER:
+                # called directly rather than through call_handler, this is the hot path
+                failed = False
+                start = time.perf_counter()
+                try:
+                    subscription.callback(value)
+                except Exception:
+                    failed = True
+                    logger.exception(f"exception handling {self.name}")
+                self.record_handler(subscription.handler_name, time.perf_counter() - start, failed)
+            elif subscription.offer(value):
+                if not dispatcher.dispatch(subscription, subscription.delivery, self, {}):
+                    subscription.cancel()
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats['coalesced'] = {s.handler_name: s.coalesced for s in self.subscriptions}
+        return stats
+
+
+def event_stats() -> dict:
+    """
+    Emit counts and handler timings for every event, and the dispatch queues
+    """
+    return {
+        'events': {event.name: event.stats() for event in Event.instances},
+        'dispatch': dispatcher.stats(),
+    }
+
+
+class EventStatsLogger(EventHandler):
+    """
+    Logs event_stats() when the application exits
+    """
+
+    def handle_event(self, event, **kwargs):
+        for name, stats in event_stats()['events'].items():
+            if stats['emitted']:
+                logger.info(f"Event stats {name}: {stats}")
+        logger.info(f"Event dispatch stats: {dispatcher.stats()}")
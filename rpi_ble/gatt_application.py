@@ -11,6 +11,7 @@ from gi.repository import GLib
 
 from rpi_ble.constants import BLUEZ_SERVICE_NAME, GATT_MANAGER_IFACE, DBUS_OM_IFACE, DBUS_PROP_IFACE
 from rpi_ble.gatt_advertisement import GattAdvertisement
+from rpi_ble.metrics import registry
 from rpi_ble.utils import find_adapter
 
 logger = logging.getLogger(__name__)
@@ -22,7 +23,8 @@ class LemonPiAdvertisement(GattAdvertisement):
         self.include_tx_power = True
 
 class GattApplication(dbus.service.Object):
-    def __init__(self, bus, test_mode=False):
+    def __init__(self, bus, test_mode=False, gps_source='thread', obd_driver='python-obd',
+                 can_interface='can0', can_signal_map=None):
         self.path = '/'
         self.services = []
         self.bus = bus
@@ -30,13 +32,19 @@ class GattApplication(dbus.service.Object):
         self.advertisement = None
         self.is_advertising = False
         self.test_mode = test_mode
+        self.managed_objects = None
+        self.advertising = registry.gauge('ble.advertising')
+        self.advertising_starts = registry.counter('ble.advertising.starts')
+        self.advertising_failures = registry.counter('ble.advertising.failures')
+        self.clients = registry.gauge('ble.clients')
 
         dbus.service.Object.__init__(self, bus, self.path)
         from rpi_ble.device_status_gatt_service import DeviceStatusGattService
         from rpi_ble.gps_gatt_service import GpsGattService
         from rpi_ble.obd_gatt_service import ObdGattService
-        self.gps_service = GpsGattService(bus, 0, test_mode=test_mode)
-        self.obd_service = ObdGattService(bus, 1, test_mode=test_mode)
+        self.gps_service = GpsGattService(bus, 0, test_mode=test_mode, gps_source=gps_source)
+        self.obd_service = ObdGattService(bus, 1, test_mode=test_mode, obd_driver=obd_driver,
+                                          can_interface=can_interface, can_signal_map=can_signal_map)
         self.add_service(self.gps_service)
         self.add_service(self.obd_service)
         self.add_service(DeviceStatusGattService(bus, 2))
@@ -50,6 +58,11 @@ class GattApplication(dbus.service.Object):
 
     def add_service(self, service):
         self.services.append(service)
+        self.managed_objects = None
+
+    def remove_service(self, service):
+        self.services.remove(service)
+        self.managed_objects = None
 
     def register_application(self, bus):
         adapter = find_adapter(bus)
@@ -58,6 +71,8 @@ class GattApplication(dbus.service.Object):
             return
 
         self.adapter_path = adapter
+        # build the object tree now, rather than while BlueZ waits on GetManagedObjects
+        self.get_managed_objects()
         service_manager = dbus.Interface(
             bus.get_object(BLUEZ_SERVICE_NAME, adapter),
             GATT_MANAGER_IFACE)
@@ -84,6 +99,9 @@ class GattApplication(dbus.service.Object):
         
         # Stop advertising first
         self.stop_advertising()
+
+        for path, stats in self.notification_stats().items():
+            logger.info(f"notifications {path} : {stats}")
         
         # Unregister GATT application
         self.unregister_application()
@@ -109,6 +127,17 @@ class GattApplication(dbus.service.Object):
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
+    def notification_stats(self) -> dict:
+        """
+        Notifications emitted versus suppressed (no subscriber) and dropped
+        (coalesced or rate limited), per characteristic path
+        """
+        stats = {}
+        for service in self.services:
+            for chrc in service.get_characteristics():
+                stats[chrc.path] = chrc.publisher.stats()
+        return stats
+
     def get_gps_service(self):
         return self.gps_service
 
@@ -123,8 +152,11 @@ class GattApplication(dbus.service.Object):
             try:
                 self.advertisement.register(self.bus)
                 self.is_advertising = True
+                self.advertising_starts.inc()
+                self.advertising.set(1)
                 logger.info("BLE advertising started")
             except Exception as e:
+                self.advertising_failures.inc()
                 logger.error(f"Failed to start advertising: {e}")
 
     def stop_advertising(self):
@@ -132,6 +164,7 @@ class GattApplication(dbus.service.Object):
             try:
                 self.advertisement.unregister()
                 self.is_advertising = False
+                self.advertising.set(0)
                 logger.info("BLE advertising stopped")
             except Exception as e:
                 logger.error(f"Failed to stop advertising: {e}")
@@ -140,11 +173,13 @@ class GattApplication(dbus.service.Object):
         if interface == "org.bluez.Device1" and "Connected" in changed:
             if changed["Connected"]:
                 self.connected_devices.add(path)
+                self.clients.set(len(self.connected_devices))
                 if self.is_advertising:
                     self.stop_advertising()
                 logger.info(f"BLE client connected: {path}")
             else:
                 self.connected_devices.discard(path)
+                self.clients.set(len(self.connected_devices))
                 logger.info(f"BLE client disconnected: {path}")
                 
                 # Re-advertise when client disconnects
@@ -163,18 +198,24 @@ class GattApplication(dbus.service.Object):
             self.start_advertising()
         return False
 
+    def get_managed_objects(self):
+        # only invalidated when a service is added or removed
+        if self.managed_objects is None:
+            response = {}
+            for service in self.services:
+                response[service.get_path()] = service.get_properties()
+                chrcs = service.get_characteristics()
+                for chrc in chrcs:
+                    response[chrc.get_path()] = chrc.get_properties()
+                    descriptors = chrc.get_descriptors()
+                    for desc in descriptors:
+                        response[desc.get_path()] = desc.get_properties()
+            self.managed_objects = dbus.Dictionary(response, signature='oa{sa{sv}}')
+        return self.managed_objects
+
     @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
     def GetManagedObjects(self):
-        response = {}
-        for service in self.services:
-            response[service.get_path()] = service.get_properties()
-            chrcs = service.get_characteristics()
-            for chrc in chrcs:
-                response[chrc.get_path()] = chrc.get_properties()
-                descriptors = chrc.get_descriptors()
-                for desc in descriptors:
-                    response[desc.get_path()] = desc.get_properties()
-        return response
+        return self.get_managed_objects()
 
 def register_app_cb():
     logger.info('GATT application registered')
@@ -0,0 +1,237 @@
+import struct
+from collections import namedtuple
+from math import isnan
+
+# Compact binary encoding of a GPS fix, sized to fit a single notification at the
+# default ATT MTU of 23 bytes (20 bytes of payload).
+#
+# All multi-byte fields are little-endian.
+#
+#   offset  size  field
+#   0       1     frame type (FRAME_ABSOLUTE)
+#   1       4     latitude, int32, degrees * 1e7
+#   5       4     longitude, int32, degrees * 1e7
+#   9       2     heading, uint16, degrees * 100
+#   11      4     timestamp, uint32, low 32 bits of epoch milliseconds
+#   15      1     speed, uint8, mph (clamped to 255)
+#   16      1     gdop, uint8, gdop * 10 (clamped to 25.5)
+#   17      1     pdop, uint8, pdop * 10 (clamped to 25.5)
+#
+# The timestamp wraps every ~49.7 days, clients recover the full epoch time from
+# their own clock with expand_timestamp()
+#
+# Delta mode (GpsDeltaEncoder) sends a keyframe every N fixes (or on request) and
+# small signed deltas in between. Both carry a uint8 sequence number in byte 1 so
+# a client can spot a dropped notification and ask for a keyframe.
+#
+#   keyframe : frame type (FRAME_KEYFRAME), seq, then the absolute fields above
+#   delta    : frame type (FRAME_DELTA), seq,
+#              int16 lat delta, int16 long delta, int16 heading delta (same scales),
+#              uint16 milliseconds since the previous frame,
+#              uint8 speed, uint8 gdop, uint8 pdop (absolute, as above)
+#
+# Deltas are taken against the quantized values of the previous frame that was
+# encoded, so rounding errors don't accumulate on the client.
+
+FRAME_ABSOLUTE = 0x01
+FRAME_KEYFRAME = 0x02
+FRAME_DELTA = 0x03
+
+# commands a client can write to the binary characteristic
+CMD_ABSOLUTE_MODE = 0x00
+CMD_DELTA_MODE = 0x01
+CMD_KEYFRAME = 0x02
+
+DEFAULT_KEYFRAME_INTERVAL = 10
+
+LAT_LONG_SCALE = 10_000_000
+HEADING_SCALE = 100
+DOP_SCALE = 10
+
+ABSOLUTE_FORMAT = struct.Struct('<BiiHIBBB')
+ABSOLUTE_SIZE = ABSOLUTE_FORMAT.size
+KEYFRAME_FORMAT = struct.Struct('<BBiiHIBBB')
+KEYFRAME_SIZE = KEYFRAME_FORMAT.size
+DELTA_FORMAT = struct.Struct('<BBhhhHBBB')
+DELTA_SIZE = DELTA_FORMAT.size
+
+_INT16_MIN = -0x8000
+_INT16_MAX = 0x7FFF
+_UINT16_MAX = 0xFFFF
+_HEADING_WRAP = 360 * HEADING_SCALE
+
+_TSTAMP_MASK = 0xFFFFFFFF
+_TSTAMP_WRAP = _TSTAMP_MASK + 1
+
+DecodedFix = namedtuple('DecodedFix', ['lat', 'long', 'heading', 'tstamp_ms', 'speed', 'gdop', 'pdop'])
+
+
+class GpsCodecException(Exception):
+    pass
+
+
+def _clamp(value: int, low: int, high: int) -> int:
+    if value < low:
+        return low
+    if value > high:
+        return high
+    return value
+
+
+def scale_lat_long(degrees: float) -> int:
+    return int(round(degrees * LAT_LONG_SCALE))
+
+
+def scale_heading(heading: float) -> int:
+    return int(round(heading * HEADING_SCALE)) % _HEADING_WRAP
+
+
+def scale_dop(dop: float) -> int:
+    if isnan(dop):
+        return 0
+    return _clamp(int(round(dop * DOP_SCALE)), 0, 255)
+
+
+def scale_speed(speed: int) -> int:
+    return _clamp(int(speed), 0, 255)
+
+
+def scale_tstamp(tstamp: float) -> int:
+    return int(tstamp * 1000) & _TSTAMP_MASK
+
+
+def encode(lat: float, long: float, heading: float, tstamp: float,
+           speed: int, gdop: float, pdop: float) -> bytes:
+    """
+    Encode a fix (tstamp in epoch seconds) into an ABSOLUTE_SIZE byte frame
+    """
+    return ABSOLUTE_FORMAT.pack(FRAME_ABSOLUTE,
+                                scale_lat_long(lat),
+                                scale_lat_long(long),
+                                scale_heading(heading),
+                                scale_tstamp(tstamp),
+                                scale_speed(speed),
+                                scale_dop(gdop),
+                                scale_dop(pdop))
+
+
+def _unscale(lat, long, heading, tstamp_ms, speed, gdop, pdop) -> DecodedFix:
+    return DecodedFix(lat / LAT_LONG_SCALE,
+                      long / LAT_LONG_SCALE,
+                      heading / HEADING_SCALE,
+                      tstamp_ms,
+                      speed,
+                      gdop / DOP_SCALE,
+                      pdop / DOP_SCALE)
+
+
+def decode(data: bytes) -> DecodedFix:
+    if len(data) != ABSOLUTE_SIZE or data[0] != FRAME_ABSOLUTE:
+        raise GpsCodecException(f"not an absolute gps frame : {bytes(data).hex()}")
+    return _unscale(*ABSOLUTE_FORMAT.unpack(data)[1:])
+
+
+def expand_timestamp(tstamp_ms: int, reference_ms: int) -> int:
+    """
+    Recover full epoch milliseconds from the wrapped 32 bit timestamp, picking the
+    candidate closest to reference_ms (usually the receiver's clock)
+    """
+    base = reference_ms - (reference_ms & _TSTAMP_MASK)
+    candidate = base + tstamp_ms
+    if candidate - reference_ms > _TSTAMP_WRAP // 2:
+        candidate -= _TSTAMP_WRAP
+    elif reference_ms - candidate > _TSTAMP_WRAP // 2:
+        candidate += _TSTAMP_WRAP
+    return candidate
+
+
+class GpsDeltaEncoder:
+    """
+    Stateful encoder for the delta stream. Only call encode() for frames that are
+    actually going to be sent, otherwise the client loses the delta base.
+    """
+
+    def __init__(self, keyframe_interval: int = DEFAULT_KEYFRAME_INTERVAL):
+        self.keyframe_interval = keyframe_interval
+        self.seq = 0
+        self.frames_since_keyframe = 0
+        self.keyframe_requested = True
+        self.previous = None
+
+    def request_keyframe(self):
+        self.keyframe_requested = True
+
+    def encode(self, lat: float, long: float, heading: float, tstamp: float,
+               speed: int, gdop: float, pdop: float) -> bytes:
+        current = (scale_lat_long(lat),
+                   scale_lat_long(long),
+                   scale_heading(heading),
+                   scale_tstamp(tstamp),
+                   scale_speed(speed),
+                   scale_dop(gdop),
+                   scale_dop(pdop))
+        seq = self.seq
+        self.seq = (seq + 1) & 0xFF
+
+        frame = None
+        if not self.keyframe_requested and self.frames_since_keyframe < self.keyframe_interval:
+            frame = self._encode_delta(seq, current)
+        if frame is None:
+            frame = KEYFRAME_FORMAT.pack(FRAME_KEYFRAME, seq, *current)
+            self.keyframe_requested = False
+            self.frames_since_keyframe = 0
+        self.frames_since_keyframe += 1
+        self.previous = current
+        return frame
+
+    def _encode_delta(self, seq: int, current: tuple):
+        previous = self.previous
+        d_lat = current[0] - previous[0]
+        d_long = current[1] - previous[1]
+        d_heading = (current[2] - previous[2] + _HEADING_WRAP // 2) % _HEADING_WRAP - _HEADING_WRAP // 2
+        d_tstamp = (current[3] - previous[3]) & _TSTAMP_MASK
+        if not (_INT16_MIN <= d_lat <= _INT16_MAX and _INT16_MIN <= d_long <= _INT16_MAX) \
+                or d_tstamp > _UINT16_MAX:
+            # moved too far, or too long since the last frame, fall back to a keyframe
+            return None
+        return DELTA_FORMAT.pack(FRAME_DELTA, seq, d_lat, d_long, d_heading, d_tstamp, *current[4:])
+
+
+class GpsDeltaDecoder:
+    """
+    Client side of the delta stream, mostly for testing and tooling. decode()
+    returns None while waiting for a keyframe after a gap, in which case the client
+    should write CMD_KEYFRAME.
+    """
+
+    def __init__(self):
+        self.previous = None
+        self.expected_seq = None
+        self.gaps = 0
+
+    @property
+    def needs_keyframe(self) -> bool:
+        return self.previous is None
+
+    def decode(self, data: bytes):
+        if len(data) == KEYFRAME_SIZE and data[0] == FRAME_KEYFRAME:
+            values = KEYFRAME_FORMAT.unpack(data)
+            self.expected_seq = (values[1] + 1) & 0xFF
+            self.previous = values[2:]
+            return _unscale(*self.previous)
+        if len(data) == DELTA_SIZE and data[0] == FRAME_DELTA:
+            _, seq, d_lat, d_long, d_heading, d_tstamp, speed, gdop, pdop = DELTA_FORMAT.unpack(data)
+            if self.previous is None or seq != self.expected_seq:
+                if self.previous is not None:
+                    self.gaps += 1
+                self.previous = None
+                return None
+            previous = self.previous
+            self.expected_seq = (seq + 1) & 0xFF
+            self.previous = (previous[0] + d_lat,
+                             previous[1] + d_long,
+                             (previous[2] + d_heading) % _HEADING_WRAP,
+                             (previous[3] + d_tstamp) & _TSTAMP_MASK,
+                             speed, gdop, pdop)
+            return _unscale(*self.previous)
+        raise GpsCodecException(f"not a delta stream gps frame : {bytes(data).hex()}")
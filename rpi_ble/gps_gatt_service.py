@@ -1,43 +1,76 @@
-from json import JSONEncoder
 from tokenize import String
 import logging
 import threading
-import time
 
 from gi.repository import GLib
 
-import dbus
 from math import isnan
 
-from rpi_ble.constants import GPS_SERVICE_UUID, GPS_DATA_CHRC_UUID, GPS_DATA_DESCRIPTOR_UUID
+from rpi_ble import gps_codec
+from rpi_ble.constants import GPS_SERVICE_UUID, GPS_DATA_CHRC_UUID, GPS_DATA_DESCRIPTOR_UUID, GPS_BINARY_CHRC_UUID, \
+    GPS_BINARY_DESCRIPTOR_UUID, GPS_JSON_MAX_NOTIFY_RATE, GPS_BINARY_MAX_NOTIFY_RATE
+from rpi_ble.event_defs import GpsFix, GpsFixEvent
 from rpi_ble.gps_reader import GpsReader
+from rpi_ble.gpsd_socket_reader import GpsdSocketReader
 from rpi_ble.interfaces import GpsReceiver
-from rpi_ble.service import GattService, GattCharacteristic, GATT_CHRC_IFACE, Descriptor, NotifyDescriptor
+from rpi_ble.latest_value import LatestValue
+from rpi_ble.metrics import Telemetry
+from rpi_ble.service import GattService, GattCharacteristic, Descriptor, NotifyDescriptor, \
+    InvalidValueLengthException, NotSupportedException, encode_value
 
 logger = logging.getLogger(__name__)
 
+# where fixes come from : a thread blocking on the gps client library, or the gpsd
+# socket read directly on the GLib main loop
+GPS_SOURCE_THREAD = 'thread'
+GPS_SOURCE_SOCKET = 'socket'
+GPS_SOURCES = (GPS_SOURCE_THREAD, GPS_SOURCE_SOCKET)
+
 class GpsGattService(GattService, GpsReceiver):
     """
     Send gps data on a frequent basis
     """
 
-    def __init__(self, bus, index, test_mode=False):
+    def __init__(self, bus, index, test_mode=False, gps_source=GPS_SOURCE_THREAD):
         GattService.__init__(self, bus, index, GPS_SERVICE_UUID, True)
         self.gps_characteristic = GpsChrc(bus, 0, self)
+        self.gps_binary_characteristic = GpsBinaryChrc(bus, 1, self)
         self.add_characteristic(self.gps_characteristic)
+        self.add_characteristic(self.gps_binary_characteristic)
         self.gps_thread = None
+        self.gps_socket_reader = None
         self.gps_connected = False
         self.test_mode = test_mode
+        self.gps_source = gps_source
 
     def set_gps_position(self, lat: float, long: float, heading: float, tstamp: float,
                          speed: int, gdop: float, pdop: float) -> None:
         self.gps_characteristic.set_gps_position(lat, long, heading, tstamp, speed, gdop, pdop)
+        self.gps_binary_characteristic.set_gps_position(lat, long, heading, tstamp, speed, gdop, pdop)
+        # for anything else interested, the recorder. Only built if someone is, so
+        # a fix costs no allocation otherwise
+        if GpsFixEvent.subscriptions:
+            GpsFixEvent.emit(GpsFix(lat, long, heading, tstamp, speed, gdop, pdop))
 
     def set_gps_connected(self):
         self.gps_connected = True
+        # plugged in after a client subscribed
+        if any(chrc.notifying for chrc in self.characteristics):
+            self.start_gps_thread()
+
+    def set_gps_disconnected(self):
+        # unplugged : a reader already running keeps trying to reconnect
+        self.gps_connected = False
 
     def start_gps_thread(self) -> None:
-        if self.gps_connected and not self.gps_thread:
+        if not self.gps_connected:
+            return
+        if self.gps_source == GPS_SOURCE_SOCKET and not self.test_mode:
+            # no thread : the socket is watched by the main loop we're running on
+            if not self.gps_socket_reader:
+                self.gps_socket_reader = GpsdSocketReader(self)
+                self.gps_socket_reader.start()
+        elif not self.gps_thread:
             self.gps_thread = GLib.Thread.new("gps-thread", run_gps_thread, self)
 
     def stop_gps_thread(self) -> None:
@@ -53,52 +86,30 @@ class GpsChrc(GattCharacteristic, GpsReceiver):
             index,
             GPS_DATA_CHRC_UUID,
             ['notify', 'read'],
-            service)
+            service,
+            max_notify_rate=GPS_JSON_MAX_NOTIFY_RATE)
         self.add_descriptor(GpsDescriptor(bus, 0, self))
         self.add_descriptor(NotifyDescriptor(bus, 1, self))
         self.notifying = False
-        # self.lock = threading.Lock()
-        self.gps_pos = GpsPos(0, 0, 0, 0, 0, 0, 0)
+        # written by the gps reader thread, read on the main loop
+        self.gps_cell = LatestValue(GpsPos(0, 0, 0, 0, 0, 0, 0))
         self.service = service
-        self.update_pending = False
         # Telemetry for monitoring BLE send rates
-        self.ble_notifications_sent = 0
-        self.ble_updates_dropped = 0
-        self.last_telemetry_time = time.time()
+        self.telemetry = Telemetry([f"ble.GpsChrc.{stat}" for stat in ('emitted', 'dropped', 'suppressed')])
 
     def set_gps_position(self, lat: float, long: float, heading: float, tstamp: float, speed: int, gdop: float, pdop: float):
-        self.gps_pos = GpsPos(lat, long, heading, tstamp, speed, gdop, pdop)
-        # Only schedule if no update is already pending
-        if not self.update_pending:
-            self.update_pending = True
-            logger.debug("Queueing GPS property change notification to GLib main loop")
-            GLib.idle_add(self._notify_property_changed, self.ReadValue(None))
-        else:
-            # Track dropped updates for telemetry
-            self.ble_updates_dropped += 1
+        self.gps_cell.update(GpsPos.update, lat, long, heading, tstamp, speed, gdop, pdop)
+        self.notify_value_changed()
+        self.log_telemetry()
         return self.notifying
 
-    def _notify_property_changed(self, value):
-        self.update_pending = False
-        self.PropertiesChanged(GATT_CHRC_IFACE, {'Value': value}, [])
-
-        # Track BLE notifications sent for telemetry
-        self.ble_notifications_sent += 1
-
+    def log_telemetry(self):
         # Log telemetry every 60 seconds
-        current_time = time.time()
-        if current_time - self.last_telemetry_time >= 60.0:
-            elapsed = current_time - self.last_telemetry_time
-            ble_send_rate = self.ble_notifications_sent / elapsed
-            drop_rate = self.ble_updates_dropped / elapsed
-            logger.info(f"BLE Telemetry: sent {ble_send_rate:.1f} notifications/sec, "
-                       f"dropped {drop_rate:.1f} updates/sec")
-            # Reset counters
-            self.ble_notifications_sent = 0
-            self.ble_updates_dropped = 0
-            self.last_telemetry_time = current_time
-
-        return False  # Don't repeat this idle callback
+        rates = self.telemetry.rates()
+        if rates:
+            logger.info(f"BLE Telemetry: sent {rates['ble.GpsChrc.emitted']:.1f} notifications/sec, "
+                       f"dropped {rates['ble.GpsChrc.dropped']:.1f} updates/sec, "
+                       f"suppressed {rates['ble.GpsChrc.suppressed']:.1f} updates/sec with no subscriber")
 
     def StartNotify(self):
         logger.info("StartNotify called")
@@ -118,17 +129,114 @@ class GpsChrc(GattCharacteristic, GpsReceiver):
 
         self.notifying = False
 
-    def ReadValue(self, options):
-        value = []
-        gps_str = self.gps_pos.toJSON()
-        for c in gps_str:
-            value.append(dbus.Byte(c.encode()))
-        return value
+    @property
+    def gps_pos(self):
+        # the live record, updated in place by the next fix
+        return self.gps_cell.get()
+
+    def get_value_bytes(self) -> bytes:
+        return self.gps_cell.read(GpsPos.toJSON)[1].encode()
+
+class GpsBinaryChrc(GattCharacteristic, GpsReceiver):
+    """
+    The same fix as GpsChrc, packed into a fixed layout (see gps_codec) that
+    fits in a single notification at the default ATT MTU.
+
+    In delta mode notifications alternate between periodic keyframes and small
+    deltas. Clients switch modes, or ask for a keyframe after spotting a gap in the
+    sequence numbers, by writing one of the gps_codec.CMD_* bytes.
+    """
+
+    def __init__(self, bus, index, service: GpsGattService, delta_mode=False,
+                 keyframe_interval=gps_codec.DEFAULT_KEYFRAME_INTERVAL):
+        GattCharacteristic.__init__(
+            self,
+            bus,
+            index,
+            GPS_BINARY_CHRC_UUID,
+            ['notify', 'read', 'write'],
+            service,
+            max_notify_rate=GPS_BINARY_MAX_NOTIFY_RATE)
+        self.add_descriptor(GpsBinaryDescriptor(bus, 0, self))
+        self.add_descriptor(NotifyDescriptor(bus, 1, self))
+        self.notifying = False
+        # written by the gps reader thread, read on the main loop
+        self.gps_cell = LatestValue(GpsPos(0, 0, 0, 0, 0, 0, 0))
+        self.delta_mode = delta_mode
+        self.delta_encoder = gps_codec.GpsDeltaEncoder(keyframe_interval)
+        self.service = service
+
+    def set_gps_position(self, lat: float, long: float, heading: float, tstamp: float, speed: int, gdop: float, pdop: float):
+        self.gps_cell.update(GpsPos.update, lat, long, heading, tstamp, speed, gdop, pdop)
+        self.notify_value_changed()
+        return self.notifying
+
+    def get_notify_value(self):
+        # encoded as the notification goes out, so the delta encoder only ever sees
+        # fixes that are actually sent
+        if self.delta_mode:
+            return encode_value(self.delta_encoder.encode(*self.gps_cell.read(GpsPos.fields)[1]))
+        return self.get_value()
+
+    def StartNotify(self):
+        logger.info("StartNotify called (binary)")
+        if self.notifying:
+            logger.info('Already notifying, nothing to do')
+            return
+        else:
+            self.service.start_gps_thread()
+
+        self.notifying = True
+
+    def on_subscribe(self):
+        # a (re)subscribing client has no delta base
+        self.delta_encoder.request_keyframe()
+
+    def StopNotify(self):
+        logger.info("StopNotify called (binary)")
+        if not self.notifying:
+            logger.info('Not notifying, nothing to do')
+            return
+
+        self.notifying = False
+
+    def get_value_bytes(self) -> bytes:
+        # reads always get an absolute frame, they are not part of the delta stream
+        return gps_codec.encode(*self.gps_cell.read(GpsPos.fields)[1])
+
+    def WriteValue(self, value, options):
+        if len(value) != 1:
+            raise InvalidValueLengthException()
+        command = int(value[0])
+        if command == gps_codec.CMD_ABSOLUTE_MODE:
+            logger.info("GPS binary characteristic switched to absolute mode")
+            self.delta_mode = False
+        elif command == gps_codec.CMD_DELTA_MODE:
+            logger.info("GPS binary characteristic switched to delta mode")
+            self.delta_mode = True
+            self.delta_encoder.request_keyframe()
+        elif command == gps_codec.CMD_KEYFRAME:
+            logger.debug("GPS keyframe requested")
+            self.delta_encoder.request_keyframe()
+        else:
+            raise NotSupportedException()
 
 class GpsPos:
+    """
+    A gps fix. One record per characteristic is updated in place for each fix
+    rather than allocating a new one.
+    """
+
+    __slots__ = ('lat', 'long', 'heading', 'tstamp', 'speed', 'gdop', 'pdop')
+
+    JSON_FORMAT = '{{"lat": {}, "long": {}, "hdg": {}, "tstamp": {}, "spd": {}, "gdop": {}, "pdop": {}}}'
 
     def __init__(self, lat: float, long: float, heading: float, tstamp: float,
                  speed: int, gdop: float, pdop: float ):
+        self.update(lat, long, heading, tstamp, speed, gdop, pdop)
+
+    def update(self, lat: float, long: float, heading: float, tstamp: float,
+               speed: int, gdop: float, pdop: float):
         self.lat = lat
         self.long = long
         self.heading = heading
@@ -137,22 +245,25 @@ class GpsPos:
         self.gdop = gdop
         self.pdop = pdop
 
+    def fields(self) -> tuple:
+        return self.lat, self.long, self.heading, self.tstamp, self.speed, self.gdop, self.pdop
+
     def __eq__(self, other):
+        # equal when they'd serialize the same : millisecond timestamps and nan dops as 0.0
         if isinstance(other, GpsPos):
-            return self.toJSON() == other.toJSON()
+            return (self.lat == other.lat and self.long == other.long and self.heading == other.heading
+                    and int(self.tstamp * 1000) == int(other.tstamp * 1000) and self.speed == other.speed
+                    and _dop(self.gdop) == _dop(other.gdop) and _dop(self.pdop) == _dop(other.pdop))
         return False
 
     def toJSON(self) -> String:
-        fields = {
-            'lat': self.lat,
-            'long': self.long,
-            'hdg': self.heading,
-            'tstamp': int(self.tstamp * 1000),
-            'spd': self.speed,
-            'gdop': 0.0 if isnan(self.gdop) else self.gdop,
-            'pdop': 0.0 if isnan(self.pdop) else self.pdop,
-        }
-        return JSONEncoder().encode(fields)
+        # formatted directly, floats come out the same as they would from JSONEncoder
+        return self.JSON_FORMAT.format(self.lat, self.long, self.heading, int(self.tstamp * 1000),
+                                       self.speed, _dop(self.gdop), _dop(self.pdop))
+
+
+def _dop(dop: float) -> float:
+    return 0.0 if isnan(dop) else dop
 
 class GpsDescriptor(Descriptor):
     GPS_DESCRIPTOR_VALUE = "GPS Position"
@@ -166,14 +277,23 @@ class GpsDescriptor(Descriptor):
             ["read"],
             characteristic)
 
-    def ReadValue(self, options):
-        value = []
-        desc = self.GPS_DESCRIPTOR_VALUE
+    def get_value_bytes(self) -> bytes:
+        return self.GPS_DESCRIPTOR_VALUE.encode()
+
+class GpsBinaryDescriptor(Descriptor):
+    GPS_BINARY_DESCRIPTOR_VALUE = "GPS Position (binary)"
 
-        for c in desc:
-            value.append(dbus.Byte(c.encode()))
+    def __init__(self, bus, index, characteristic):
+        Descriptor.__init__(
+            self,
+            bus,
+            index,
+            GPS_BINARY_DESCRIPTOR_UUID,
+            ["read"],
+            characteristic)
 
-        return value
+    def get_value_bytes(self) -> bytes:
+        return self.GPS_BINARY_DESCRIPTOR_VALUE.encode()
 
 def run_gps_thread(service: GpsGattService):
     if service.test_mode:
@@ -2,7 +2,6 @@ from typing import Optional
 
 from gps import *
 
-from dateutil import parser
 from threading import Thread
 
 #todo : think about doing moving and not moving ... can save some battery on BLE maybe
@@ -12,7 +11,9 @@ import os
 import subprocess
 
 from rpi_ble.event_defs import ExitApplicationEvent, GPSConnectedEvent, GPSDisconnectedEvent
+from rpi_ble.gps_time import gps_time_ms, MIN_VALID_TIME_MS
 from rpi_ble.interfaces import GpsReceiver
+from rpi_ble.metrics import Telemetry, registry, TIME_BUCKETS_MS
 from rpi_ble.usb_detector import UsbDetector, UsbDevice
 
 logger = logging.getLogger(__name__)
@@ -20,8 +21,10 @@ logger = logging.getLogger(__name__)
 
 class GpsReader(Thread):
 
-    def __init__(self, receiver: GpsReceiver, log_to_file=False):
+    def __init__(self, receiver: GpsReceiver, log_to_file=False, host="127.0.0.1", port=GPSD_PORT):
         Thread.__init__(self, daemon=True)
+        self.host = host
+        self.port = port
         self.speed_mph = 999
         self.heading = 0
         self.working = False
@@ -32,8 +35,9 @@ class GpsReader(Thread):
         self.time_synced = False
         self.receiver = receiver
         # Telemetry for monitoring GPS data rates
-        self.gps_updates_received = 0
-        self.last_telemetry_time = time.time()
+        self.updates = registry.counter('gps.updates')
+        self.handling_time = registry.histogram('gps.handling_ms', TIME_BUCKETS_MS)
+        self.telemetry = Telemetry(['gps.updates'])
         ExitApplicationEvent.register_handler(self)
 
     def handle_event(self, event, **kwargs):
@@ -46,7 +50,7 @@ class GpsReader(Thread):
             try:
                 logger.info("connecting to GPS...")
                 self.call_gpsctl()
-                session = gps()
+                session = gps(host=self.host, port=self.port)
                 self.init_gps_connection(session)
 
                 while not self.finished:
@@ -61,11 +65,11 @@ class GpsReader(Thread):
                                                 session.fix.longitude,
                                                 session.gdop,
                                                 session.pdop))
-                            gps_datetime = parser.isoparse(session.fix.time).astimezone()
-                            if gps_datetime.year < 2021:
+                            gps_tstamp_ms = gps_time_ms(session.fix.time)
+                            if gps_tstamp_ms < MIN_VALID_TIME_MS:
                                 logger.debug("time wonky, ignoring")
                                 continue
-                            gps_tstamp = gps_datetime.timestamp()
+                            gps_tstamp = gps_tstamp_ms / 1000
                         else:
                             # we can't trust the onboard time anymore as we don't expect to have wifi
                             continue
@@ -99,17 +103,12 @@ class GpsReader(Thread):
                                 self.long = session.fix.longitude
 
                                 # Count GPS updates received for telemetry
-                                self.gps_updates_received += 1
+                                self.updates.inc()
 
                                 # Log telemetry every 60 seconds
-                                current_time = time.time()
-                                if current_time - self.last_telemetry_time >= 60.0:
-                                    elapsed = current_time - self.last_telemetry_time
-                                    gps_rate = self.gps_updates_received / elapsed
-                                    logger.info(f"GPS Telemetry: received {gps_rate:.1f} updates/sec")
-                                    # Reset counters
-                                    self.gps_updates_received = 0
-                                    self.last_telemetry_time = current_time
+                                rates = self.telemetry.rates()
+                                if rates:
+                                    logger.info(f"GPS Telemetry: received {rates['gps.updates']:.1f} updates/sec")
 
                                 # generally we should try to move away from position listeners, and instead
                                 # have them pull from this class when they need it
@@ -124,6 +123,7 @@ class GpsReader(Thread):
                                         logger.exception("issue with GPS listener.")
                                     finally:
                                         elapsed_ms = int((time.time() - start_time) * 1000)
+                                        self.handling_time.observe(elapsed_ms)
                                         if elapsed_ms > 50:
                                             logger.warning(f"position handling took {elapsed_ms} ms")
                                 if not self.working:
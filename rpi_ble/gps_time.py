@@ -0,0 +1,41 @@
+import re
+from datetime import datetime, timezone
+
+from dateutil import parser
+
+# gpsd reports time as YYYY-MM-DDTHH:MM:SS.sssZ
+GPSD_TIME = re.compile(r'(\d{4}-\d\d-\d\dT\d\d:\d\d):([0-5]\d|60)\.(\d{3})Z')
+
+# anything earlier and the receiver hasn't got the time yet
+MIN_VALID_TIME_MS = 1609459200000  # 2021-01-01T00:00:00Z
+
+# (YYYY-MM-DDTHH:MM, epoch ms at the start of that minute), replaced as a whole
+# so the reader threads can share it
+_minute_cache = ('', 0)
+
+
+def gps_time_ms(value: str) -> int:
+    """
+    Convert a gpsd timestamp into epoch milliseconds.
+
+    At 10-25 fixes a second nearly every timestamp falls in the same minute as the
+    last one, so the date and time down to the minute is converted once and only
+    the seconds are parsed per fix. Anything not in gpsd's usual format goes
+    through dateutil. Raises ValueError if the timestamp can't be parsed.
+    """
+    global _minute_cache
+    match = GPSD_TIME.fullmatch(value)
+    if match is None:
+        return _parse_ms(value)
+    minute, minute_ms = _minute_cache
+    if match[1] != minute:
+        minute = match[1]
+        minute_ms = int(datetime.fromisoformat(minute).replace(tzinfo=timezone.utc).timestamp()) * 1000
+        _minute_cache = (minute, minute_ms)
+    # seconds and milliseconds together are the milliseconds into the minute
+    return minute_ms + int(match[2] + match[3])
+
+
+def _parse_ms(value: str) -> int:
+    # naive times are taken as local, as isoparse(...).astimezone() did
+    return round(parser.isoparse(value).timestamp() * 1000)
@@ -0,0 +1,228 @@
+import errno
+import json
+import logging
+import math
+import os
+import socket
+import time
+
+from gi.repository import GLib
+
+from rpi_ble.event_defs import ExitApplicationEvent, GPSConnectedEvent, GPSDisconnectedEvent
+from rpi_ble.gps_time import gps_time_ms, MIN_VALID_TIME_MS
+from rpi_ble.interfaces import GpsReceiver
+from rpi_ble.metrics import Telemetry, registry, TIME_BUCKETS_MS
+
+logger = logging.getLogger(__name__)
+
+GPSD_HOST = '127.0.0.1'
+GPSD_PORT = 2947
+
+WATCH_COMMAND = b'?WATCH={"enable":true,"json":true};\n'
+
+
+class GpsdSocketReader:
+    """
+    Alternative to GpsReader that reads gpsd's JSON stream straight off the socket
+    on the GLib main loop, via GLib.io_add_watch, instead of blocking in
+    session.next() on its own thread and hopping back with GLib.idle_add.
+
+    Only TPV reports are decoded into fixes. SKY reports are used for gdop/pdop,
+    which gpsd doesn't include in TPV.
+
+    Connecting doesn't block the main loop either : the connect is non-blocking
+    and finishes in an io watch, or gives up after CONNECT_TIMEOUT_MS.
+    """
+
+    RECONNECT_DELAY_MS = 10000
+    CONNECT_TIMEOUT_MS = 2000
+    # warn when the receiver takes longer than this over a fix
+    SLOW_HANDLING_MS = 50
+
+    def __init__(self, receiver: GpsReceiver, host=GPSD_HOST, port=GPSD_PORT):
+        self.receiver = receiver
+        self.host = host
+        self.port = port
+        self.sock = None
+        self.watch_id = None
+        self.connect_timeout_id = None
+        self.buffer = b''
+        self.speed_mph = 999
+        self.heading = 0
+        self.gdop = math.nan
+        self.pdop = math.nan
+        self.working = False
+        self.finished = False
+        # Telemetry for monitoring GPS data rates
+        self.updates = registry.counter('gps.updates')
+        # the same as GpsReader's, whichever source is in use
+        self.handling_time = registry.histogram('gps.handling_ms', TIME_BUCKETS_MS)
+        self.telemetry = Telemetry(['gps.updates'])
+        ExitApplicationEvent.register_handler(self)
+
+    def handle_event(self, event, **kwargs):
+        if event == ExitApplicationEvent:
+            self.finished = True
+            self.close()
+
+    def start(self) -> bool:
+        # must be called on the main loop, returns False so it can be used as a
+        # GLib timeout callback when reconnecting
+        if self.finished:
+            return False
+        try:
+            logger.info("connecting to gpsd socket...")
+            self.connect()
+        except OSError:
+            logger.exception("issue with gpsd socket, reconnecting.")
+            self.reconnect()
+        return False
+
+    def connect(self):
+        # host is an address, so there's no blocking name lookup
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        self.sock = sock
+        result = sock.connect_ex((self.host, self.port))
+        if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise OSError(result, os.strerror(result))
+        self.watch_id = GLib.io_add_watch(sock.fileno(), GLib.PRIORITY_DEFAULT,
+                                          GLib.IO_OUT | GLib.IO_HUP | GLib.IO_ERR,
+                                          self._on_connected)
+        self.connect_timeout_id = GLib.timeout_add(self.CONNECT_TIMEOUT_MS, self._on_connect_timeout)
+
+    def _on_connected(self, fd, condition) -> bool:
+        # returning False removes this watch, the one for reading replaces it
+        self.watch_id = None
+        self.cancel_connect_timeout()
+        try:
+            result = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if result:
+                raise OSError(result, os.strerror(result))
+            # a few bytes to an empty socket buffer, this doesn't block
+            self.sock.send(WATCH_COMMAND)
+        except OSError as e:
+            logger.warning(f"unable to connect to gpsd : {e}, reconnecting.")
+            self.reconnect()
+            return False
+        self.buffer = b''
+        self.watch_id = GLib.io_add_watch(fd, GLib.PRIORITY_DEFAULT,
+                                          GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+                                          self._on_readable)
+        return False
+
+    def _on_connect_timeout(self) -> bool:
+        self.connect_timeout_id = None
+        logger.warning("no answer connecting to gpsd, reconnecting.")
+        self.reconnect()
+        return False
+
+    def cancel_connect_timeout(self):
+        if self.connect_timeout_id is not None:
+            GLib.source_remove(self.connect_timeout_id)
+            self.connect_timeout_id = None
+
+    def reconnect(self):
+        self.close()
+        if not self.finished:
+            GLib.timeout_add(self.RECONNECT_DELAY_MS, self.start)
+
+    def close(self):
+        self.cancel_connect_timeout()
+        if self.watch_id is not None:
+            GLib.source_remove(self.watch_id)
+            self.watch_id = None
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                logger.debug("Error closing gpsd socket")
+            self.sock = None
+
+    def _on_readable(self, fd, condition) -> bool:
+        try:
+            data = self.sock.recv(65536)
+        except BlockingIOError:
+            return True
+        except OSError:
+            data = b''
+        if not data:
+            logger.warning("gpsd socket closed, reconnecting.")
+            # returning False removes the watch
+            self.watch_id = None
+            if self.working:
+                self.working = False
+                GPSDisconnectedEvent.emit()
+            self.reconnect()
+            return False
+        self.handle_data(data)
+        return True
+
+    def handle_data(self, data: bytes):
+        lines = (self.buffer + data).split(b'\n')
+        # the last element is a partial line (or empty)
+        self.buffer = lines.pop()
+        for line in lines:
+            try:
+                self.handle_line(line)
+            except Exception:
+                logger.exception("issue with GPS listener.")
+
+    def handle_line(self, line: bytes):
+        # cheap checks first, most reports are neither
+        if b'"class":"TPV"' in line:
+            self.handle_tpv(json.loads(line))
+        elif b'"class":"SKY"' in line:
+            sky = json.loads(line)
+            self.gdop = sky.get('gdop', self.gdop)
+            self.pdop = sky.get('pdop', self.pdop)
+        elif b'"class":"DEVICES"' in line:
+            devices = json.loads(line).get('devices')
+            if not devices or any(d.get('native') == 1 for d in devices):
+                logger.warning(f"no gps device or it's in the wrong mode : {devices}")
+
+    def handle_tpv(self, tpv: dict):
+        time_str = tpv.get('time')
+        if not time_str:
+            # we can't trust the onboard time anymore as we don't expect to have wifi
+            return
+        if tpv.get('mode', 0) < 2:
+            logger.warning("no fix...awaiting")
+            return
+        gps_tstamp_ms = gps_time_ms(time_str)
+        if gps_tstamp_ms < MIN_VALID_TIME_MS:
+            logger.debug("time wonky, ignoring")
+            return
+        lat = tpv.get('lat')
+        long = tpv.get('lon')
+        if lat is None or long is None:
+            return
+        speed = tpv.get('speed')
+        if speed is not None:
+            # m/s
+            self.speed_mph = int(speed * 2.237)
+        track = tpv.get('track')
+        if track is not None:
+            self.heading = int(track)
+
+        self.updates.inc()
+        rates = self.telemetry.rates()
+        if rates:
+            logger.info(f"GPS Telemetry: received {rates['gps.updates']:.1f} updates/sec")
+
+        if self.receiver:
+            start = time.perf_counter()
+            try:
+                self.receiver.set_gps_position(lat, long, self.heading, gps_tstamp_ms / 1000,
+                                               self.speed_mph, self.gdop, self.pdop)
+            finally:
+                elapsed_ms = int((time.perf_counter() - start) * 1000)
+                self.handling_time.observe(elapsed_ms)
+                if elapsed_ms > self.SLOW_HANDLING_MS:
+                    logger.warning(f"position handling took {elapsed_ms} ms")
+        if not self.working:
+            self.working = True
+            GPSConnectedEvent.emit()
+
+    def is_working(self) -> bool:
+        return self.working
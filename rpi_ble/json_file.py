@@ -0,0 +1,17 @@
+import json
+import os
+
+
+def save_json(path: str, data, indent: int = None):
+    """
+    Write data to path as json, to a temporary file that's synced to disk and
+    then renamed over path. So losing power mid write leaves either the old file
+    or the new one, never half of one. Raises OSError.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
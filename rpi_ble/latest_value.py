@@ -0,0 +1,60 @@
+import threading
+import time
+
+
+class LatestValue:
+    """
+    Seqlock-style cell for handing the latest reading from a reader thread over to
+    the GLib main loop.
+
+    Writers are serialised with a lock and bump the sequence number before and
+    after each write, so it is odd while a write is in progress. Readers never
+    block : they retry when a write overlapped their read, so they always see a
+    complete value even when the writer updates it in place.
+    """
+
+    def __init__(self, value=None):
+        self._seq = 0
+        self._value = value
+        self._write_lock = threading.Lock()
+
+    @property
+    def version(self) -> int:
+        # changes on every write
+        return self._seq
+
+    def publish(self, value):
+        with self._write_lock:
+            self._seq += 1
+            self._value = value
+            self._seq += 1
+
+    def update(self, fn, *args):
+        """
+        Update the current value in place with fn(value, *args)
+        """
+        with self._write_lock:
+            self._seq += 1
+            try:
+                fn(self._value, *args)
+            finally:
+                self._seq += 1
+
+    def read(self, fn=None):
+        """
+        Returns (version, value), or (version, fn(value)) where fn copies or encodes
+        the value, taken from a consistent snapshot
+        """
+        while True:
+            seq = self._seq
+            if seq & 1:
+                # a write is in progress, let the writer finish
+                time.sleep(0)
+                continue
+            value = self._value
+            result = fn(value) if fn else value
+            if self._seq == seq:
+                return seq, result
+
+    def get(self):
+        return self.read()[1]
@@ -0,0 +1,139 @@
+import logging
+import os
+import threading
+from collections import deque
+from logging.handlers import RotatingFileHandler
+
+
+class BatchingFileHandler(RotatingFileHandler):
+    """
+    A rotating log file written by a background thread. Logging a record only
+    queues it; every flush_interval, or sooner once max_batch records are
+    waiting, the writer appends what's queued then flushes and fsyncs. So a
+    sudden power cut loses about flush_interval of logs at most, without every
+    record costing the logging thread a write and a sync.
+
+    If the writer can't keep up and max_queued records are waiting, new ones
+    are dropped and counted, and the count is written to the log.
+
+    flush() and close() write out whatever is queued themselves, so the records
+    logged just before logging.shutdown() at exit make it to the file.
+    """
+
+    FLUSH_INTERVAL = 0.25
+    MAX_BATCH = 256
+    MAX_QUEUED = 10000
+
+    def __init__(self, filename: str, maxBytes: int = 0, backupCount: int = 0,
+                 flush_interval: float = FLUSH_INTERVAL, max_batch: int = MAX_BATCH,
+                 max_queued: int = MAX_QUEUED):
+        super().__init__(filename, maxBytes=maxBytes, backupCount=backupCount)
+        # tracked here : RotatingFileHandler seeks to the end to check, which flushes
+        self.size = os.path.getsize(filename)
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.max_queued = max_queued
+        # (record, message, exception text), appends and pops are thread safe
+        self.records = deque()
+        # held while writing, by the writer thread or a flush or close
+        self.write_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.queued = 0
+        self.written = 0
+        self.syncs = 0
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.writer = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self.writer.start()
+
+    def emit(self, record):
+        try:
+            if len(self.records) >= self.max_queued:
+                self.dropped += 1
+                return
+            # the message is made here as the args might change once we return
+            exc_text = self.format_exception(record) if record.exc_info else record.exc_text
+            self.records.append((record, record.getMessage(), exc_text))
+            self.queued += 1
+            if len(self.records) >= self.max_batch:
+                self.wakeup.set()
+        except Exception:
+            self.handleError(record)
+
+    def format_exception(self, record) -> str:
+        return (self.formatter or logging.Formatter()).formatException(record.exc_info)
+
+    def _run(self):
+        while not self.stopping:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.write_queued()
+        self.write_queued()
+
+    def write_queued(self) -> bool:
+        """
+        Write out and sync whatever is queued, returns whether there was anything
+        """
+        with self.write_lock:
+            if not self.records or self.stream is None:
+                return False
+            while self.records:
+                self.write(*self.records.popleft())
+            if self.dropped != self.reported_dropped:
+                dropped = self.dropped
+                self.write_text(f"dropped ({dropped - self.reported_dropped}) log records\n")
+                self.reported_dropped = dropped
+            self.sync()
+            return True
+
+    def write(self, record, message: str, exc_text: str):
+        try:
+            # formatted from a copy, other handlers may still be using the record
+            snapshot = logging.LogRecord.__new__(logging.LogRecord)
+            snapshot.__dict__.update(record.__dict__, msg=message, args=None, exc_info=None, exc_text=exc_text)
+            self.write_text(self.format(snapshot) + self.terminator)
+            self.written += 1
+        except Exception:
+            self.handleError(record)
+
+    def write_text(self, text: str):
+        length = len(text.encode())
+        if self.maxBytes and self.size and self.size + length > self.maxBytes:
+            self.sync()
+            self.doRollover()
+            self.size = 0
+        self.stream.write(text)
+        self.size += length
+
+    def sync(self):
+        stream = self.stream
+        if stream:
+            try:
+                stream.flush()
+                os.fsync(stream.fileno())
+                self.syncs += 1
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            'queued': self.queued,
+            'written': self.written,
+            'syncs': self.syncs,
+            'dropped': self.dropped,
+            'depth': len(self.records),
+        }
+
+    def flush(self):
+        if not self.write_queued():
+            super().flush()
+
+    def close(self):
+        # everything queued before this is written out
+        if self.writer.is_alive():
+            self.stopping = True
+            self.wakeup.set()
+            self.writer.join()
+        self.write_queued()
+        super().close()
@@ -4,30 +4,27 @@ import dbus.exceptions
 import dbus.mainloop.glib
 import dbus.service
 import logging
-from logging.handlers import RotatingFileHandler
 import time
 import argparse
 import os
 
-from rpi_ble.event_defs import ExitApplicationEvent
+from gi.repository import GLib
+
+from rpi_ble import events, metrics
+from rpi_ble.event_defs import ExitApplicationEvent, GPSConnectedEvent, OBDConnectedEvent, CoolantTempEvent, \
+    FuelLevelEvent, GpsFixEvent, GPSDisconnectedEvent, OBDDisconnectedEvent
+from rpi_ble.socketcan_reader import can_interface_present
 from rpi_ble.usb_detector import UsbDetector, UsbDevice
+from rpi_ble.usb_hotplug import UsbHotplugWatcher
+from rpi_ble.value_recorder import ValueRecorder, ValueMetrics
 
 from rpi_ble.gatt_application import GattApplication, LemonPiAdvertisement
+from rpi_ble.log_writer import BatchingFileHandler
 
 # Create logs directory if it doesn't exist
 os.makedirs('logs', exist_ok=True)
 
 
-class FlushingRotatingFileHandler(RotatingFileHandler):
-    """
-    RotatingFileHandler that flushes after every log message.
-    Critical for devices that may lose power suddenly (like car accessories).
-    """
-    def emit(self, record):
-        super().emit(record)
-        self.flush()
-
-
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
@@ -40,11 +37,11 @@ console_formatter = logging.Formatter('%(asctime)s %(name)s %(message)s',
 console_handler.setFormatter(console_formatter)
 
 # File handler - INFO level, 1MB max, 10 backup files
-# Uses FlushingRotatingFileHandler to ensure logs are written immediately
-# This is critical since the device may lose power suddenly
-file_handler = FlushingRotatingFileHandler('logs/rpi-ble.log',
-                                           maxBytes=1024*1024,  # 1MB
-                                           backupCount=10)
+# The device may lose power suddenly, so the background writer fsyncs at least
+# every flush_interval (250ms) : that's the most we can lose
+file_handler = BatchingFileHandler('logs/rpi-ble.log',
+                                   maxBytes=1024*1024,  # 1MB
+                                   backupCount=10)
 file_handler.setLevel(logging.INFO)
 file_formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s',
                                   datefmt='%Y-%m-%d %H:%M:%S')
@@ -63,7 +60,24 @@ def main():
     parser = argparse.ArgumentParser(description='Lemon-Pi BLE GATT Server')
     parser.add_argument('--test-mode', action='store_true',
                         help='Run with synthetic GPS and OBD data for testing')
+    parser.add_argument('--gps-source', choices=['thread', 'socket'], default='thread',
+                        help='Read gpsd on its own thread, or straight off the socket on the main loop')
+    parser.add_argument('--obd-driver', choices=['python-obd', 'elm327', 'socketcan'], default='python-obd',
+                        help='Talk to the OBD adapter through python-obd or the lean ELM327 driver, '
+                             'or to the car over a SocketCAN interface')
+    parser.add_argument('--can-interface', default='can0',
+                        help='SocketCAN interface for --obd-driver socketcan')
+    parser.add_argument('--can-signal-map',
+                        help='json file of broadcast CAN signals to decode with --obd-driver socketcan')
+    parser.add_argument('--slow-handler-ms', type=float, default=events.Event.slow_handler_threshold * 1000,
+                        help='Warn about event handlers that take longer than this')
+    parser.add_argument('--record-values',
+                        help='Append the GPS and OBD values to this file, as json lines')
+    parser.add_argument('--log-flush-ms', type=float, default=BatchingFileHandler.FLUSH_INTERVAL * 1000,
+                        help='Longest the log file goes without an fsync, what a power cut can lose')
     args = parser.parse_args()
+    events.Event.slow_handler_threshold = args.slow_handler_ms / 1000
+    file_handler.flush_interval = args.log_flush_ms / 1000
 
     if args.test_mode:
         logger.info("*** RUNNING IN TEST MODE WITH SYNTHETIC DATA ***")
@@ -74,9 +88,18 @@ def main():
 
     bus = dbus.SystemBus()
     logger.info("initializing application")
-    app = GattApplication(bus, test_mode=args.test_mode)
+    app = GattApplication(bus, test_mode=args.test_mode, gps_source=args.gps_source,
+                          obd_driver=args.obd_driver, can_interface=args.can_interface,
+                          can_signal_map=args.can_signal_map)
 
     mainloop = app.get_mainloop()
+    # not gps fixes, they'd be built for every fix just to fill a gauge
+    ValueMetrics([CoolantTempEvent, FuelLevelEvent])
+    if args.record_values:
+        ValueRecorder(args.record_values, [GpsFixEvent, CoolantTempEvent, FuelLevelEvent])
+    # handlers that touch dbus get their events on the main loop
+    events.dispatcher.use_main_loop(GLib.idle_add)
+    hotplug_watcher = None
 
     if args.test_mode:
         # In test mode, enable both services and start synthetic readers
@@ -91,9 +114,33 @@ def main():
         # enable devices based on USB
         if UsbDetector.detected(UsbDevice.GPS):
             app.get_gps_service().set_gps_connected()
-        if UsbDetector.detected(UsbDevice.OBD):
+        if args.obd_driver == 'socketcan':
+            if can_interface_present(args.can_interface):
+                app.get_obd_service().set_obd_connected()
+        elif UsbDetector.detected(UsbDevice.OBD):
             app.get_obd_service().set_obd_connected()
 
+        # and as they're plugged in later
+        def on_devices_detected(device_types):
+            if UsbDevice.GPS in device_types:
+                app.get_gps_service().set_gps_connected()
+                GPSConnectedEvent.emit()
+            if UsbDevice.OBD in device_types and args.obd_driver != 'socketcan':
+                app.get_obd_service().set_obd_connected()
+                OBDConnectedEvent.emit()
+
+        # and unplugged, without waiting for the readers to notice
+        def on_devices_removed(device_types):
+            if UsbDevice.GPS in device_types:
+                app.get_gps_service().set_gps_disconnected()
+                GPSDisconnectedEvent.emit()
+            if UsbDevice.OBD in device_types and args.obd_driver != 'socketcan':
+                app.get_obd_service().set_obd_disconnected()
+                OBDDisconnectedEvent.emit()
+
+        hotplug_watcher = UsbHotplugWatcher(on_devices_detected, on_removed=on_devices_removed)
+        hotplug_watcher.start()
+
     logger.info('Registering GATT application...')
 
     app.register_application(bus)
@@ -109,15 +156,21 @@ def main():
         mainloop.run()
     except KeyboardInterrupt:
         logger.info("Shutting down due to CTRL-C")
+    # the main loop has stopped, deliver whatever is left directly
+    events.dispatcher.use_main_loop(None)
 
     # Clean up BlueZ and D-Bus resources
     logger.info("Cleaning up BlueZ and D-Bus resources")
+    if hotplug_watcher:
+        hotplug_watcher.stop()
     app.cleanup()
 
     # tell everything we're shutting down
     logger.info("sending shutdown notification")
     ExitApplicationEvent.emit()
     time.sleep(1)
+    logger.info(f"log writer stats: {file_handler.stats()}")
+    logger.info(f"metrics: {metrics.registry.snapshot()}")
     logger.info("Shutdown Complete. Good Bye!")
 
 if __name__ == '__main__':
@@ -0,0 +1,174 @@
+import threading
+import time
+from bisect import bisect_left
+
+# histogram buckets for how long something took, in ms
+TIME_BUCKETS_MS = (1, 5, 10, 50, 100, 500)
+
+
+class Counter:
+    """
+    A count that only goes up. Increments aren't locked, so each counter
+    should have a single writing thread; readers on other threads may see it
+    one increment behind.
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n: int = 1):
+        self.value += n
+
+    def snapshot(self) -> int:
+        return self.value
+
+
+class Gauge:
+    """
+    The latest value of something
+    """
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+
+class Histogram:
+    """
+    Counts of values falling in fixed buckets. buckets are the inclusive upper
+    bounds, in ascending order, and there's a final bucket for anything larger.
+    """
+
+    __slots__ = ('buckets', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, buckets: tuple):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def labels(self) -> list:
+        return [f"<={b}" for b in self.buckets] + [f">{self.buckets[-1]}"]
+
+    def snapshot(self) -> tuple:
+        return tuple(self.counts)
+
+    def to_dict(self) -> dict:
+        return dict(zip(self.labels(), self.counts))
+
+
+class Observed:
+    """
+    A value something else already keeps, read when a snapshot is taken
+    """
+
+    __slots__ = ('fn',)
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def snapshot(self):
+        return self.fn()
+
+
+class MetricsRegistry:
+    """
+    Named counters, gauges and histograms. Components get or create their
+    metrics once, up front, and update them directly, so updating one costs
+    no more than bumping an attribute. Names are dotted, component first,
+    e.g. gps.updates.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, name: str, kind: type, *args):
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(name)
+                if metric is None:
+                    metric = self.metrics[name] = kind(*args)
+        if not isinstance(metric, kind):
+            raise TypeError(f"metric {name} is a {type(metric).__name__}, not a {kind.__name__}")
+        return metric
+
+    def counter(self, name: str) -> Counter:
+        return self._get(name, Counter)
+
+    def gauge(self, name: str) -> Gauge:
+        return self._get(name, Gauge)
+
+    def histogram(self, name: str, buckets: tuple) -> Histogram:
+        return self._get(name, Histogram, buckets)
+
+    def observe(self, name: str, fn):
+        """
+        Report fn() as name. Replaces whatever was observed as name before.
+        """
+        with self.lock:
+            self.metrics[name] = Observed(fn)
+
+    def value(self, name: str):
+        metric = self.metrics.get(name)
+        return metric.snapshot() if metric is not None else 0
+
+    def snapshot(self, prefix: str = '') -> dict:
+        """
+        {name: value} for every metric, or those starting with prefix. Histograms
+        are a tuple of their bucket counts.
+        """
+        return {name: metric.snapshot() for name, metric in list(self.metrics.items())
+                if name.startswith(prefix)}
+
+
+registry = MetricsRegistry()
+
+
+class Telemetry:
+    """
+    The per second rate of some counters, every interval, for the periodic
+    telemetry log lines. rates() is cheap to call on every update, it only
+    reads the counters once the interval is up.
+    """
+
+    def __init__(self, names: list, interval: float = 60.0, metrics: MetricsRegistry = None,
+                 clock=time.monotonic):
+        self.names = names
+        self.interval = interval
+        self.metrics = metrics or registry
+        self.clock = clock
+        self.last_time = clock()
+        self.last_values = {name: self.metrics.value(name) for name in names}
+
+    def rates(self):
+        """
+        {name: per second rate since the last time} once interval has passed, else None
+        """
+        now = self.clock()
+        elapsed = now - self.last_time
+        if elapsed < self.interval:
+            return None
+        values = {name: self.metrics.value(name) for name in self.names}
+        rates = {name: (values[name] - self.last_values[name]) / elapsed for name in self.names}
+        self.last_time = now
+        self.last_values = values
+        return rates
@@ -1,21 +1,31 @@
-import dbus
 import logging
 
 from gi.repository import GLib
 
 from rpi_ble.constants import OBD_SERVICE_UUID, ENGINE_TEMP_CHRC_UUID, FUEL_LEVEL_CHRC_UUID
+from rpi_ble.elm327 import Elm327Reader
+from rpi_ble.event_defs import CoolantTempEvent, FuelLevelEvent
 from rpi_ble.interfaces import TemperatureReceiver, FuelLevelReceiver
+from rpi_ble.latest_value import LatestValue
 from rpi_ble.obd_reader import ObdReader
-from rpi_ble.service import GattService, GattCharacteristic, GATT_CHRC_IFACE, Descriptor, NotifyDescriptor
+from rpi_ble.socketcan_reader import SocketCanReader, load_signal_map
+from rpi_ble.service import GattService, GattCharacteristic, Descriptor, NotifyDescriptor
 
 logger = logging.getLogger(__name__)
 
+# python-obd, or our own lean ELM327 driver, or a native CAN interface
+OBD_DRIVER_PYTHON_OBD = 'python-obd'
+OBD_DRIVER_ELM327 = 'elm327'
+OBD_DRIVER_SOCKETCAN = 'socketcan'
+OBD_DRIVERS = (OBD_DRIVER_PYTHON_OBD, OBD_DRIVER_ELM327, OBD_DRIVER_SOCKETCAN)
+
 class ObdGattService(GattService, TemperatureReceiver, FuelLevelReceiver):
     """
     Send obd data on a frequent basis
     """
 
-    def __init__(self, bus, index, test_mode=False):
+    def __init__(self, bus, index, test_mode=False, obd_driver=OBD_DRIVER_PYTHON_OBD,
+                 can_interface='can0', can_signal_map=None):
         GattService.__init__(self, bus, index, OBD_SERVICE_UUID, True)
         self.engine_temp_characteristic = EngineTempObdChrc(bus, 0, self)
         self.fuel_level_characteristic = FuelLevelObdChrc(bus, 1, self)
@@ -24,15 +34,32 @@ class ObdGattService(GattService, TemperatureReceiver, FuelLevelReceiver):
         self.obd_thread = None
         self.obd_connected = False
         self.test_mode = test_mode
+        self.obd_driver = obd_driver
+        self.can_interface = can_interface
+        # path to a json signal map, see socketcan_reader.load_signal_map
+        self.can_signal_map = can_signal_map
 
+    # the readers' receiver : values go to our characteristics, then out as value
+    # events for anything else interested, the recorder and metrics, if anything is
     def set_temp_f(self, temperature: int) -> None:
         self.engine_temp_characteristic.set_temp_f(temperature)
+        if CoolantTempEvent.subscriptions:
+            CoolantTempEvent.emit(temperature)
 
     def set_fuel_percent_remaining(self, percent: int) -> None:
         self.fuel_level_characteristic.set_fuel_percent_remaining(percent)
+        if FuelLevelEvent.subscriptions:
+            FuelLevelEvent.emit(percent)
 
     def set_obd_connected(self):
         self.obd_connected = True
+        # plugged in after a client subscribed
+        if any(chrc.notifying for chrc in self.characteristics):
+            self.start_obd_thread()
+
+    def set_obd_disconnected(self):
+        # unplugged : a reader already running keeps trying to reconnect
+        self.obd_connected = False
 
     def start_obd_thread(self) -> None:
         if self.obd_connected and not self.obd_thread:
@@ -53,24 +80,15 @@ class EngineTempObdChrc(GattCharacteristic, TemperatureReceiver):
         self.add_descriptor(EngineTempObdDescriptor(bus, 0, self))
         self.add_descriptor(NotifyDescriptor(bus, 1, self))
         self.notifying = False
-        self.temp_f = 0
+        # written by the obd reader thread, read on the main loop
+        self.temp_cell = LatestValue(0)
         self.service = service
-        self.update_pending = False
 
     def set_temp_f(self, temperature: int):
-        self.temp_f = temperature
-        # Only schedule if no update is already pending
-        if not self.update_pending:
-            self.update_pending = True
-            logger.debug("Queueing engine temperature property change notification to GLib main loop")
-            GLib.idle_add(self._notify_property_changed, self.ReadValue(None))
+        self.temp_cell.publish(temperature)
+        self.notify_value_changed()
         return self.notifying
 
-    def _notify_property_changed(self, value):
-        self.update_pending = False
-        self.PropertiesChanged(GATT_CHRC_IFACE, {'Value': value}, [])
-        return False  # Don't repeat this idle callback
-
     def StartNotify(self):
         logger.info("StartNotify called")
         if self.notifying:
@@ -89,10 +107,13 @@ class EngineTempObdChrc(GattCharacteristic, TemperatureReceiver):
 
         self.notifying = False
 
-    def ReadValue(self, options):
-        value = []
-        value.append(dbus.Int32(self.temp_f))
-        return value
+    @property
+    def temp_f(self) -> int:
+        return self.temp_cell.get()
+
+    def get_value_bytes(self) -> bytes:
+        # a single unsigned byte
+        return bytes((max(0, min(255, self.temp_f)),))
 
 class FuelLevelObdChrc(GattCharacteristic, FuelLevelReceiver):
 
@@ -105,23 +126,15 @@ class FuelLevelObdChrc(GattCharacteristic, FuelLevelReceiver):
         self.add_descriptor(FuelLevelObdDescriptor(bus, 0, self))
         self.add_descriptor(NotifyDescriptor(bus, 1, self))
         self.notifying = False
-        self.fuel_level = 0
+        # written by the obd reader thread, read on the main loop
+        self.fuel_level_cell = LatestValue(0)
         self.service = service
-        self.update_pending = False
 
     def set_fuel_percent_remaining(self, percent: int):
-        self.fuel_level = percent
-        # Only schedule if no update is already pending
-        if not self.update_pending:
-            self.update_pending = True
-            GLib.idle_add(self._notify_property_changed, self.ReadValue(None))
+        self.fuel_level_cell.publish(percent)
+        self.notify_value_changed()
         return self.notifying
 
-    def _notify_property_changed(self, value):
-        self.update_pending = False
-        self.PropertiesChanged(GATT_CHRC_IFACE, {'Value': value}, [])
-        return False  # Don't repeat this idle callback
-
     def StartNotify(self):
         if self.notifying:
             logger.info('Already notifying, nothing to do')
@@ -138,10 +151,13 @@ class FuelLevelObdChrc(GattCharacteristic, FuelLevelReceiver):
 
         self.notifying = False
 
-    def ReadValue(self, options):
-        value = []
-        value.append(dbus.Int32(self.fuel_level))
-        return value
+    @property
+    def fuel_level(self) -> int:
+        return self.fuel_level_cell.get()
+
+    def get_value_bytes(self) -> bytes:
+        # a single unsigned byte
+        return bytes((max(0, min(255, self.fuel_level)),))
 
 class EngineTempObdDescriptor(Descriptor):
     TEMP_DESCRIPTOR_UUID = "2901"
@@ -156,14 +172,8 @@ class EngineTempObdDescriptor(Descriptor):
             ["read"],
             characteristic)
 
-    def ReadValue(self, options):
-        value = []
-        desc = self.TEMP_DESCRIPTOR_VALUE
-
-        for c in desc:
-            value.append(dbus.Byte(c.encode()))
-
-        return value
+    def get_value_bytes(self) -> bytes:
+        return self.TEMP_DESCRIPTOR_VALUE.encode()
 
 
 class FuelLevelObdDescriptor(Descriptor):
@@ -179,20 +189,19 @@ class FuelLevelObdDescriptor(Descriptor):
             ["read"],
             characteristic)
 
-    def ReadValue(self, options):
-        value = []
-        desc = self.FUEL_LEVEL_DESCRIPTOR_VALUE
-
-        for c in desc:
-            value.append(dbus.Byte(c.encode()))
-
-        return value
+    def get_value_bytes(self) -> bytes:
+        return self.FUEL_LEVEL_DESCRIPTOR_VALUE.encode()
 
 def run_obd_thread(service: ObdGattService):
     if service.test_mode:
         from rpi_ble.synthetic_obd_reader import SyntheticObdReader
         logger.info("Starting synthetic OBD reader thread")
         SyntheticObdReader(service).run()
+    elif service.obd_driver == OBD_DRIVER_ELM327:
+        Elm327Reader(service).run()
+    elif service.obd_driver == OBD_DRIVER_SOCKETCAN:
+        signal_map = load_signal_map(service.can_signal_map) if service.can_signal_map else None
+        SocketCanReader(service, service.can_interface, signal_map).run()
     else:
         ObdReader(service).run()
 
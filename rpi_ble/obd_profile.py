@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+import time
+
+import obd
+from obd import OBDStatus
+
+from rpi_ble.json_file import save_json
+from rpi_ble.usb_detector import device_identity
+
+logger = logging.getLogger(__name__)
+
+# the mode 01 commands that return a bitmap of the 32 pids after them
+PID_GETTERS = (obd.commands.PIDS_A, obd.commands.PIDS_B, obd.commands.PIDS_C)
+
+
+def adapter_id(port: str) -> str:
+    """
+    A name for the adapter on port that stays the same wherever it's plugged in
+    """
+    return device_identity(port) or port
+
+
+def connection_baudrate(connection):
+    # python-obd has no public way to get the baud rate it settled on, so this
+    # reads its ELM327's private serial port. Without it a profile has no baud
+    # rate and connecting with it finds one as usual, just more slowly.
+    if connection.interface is None:
+        return None
+    port = getattr(connection.interface, '_ELM327__port', None)
+    if port is None:
+        logger.warning(f"can't find python-obd {obd.__version__}'s serial port, "
+                       f"profiles won't record the baud rate")
+    return getattr(port, 'baudrate', None)
+
+
+def read_vin(connection) -> str:
+    """
+    The VIN straight from the response bytes, python-obd's decoder doesn't cope
+    with every ECU's padding. Empty if the car doesn't report one.
+    """
+    response = connection.query(obd.commands.VIN, force=True)
+    for message in response.messages or []:
+        # 49 02 <count> then the VIN, sometimes after some padding
+        text = bytes(message.data[3:]).decode('ascii', 'ignore')
+        vin = ''.join(c for c in text if c.isalnum())
+        if len(vin) >= 17:
+            return vin[-17:]
+    return ''
+
+
+class ObdProfile:
+    """
+    What a full python-obd connect works out about an adapter and car : the
+    protocol, the adapter's baud rate and which mode 01 pids the car supports
+    """
+
+    def __init__(self, adapter: str, vin: str, protocol: str, baudrate: int = None,
+                 bitmaps: dict = None, used: float = 0.0):
+        self.adapter = adapter
+        self.vin = vin
+        self.protocol = protocol
+        self.baudrate = baudrate
+        # pid getter name : supported bits as hex
+        self.bitmaps = bitmaps or {}
+        self.used = used
+
+    @property
+    def key(self) -> str:
+        return f"{self.adapter}|{self.vin}"
+
+    def matches(self, other) -> bool:
+        return other is not None and (self.vin, self.protocol, self.bitmaps) == \
+            (other.vin, other.protocol, other.bitmaps)
+
+    def commands(self) -> set:
+        """
+        The commands the bitmaps say are supported, as python-obd works them out
+        """
+        supported = set()
+        for getter in PID_GETTERS:
+            bits = int(self.bitmaps.get(getter.name, '0'), 16)
+            for i in range(32):
+                if bits & (1 << (31 - i)):
+                    pid = getter.pid + i + 1
+                    if obd.commands.has_pid(1, pid):
+                        supported.add(obd.commands[1][pid])
+                    if obd.commands.has_pid(2, pid):
+                        supported.add(obd.commands[2][pid])
+        return supported
+
+    @classmethod
+    def probe(cls, adapter: str, connection):
+        """
+        Build a profile by querying the car, None if it doesn't answer PIDS_A
+        """
+        bitmaps = {}
+        for getter in PID_GETTERS:
+            response = connection.query(getter, force=True)
+            if response.is_null():
+                break
+            bitmaps[getter.name] = f"{sum(1 << (31 - i) for i, bit in enumerate(response.value) if bit):08X}"
+            # the last pid in the bitmap says whether the next getter is supported
+            if not response.value[-1]:
+                break
+        if not bitmaps:
+            return None
+        return cls(adapter, read_vin(connection), connection.protocol_id(), connection_baudrate(connection), bitmaps)
+
+    def to_dict(self) -> dict:
+        return {
+            'adapter': self.adapter,
+            'vin': self.vin,
+            'protocol': self.protocol,
+            'baudrate': self.baudrate,
+            'bitmaps': self.bitmaps,
+            'used': self.used,
+        }
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        return cls(d['adapter'], d['vin'], d['protocol'], d.get('baudrate'), d.get('bitmaps'), d.get('used', 0.0))
+
+
+class ObdProfileCache:
+    """
+    Profiles on disk, keyed by adapter and VIN. Until the car has answered we
+    don't know its VIN, so a lookup is by adapter and returns the profile used
+    with it most recently.
+    """
+
+    DEFAULT_PATH = os.path.expanduser('~/.cache/rpi-ble/obd_profiles.json')
+
+    def __init__(self, path: str = DEFAULT_PATH):
+        self.path = path
+        self.profiles = None
+
+    def load(self) -> dict:
+        if self.profiles is None:
+            self.profiles = {}
+            try:
+                with open(self.path) as f:
+                    for d in json.load(f).values():
+                        profile = ObdProfile.from_dict(d)
+                        self.profiles[profile.key] = profile
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, KeyError, TypeError, AttributeError):
+                logger.warning(f"ignoring unreadable OBD profile cache {self.path}")
+        return self.profiles
+
+    def lookup(self, adapter: str):
+        candidates = [p for p in self.load().values() if p.adapter == adapter]
+        return max(candidates, key=lambda p: p.used) if candidates else None
+
+    def store(self, profile: ObdProfile):
+        profile.used = time.time()
+        self.load()[profile.key] = profile
+        try:
+            save_json(self.path, {key: p.to_dict() for key, p in self.profiles.items()}, indent=1)
+        except OSError:
+            logger.exception(f"unable to save OBD profile cache {self.path}")
+
+
+class ProfiledOBD(obd.OBD):
+    """
+    obd.OBD connecting with the protocol and baud rate from a profile, rather
+    than searching for them, which is most of the time a connect takes. Only
+    python-obd's public API is used : the profile's supported commands are
+    added once it has connected.
+    """
+
+    def __init__(self, portstr: str, profile: ObdProfile):
+        self.profile = profile
+        super().__init__(portstr, baudrate=profile.baudrate, protocol=profile.protocol, fast=True)
+        if self.status() == OBDStatus.CAR_CONNECTED:
+            self.supported_commands.update(self.profile.commands())
@@ -1,32 +1,293 @@
 
 
+import heapq
+import itertools
+
 import obd
-from obd import OBDResponse
+from obd import OBDCommand, OBDResponse
+from obd.protocols import ECU
+from obd.protocols.protocol import Message
 import time
 import os
 import logging
 import platform
 
-from threading import Thread
+from threading import Event, Thread
 # from python_settings import settings
 
 from rpi_ble.event_defs import OBDConnectedEvent, OBDDisconnectedEvent, ExitApplicationEvent
 from rpi_ble.interfaces import ObdReceiver
+from rpi_ble.metrics import Telemetry, registry, TIME_BUCKETS_MS
+from rpi_ble.obd_profile import ObdProfile, ObdProfileCache, ProfiledOBD, adapter_id
 from rpi_ble.usb_detector import UsbDetector, UsbDevice
 
 logger = logging.getLogger(__name__)
 
 
+def raw_messages(messages):
+    return messages
+
+
+def batch_command(cmds) -> OBDCommand:
+    """
+    A single mode 01 request for all of cmds, its value is the raw messages
+    """
+    return OBDCommand("+".join(cmd.name for cmd in cmds), "batched mode 01 request",
+                      b'01' + b''.join(cmd.command[2:] for cmd in cmds), 0, raw_messages,
+                      ECU.ENGINE, fast=True)
+
+
+def split_batch_response(cmds, response: OBDResponse) -> dict:
+    """
+    Split the response to a batch_command into a response per command
+    """
+    by_pid = {cmd.pid: cmd for cmd in cmds}
+    responses = {}
+    for message in response.value or []:
+        data = message.data
+        if not data or data[0] != 0x41:
+            continue
+        i = 1
+        while i < len(data):
+            cmd = by_pid.get(data[i])
+            if cmd is None:
+                # no way to tell how much data an unexpected pid has
+                break
+            # cmd.bytes includes the mode and pid
+            end = i + cmd.bytes - 1
+            if end > len(data):
+                break
+            part = Message(message.frames)
+            part.ecu = message.ecu
+            part.data = bytearray([0x41]) + data[i:end]
+            r = cmd([part])
+            r.time = response.time
+            responses[cmd] = r
+            i = end
+    return responses
+
+
+class AdaptiveRate:
+    """
+    Lets a PID's polling period follow its value : the period shrinks towards
+    min_period when the value moves by more than resolution between polls, and
+    grows towards max_period while it holds steady. Within margin of the high
+    or low alert level it's polled at min_period.
+    """
+
+    GROWTH = 1.5
+
+    def __init__(self, min_period: float, max_period: float, resolution: float,
+                 high: float = None, low: float = None, margin: float = 0.0):
+        self.min_period = min_period
+        self.max_period = max_period
+        self.resolution = resolution
+        self.high = high
+        self.low = low
+        self.margin = margin
+
+    def near_alert(self, value) -> bool:
+        return (self.high is not None and value >= self.high - self.margin) or \
+            (self.low is not None and value <= self.low + self.margin)
+
+    def next_period(self, period: float, value, change, elapsed: float) -> float:
+        if self.near_alert(value):
+            return self.min_period
+        target = period * self.GROWTH
+        if abs(change) > self.resolution and elapsed > 0:
+            # about one resolution step per poll at the rate it's been changing
+            target = min(target, self.resolution * elapsed / abs(change))
+        return min(max(target, self.min_period), self.max_period)
+
+
+class PidPoll:
+
+    def __init__(self, cmd, period: float, priority: int, adaptive: AdaptiveRate = None):
+        self.cmd = cmd
+        self.priority = priority
+        self.adaptive = adaptive
+        if adaptive:
+            period = min(max(period, adaptive.min_period), adaptive.max_period)
+        self.period = period
+        # the last value and when it was read, for adaptive polling
+        self.last_value = None
+        self.last_time = None
+        self.deadline = 0.0
+        self.failures = 0
+        # counted since the last report
+        self.successes = 0
+        self.attempts = 0
+
+
+class PollSchedule:
+    """
+    Decides which PID to query next. PIDs are kept in a heap ordered by when
+    they are next due; when several are due the lowest priority number goes
+    first. A PID that returns no data backs off exponentially on its own,
+    without holding up the others.
+    """
+
+    MAX_BACKOFF = 60.0
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.heap = []
+        self.sequence = itertools.count()
+        self.report_start = clock()
+
+    def add(self, cmd, period: float, priority: int = 0, adaptive: AdaptiveRate = None) -> PidPoll:
+        poll = PidPoll(cmd, period, priority, adaptive)
+        poll.deadline = self.clock()
+        self._push(poll)
+        return poll
+
+    def _push(self, poll: PidPoll):
+        # the sequence number keeps ties from comparing PidPolls
+        heapq.heappush(self.heap, (poll.deadline, next(self.sequence), poll))
+
+    def time_until_next(self) -> float:
+        return max(0.0, self.heap[0][0] - self.clock())
+
+    def next_due(self):
+        """
+        Remove and return the PID to query now, or None if nothing is due yet.
+        It has to be handed back with succeeded() or failed().
+        """
+        batch = self.next_due_batch(1)
+        return batch[0] if batch else None
+
+    def next_due_batch(self, limit: int) -> list:
+        """
+        As next_due, along with up to limit - 1 other mode 01 PIDs that are due, to
+        go in the same request. Returns an empty list if nothing is due yet.
+        """
+        now = self.clock()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap))
+        if not due:
+            return []
+        due.sort(key=lambda entry: (entry[2].priority, entry[0]))
+        batch = due[:1]
+        if due[0][2].cmd.mode == 1:
+            batch += [entry for entry in due[1:] if entry[2].cmd.mode == 1][:limit - 1]
+        for entry in due:
+            if entry not in batch:
+                heapq.heappush(self.heap, entry)
+        for entry in batch:
+            entry[2].attempts += 1
+        return [entry[2] for entry in batch]
+
+    def succeeded(self, poll: PidPoll, value=None):
+        """
+        value is what was read, used to adapt the period of adaptive PIDs
+        """
+        now = self.clock()
+        poll.successes += 1
+        poll.failures = 0
+        if poll.adaptive and value is not None:
+            if poll.last_time is not None:
+                poll.period = poll.adaptive.next_period(poll.period, value, value - poll.last_value,
+                                                        now - poll.last_time)
+            poll.last_value = value
+            poll.last_time = now
+        # keep to the cadence, but don't try to catch up on missed polls
+        poll.deadline = max(poll.deadline + poll.period, now)
+        self._push(poll)
+
+    def failed(self, poll: PidPoll):
+        poll.failures += 1
+        poll.deadline = self.clock() + min(poll.period * 2 ** poll.failures, self.MAX_BACKOFF)
+        self._push(poll)
+
+    def intervals(self) -> dict:
+        """
+        Returns {cmd name: current period in seconds}
+        """
+        return {poll.cmd.name: poll.period for _, _, poll in self.heap}
+
+    def report(self) -> dict:
+        """
+        Returns {cmd name: (requested Hz, achieved Hz, attempts)} since the last report
+        """
+        now = self.clock()
+        elapsed = max(now - self.report_start, 1e-9)
+        result = {}
+        for _, _, poll in self.heap:
+            result[poll.cmd.name] = (1 / poll.period, poll.successes / elapsed, poll.attempts)
+            poll.successes = 0
+            poll.attempts = 0
+        self.report_start = now
+        return result
+
+
+class ReconnectBackoff:
+    """
+    Delays between attempts to reconnect : starting well under a second so a
+    brief glitch costs little, doubling up to MAX_DELAY while the car is off or
+    the adapter unplugged. Also times each outage.
+    """
+
+    INITIAL_DELAY = 0.25
+    MAX_DELAY = 30.0
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.delay = self.INITIAL_DELAY
+        self.attempts = 0
+        self.outage_start = clock()
+        self.up = False
+        # times a connection was lost, until then connecting isn't a recovery
+        self.outages = 0
+
+    def next_delay(self) -> float:
+        delay = self.delay
+        self.attempts += 1
+        self.delay = min(self.delay * 2, self.MAX_DELAY)
+        return delay
+
+    def connected(self):
+        """
+        Returns (seconds the outage lasted, reconnect attempts)
+        """
+        result = (self.clock() - self.outage_start, self.attempts)
+        self.up = True
+        self.delay = self.INITIAL_DELAY
+        self.attempts = 0
+        return result
+
+    def disconnected(self):
+        if self.up:
+            self.up = False
+            self.outages += 1
+            self.outage_start = self.clock()
+
+
 class ObdReader(Thread):
 
+    # command : (period in seconds, priority - lower goes first when several are due)
     refresh_rate = {
-        obd.commands.COOLANT_TEMP: 10,
-        # obd.commands.FUEL_LEVEL: 10,
+        obd.commands.COOLANT_TEMP: (10, 1),
+        # obd.commands.FUEL_LEVEL: (10, 2),
+    }
+
+    # command : how its period adapts to the values read, in the units sent over BLE
+    adaptive_rate = {
+        # steady once warm, but watched closely while warming up or overheating
+        obd.commands.COOLANT_TEMP: AdaptiveRate(min_period=2, max_period=30, resolution=2, high=230, margin=15),
+        obd.commands.FUEL_LEVEL: AdaptiveRate(min_period=5, max_period=60, resolution=1, low=10, margin=5),
     }
 
-    def __init__(self, receiver: ObdReceiver):
+    TELEMETRY_INTERVAL = 60.0
+    # mode 01 requests can carry up to six pids
+    MAX_PIDS_PER_REQUEST = 6
+
+    def __init__(self, receiver: ObdReceiver, profiles: ObdProfileCache = None):
         Thread.__init__(self, daemon=True)
         self.receiver = receiver
+        self.profiles = profiles if profiles is not None else ObdProfileCache()
+        # a cached profile we connected with, to check against the car once polling is under way
+        self.unverified_profile = None
         self.working = False
         self.temp_f = 0
         self.initialization_time = time.time()
@@ -34,77 +295,158 @@ class ObdReader(Thread):
         self.temp_time = 0
         self.fuel_level = 100
         self.fuel_level_time = 0
-        self.last_update_time = {}
+        # cleared for the rest of a connection if batched requests go unanswered
+        self.batching = True
+        self.batch_commands = {}
         self.finished = False
+        # cuts short the wait for the next poll when we're shutting down, or the
+        # wait to reconnect
+        self.wakeup = Event()
+        self.reconnecting = False
+        self.schedule = None
         self.is_rpi = platform.system() == "Linux"
+        self.queries = registry.counter('obd.queries')
+        self.no_data = registry.counter('obd.no_data')
+        self.query_time = registry.histogram('obd.query_ms', TIME_BUCKETS_MS)
+        self.reconnect_attempts = registry.counter('obd.reconnect_attempts')
+        self.connected = registry.gauge('obd.connected')
         ExitApplicationEvent.register_handler(self)
-
-        for key in ObdReader.refresh_rate.keys():
-            self.last_update_time[key] = 0.0
+        OBDConnectedEvent.register_handler(self)
 
     def handle_event(self, event, **kwargs):
         if event == ExitApplicationEvent:
             self.finished = True
+            self.wakeup.set()
+        elif event == OBDConnectedEvent and self.reconnecting:
+            self.wakeup.set()
 
     def run(self) -> None:
         connection = None
+        backoff = ReconnectBackoff()
         while not self.finished:
             try:
                 connection = self.connect(connection)
-                if connection is None:
-                    logger.info("no connection, waiting 30s")
-                    time.sleep(30)
-                    continue
-
-                while connection.status() != obd.OBDStatus.CAR_CONNECTED and not self.finished:
-                    time.sleep(30)
-
-                self.initialization_time = time.time()
-
-                no_data_cycles = 0
-                while connection.status() == obd.OBDStatus.CAR_CONNECTED and not self.finished:
-                    now = time.time()
-                    keys_to_delete = []
-                    for cmd in ObdReader.refresh_rate.keys():
-                        if now - self.last_update_time[cmd] > ObdReader.refresh_rate[cmd]:
-                            r = connection.query(cmd)
-                            if not r.is_null():
-                                no_data_cycles = 0
-                                self.working = True
-                                self.last_update_time[cmd] = r.time
-                                self.process_result(cmd, r)
-                            else:
-                                no_data_cycles += 1
-                                logger.info(f"no data, for {cmd} ({no_data_cycles}/5)")
-                                # keep trying for 5 minutes, then remove the setting
-                                if self.last_update_time[cmd] == 0.0 and time.time() - self.initialization_time > 300:
-                                    # we never got any data for this command, remove it
-                                    keys_to_delete.append(cmd)
-                                time.sleep(10)
-                                if no_data_cycles == 5:
-                                    raise Exception("forcing reconnect due to data starvation")
-                    time.sleep(0.5)
-                    # leaving this functionality out for now, seems fragile and harmful
-                    # for dead_key in keys_to_delete:
-                    #     del ObdReader.refresh_rate[dead_key]
-                    #     logger.info(f"removed {dead_key}")
-
-                # If we exited the loop due to car disconnection (not application exit)
-                if not self.finished and connection.status() != obd.OBDStatus.CAR_CONNECTED:
-                    logger.info("Car disconnected, connection status changed to: %s", connection.status())
-                    self.working = False
-                    OBDDisconnectedEvent.emit()
-                    connection.close()
-                    connection = None
-                    time.sleep(30)  # Wait before attempting reconnection
+                if connection is not None:
+                    outage, attempts = backoff.connected()
+                    if backoff.outages:
+                        logger.info(f"OBD recovered in {outage:.1f}s after {attempts} reconnect attempts")
+                    self.reconnect_attempts.inc(attempts)
+                    self.connected.set(1)
+                    self.initialization_time = time.time()
+
+                    self.poll(connection)
+
+                    # If we exited the loop due to car disconnection (not application exit)
+                    if not self.finished and connection.status() != obd.OBDStatus.CAR_CONNECTED:
+                        logger.info("Car disconnected, connection status changed to: %s", connection.status())
+                        self.working = False
+                        self.connected.set(0)
+                        OBDDisconnectedEvent.emit()
+                        connection.close()
+                        connection = None
+                        backoff.disconnected()
 
             except Exception as e:
                 logger.exception("bad stuff in OBD land %s", e)
                 if connection:
                     connection.close()
+                    connection = None
                 self.working = False
+                self.connected.set(0)
                 OBDDisconnectedEvent.emit()
-                time.sleep(10)
+                backoff.disconnected()
+
+            if connection is None and not self.finished:
+                self.wait_for_reconnect(backoff.next_delay())
+
+    def wait_for_reconnect(self, delay: float):
+        """
+        Wait up to delay before trying to connect again. Cut short when we're
+        shutting down, or by an OBDConnectedEvent, which is also emitted when
+        the hotplug watcher sees the adapter plugged back in. Without inotify
+        there's no such event, and the backoff's longest delay is the wait.
+        """
+        logger.debug(f"reconnecting to OBD in {delay:.2f}s")
+        self.wakeup.clear()
+        self.reconnecting = True
+        try:
+            if not self.finished:
+                self.wakeup.wait(delay)
+        finally:
+            self.reconnecting = False
+            if not self.finished:
+                self.wakeup.clear()
+
+    def poll(self, connection):
+        """
+        Query each PID as it falls due until the car disconnects or we're shutting down
+        """
+        schedule = PollSchedule()
+        for cmd, (period, priority) in ObdReader.refresh_rate.items():
+            schedule.add(cmd, period, priority, ObdReader.adaptive_rate.get(cmd))
+        self.schedule = schedule
+        telemetry = Telemetry(['obd.queries', 'obd.no_data'], self.TELEMETRY_INTERVAL, clock=schedule.clock)
+        no_data_cycles = 0
+        self.batching = True
+        while connection.status() == obd.OBDStatus.CAR_CONNECTED and not self.finished:
+            polls = schedule.next_due_batch(self.MAX_PIDS_PER_REQUEST if self.batching else 1)
+            if not polls:
+                if self.unverified_profile:
+                    self.revalidate_profile(connection)
+                else:
+                    self.wakeup.wait(schedule.time_until_next())
+                continue
+            start = time.perf_counter()
+            results = self.query(connection, polls)
+            self.query_time.observe((time.perf_counter() - start) * 1000)
+            self.queries.inc(len(polls))
+            for poll, r in results:
+                if not r.is_null():
+                    no_data_cycles = 0
+                    self.working = True
+                    schedule.succeeded(poll, self.process_result(poll.cmd, r))
+                else:
+                    no_data_cycles += 1
+                    self.no_data.inc()
+                    schedule.failed(poll)
+                    logger.info(f"no data, for {poll.cmd} ({no_data_cycles}/5)")
+                    if no_data_cycles == 5:
+                        raise Exception("forcing reconnect due to data starvation")
+            rates = telemetry.rates()
+            if rates:
+                logger.info(f"OBD Telemetry: {rates['obd.queries']:.2f} pids/sec, "
+                            f"{rates['obd.no_data']:.2f} without data")
+                self.log_telemetry(schedule)
+
+    def query(self, connection, polls: list) -> list:
+        """
+        Query the PIDs for polls, several at once in a single request when there
+        is more than one. Returns (poll, response) pairs.
+        """
+        if len(polls) > 1 and self.batching:
+            cmds = tuple(poll.cmd for poll in polls)
+            if cmds not in self.batch_commands:
+                self.batch_commands[cmds] = batch_command(cmds)
+            responses = split_batch_response(cmds, connection.query(self.batch_commands[cmds], force=True))
+            if responses:
+                return [(poll, responses.get(poll.cmd, OBDResponse(poll.cmd))) for poll in polls]
+            # some adapters and ECUs only take one pid per request
+            logger.info(f"no response to batched request for {[cmd.name for cmd in cmds]}, "
+                        f"querying one pid at a time")
+            self.batching = False
+        return [(poll, connection.query(poll.cmd)) for poll in polls]
+
+    @staticmethod
+    def log_telemetry(schedule: PollSchedule):
+        rates = ", ".join(f"{name} {achieved:.2f}/{requested:.2f} Hz ({attempts} queries)"
+                          for name, (requested, achieved, attempts) in schedule.report().items())
+        logger.info(f"OBD Telemetry: achieved/requested {rates}")
+
+    def intervals(self) -> dict:
+        """
+        The period each PID is currently polled at, {cmd name: seconds}
+        """
+        return self.schedule.intervals() if self.schedule else {}
 
     def connect(self, old_connection):
         if not UsbDetector.detected(UsbDevice.OBD):
@@ -118,22 +460,38 @@ class ObdReader(Thread):
             OBDDisconnectedEvent.emit()
             old_connection.close()
 
+        adapter = adapter_id(port)
+        profile = self.profiles.lookup(adapter)
+        if profile:
+            result = ProfiledOBD(port, profile)
+            if result.status() == obd.OBDStatus.CAR_CONNECTED:
+                logger.info(f"Car Connected, using cached profile for {profile.vin or 'unknown VIN'}")
+                UsbDetector.confirm(UsbDevice.OBD)
+                self.unverified_profile = profile
+                OBDConnectedEvent.emit()
+                return result
+            logger.info(f"cached OBD profile for {adapter} didn't connect, probing")
+            result.close()
+
         result = obd.OBD(port, fast=True)
         status = result.status()
         if status != obd.OBDStatus.CAR_CONNECTED:
             result.close()
+            if status == obd.OBDStatus.NOT_CONNECTED:
+                # not even an ELM327 there
+                UsbDetector.reject(UsbDevice.OBD)
             return None
 
+        UsbDetector.confirm(UsbDevice.OBD)
+
         logger.info("Car Connected")
         time.sleep(0.5)
 
-        cmds = result.query(obd.commands.PIDS_A)
-        if cmds.value:
-            logger.info(f"available PIDS_A commands {cmds.value}")
+        profile = ObdProfile.probe(adapter, result)
+        if profile:
+            logger.info(f"available PIDS {profile.bitmaps}")
+            self.profiles.store(profile)
             OBDConnectedEvent.emit()
-            cmds = result.query(obd.commands.PIDS_B)
-            if cmds.value:
-                logger.info(f"available PIDS_B commands {cmds.value}")
             return result
         else:
             logger.info("no response to PIDS_A command")
@@ -141,19 +499,42 @@ class ObdReader(Thread):
 
         return None
 
+    def revalidate_profile(self, connection):
+        """
+        Check the cached profile we connected with against the car, once the
+        first values are out. Runs on this thread between polls, as the
+        connection can't be shared.
+        """
+        cached = self.unverified_profile
+        self.unverified_profile = None
+        profile = ObdProfile.probe(cached.adapter, connection)
+        if profile is None:
+            logger.info("no response to PIDS_A command revalidating OBD profile")
+            return
+        if not profile.matches(cached):
+            logger.info(f"OBD profile changed, VIN {cached.vin} -> {profile.vin}, PIDS {profile.bitmaps}")
+            connection.supported_commands = set(obd.commands.base_commands()) | profile.commands()
+        self.profiles.store(profile)
+
     def process_result(self, cmd, response: OBDResponse):
+        """
+        Pass the value on to the receiver, returns the value sent
+        """
         if response.value is None:
-            return
+            return None
         logger.debug(f"processing {cmd} at {response}")
         if cmd == obd.commands.COOLANT_TEMP:
             self.temp_f = int(response.value.to('degF').magnitude)
             self.temp_time = response.time
             self.receiver.set_temp_f(self.temp_f)
+            return self.temp_f
         elif cmd == obd.commands.FUEL_LEVEL:
             if response.value:
                 self.fuel_level = int(response.value.magnitude)
                 self.fuel_level_time = response.time
                 self.receiver.set_fuel_percent_remaining(self.fuel_level)
+                return self.fuel_level
+            return None
         else:
             raise RuntimeWarning(f"no handler for {cmd}")
 
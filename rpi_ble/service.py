@@ -4,7 +4,12 @@ import dbus.exceptions
 import dbus.mainloop.glib
 import dbus.service
 import logging
+import time
+from functools import partial
 
+from gi.repository import GLib
+
+from rpi_ble import metrics
 from rpi_ble.constants import GATT_SERVICE_IFACE, DBUS_PROP_IFACE, GATT_CHRC_IFACE, GATT_DESC_IFACE, \
     NOTIFY_DESCRIPTOR_UUID
 
@@ -26,6 +31,119 @@ class InvalidValueLengthException(dbus.exceptions.DBusException):
 class FailedException(dbus.exceptions.DBusException):
     _dbus_error_name = 'org.bluez.Error.Failed'
 
+def encode_value(data: bytes) -> dbus.Array:
+    """
+    Wrap a bytes buffer as a single D-Bus byte array, rather than building a list of
+    dbus.Byte objects one at a time
+    """
+    return dbus.Array(data, signature='y')
+
+class CachedValue:
+    """
+    Holds the D-Bus encoding of a characteristic or descriptor value until the
+    underlying data changes, so repeated reads and notifications share one array.
+
+    invalidate() may be called from a reader thread while the main loop encodes :
+    the encoding is tagged with the version it started from, so a change that
+    lands mid-encode is picked up by the next get()
+    """
+
+    def __init__(self, source):
+        # callable returning the current value as bytes
+        self.source = source
+        self.value = None
+        self.version = 0
+        self.value_version = -1
+
+    def get(self) -> dbus.Array:
+        version = self.version
+        value = self.value
+        if self.value_version != version:
+            value = encode_value(self.source())
+            self.value = value
+            self.value_version = version
+        return value
+
+    def invalidate(self):
+        self.version += 1
+
+class NotificationPublisher:
+    """
+    Tracks whether a central is subscribed to a characteristic, and pushes value
+    changes to it with PropertiesChanged on the GLib main loop. While nobody is
+    subscribed changes are only counted : nothing is encoded or scheduled.
+
+    Changes are coalesced latest-value-wins : at most one notification is pending
+    and it reads the newest value when it goes out. min_interval / max_rate cap how
+    often a characteristic notifies, changes in between are folded into the next
+    notification and counted as dropped.
+    """
+
+    def __init__(self, chrc, min_interval: float = 0.0, max_rate: float = None):
+        self.chrc = chrc
+        self.interval = min_interval
+        if max_rate:
+            self.interval = max(self.interval, 1.0 / max_rate)
+        self.subscribed = False
+        self.update_pending = False
+        self.last_emit_time = 0.0
+        # notifications sent, changes dropped because nobody was subscribed, and
+        # changes folded into a notification that was already pending
+        self.emitted = 0
+        self.suppressed = 0
+        self.dropped = 0
+        # as ble.<characteristic class>.emitted etc
+        prefix = f"ble.{type(chrc).__name__}"
+        for stat in ('emitted', 'suppressed', 'dropped'):
+            metrics.registry.observe(f"{prefix}.{stat}", partial(getattr, self, stat))
+
+    def publish(self) -> bool:
+        """
+        Note that the characteristic's value changed. Safe to call from any thread.
+        Returns whether anyone is listening.
+        """
+        if not self.subscribed:
+            self.suppressed += 1
+            return False
+        if self.update_pending:
+            self.dropped += 1
+            return True
+        self.update_pending = True
+        delay = self.last_emit_time + self.interval - time.monotonic()
+        if delay > 0:
+            GLib.timeout_add(max(1, round(delay * 1000)), self._emit)
+        else:
+            GLib.idle_add(self._emit)
+        return True
+
+    def subscribe(self):
+        if self.subscribed:
+            return
+        self.subscribed = True
+        # StartNotify runs on the main loop, so push the latest value now rather
+        # than leaving the client waiting for the next change. Until something has
+        # been set there's only the placeholder, e.g. a gps fix at 0,0, so not then
+        if self.chrc.cached_value.version:
+            self._emit()
+
+    def unsubscribe(self):
+        self.subscribed = False
+
+    def _emit(self):
+        self.update_pending = False
+        if self.subscribed:
+            self.last_emit_time = time.monotonic()
+            self.chrc.PropertiesChanged(GATT_CHRC_IFACE, {'Value': self.chrc.get_notify_value()}, [])
+            self.emitted += 1
+        return False  # Don't repeat this callback
+
+    def stats(self) -> dict:
+        return {
+            'emitted': self.emitted,
+            'suppressed': self.suppressed,
+            'dropped': self.dropped,
+        }
+
 class GattService(dbus.service.Object):
     PATH_BASE = '/org/bluez/lemonpi/service'
 
@@ -35,24 +153,30 @@ class GattService(dbus.service.Object):
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
+        self.properties = None
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
-        return {
-            GATT_SERVICE_IFACE: {
-                'UUID': self.uuid,
-                'Primary': self.primary,
-                'Characteristics': dbus.Array(
-                    self.get_characteristic_paths(),
-                    signature='o')
+        # the tree doesn't change once it's built, so BlueZ's repeated
+        # GetManagedObjects/GetAll calls are served from a cached copy
+        if self.properties is None:
+            self.properties = {
+                GATT_SERVICE_IFACE: dbus.Dictionary({
+                    'UUID': self.uuid,
+                    'Primary': self.primary,
+                    'Characteristics': dbus.Array(
+                        self.get_characteristic_paths(),
+                        signature='o')
+                }, signature='sv')
             }
-        }
+        return self.properties
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        self.properties = None
 
     def get_characteristic_paths(self):
         result = []
@@ -75,34 +199,60 @@ class GattService(dbus.service.Object):
 class GattCharacteristic(dbus.service.Object):
 
     def \
-            __init__(self, bus, index, uuid, flags, service):
+            __init__(self, bus, index, uuid, flags, service, min_notify_interval=0.0, max_notify_rate=None):
         self.path = service.path + '/char' + str(index)
         self.bus = bus
         self.uuid = uuid
         self.service = service
         self.flags = flags
         self.descriptors = []
+        self.properties = None
+        self.cached_value = CachedValue(self.get_value_bytes)
+        self.publisher = NotificationPublisher(self, min_notify_interval, max_notify_rate)
         dbus.service.Object.__init__(self, bus, self.path)
 
+    @property
+    def notifying(self) -> bool:
+        return self.publisher.subscribed
+
+    @notifying.setter
+    def notifying(self, enabled: bool):
+        if enabled:
+            if not self.publisher.subscribed:
+                self.on_subscribe()
+            self.publisher.subscribe()
+        else:
+            self.publisher.unsubscribe()
+
+    def on_subscribe(self):
+        """
+        Called as a client subscribes, by StartNotify or the notify descriptor,
+        before the latest value is pushed to it
+        """
+        pass
+
     def get_properties(self):
-        return {
-            GATT_CHRC_IFACE: {
-                'Service': self.service.get_path(),
-                'UUID': self.uuid,
-                'Flags': self.flags,
-                'Descriptors': dbus.Array(
-                    self.get_descriptor_paths(),
-                    # this means its a dbus path
-                    signature='o'
-                )
+        if self.properties is None:
+            self.properties = {
+                GATT_CHRC_IFACE: dbus.Dictionary({
+                    'Service': self.service.get_path(),
+                    'UUID': self.uuid,
+                    'Flags': self.flags,
+                    'Descriptors': dbus.Array(
+                        self.get_descriptor_paths(),
+                        # this means its a dbus path
+                        signature='o'
+                    )
+                }, signature='sv')
             }
-        }
+        return self.properties
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_descriptor(self, descriptor):
         self.descriptors.append(descriptor)
+        self.properties = None
 
     def get_descriptor_paths(self):
         result = []
@@ -113,6 +263,28 @@ class GattCharacteristic(dbus.service.Object):
     def get_descriptors(self):
         return self.descriptors
 
+    def get_value_bytes(self) -> bytes:
+        logger.warning('Default ReadValue called, returning error')
+        raise NotSupportedException()
+
+    def get_value(self) -> dbus.Array:
+        return self.cached_value.get()
+
+    def value_changed(self):
+        # call whenever the data behind get_value_bytes() changes
+        self.cached_value.invalidate()
+
+    def notify_value_changed(self) -> bool:
+        """
+        value_changed(), plus a notification if a central is subscribed. Returns
+        whether anyone is listening.
+        """
+        self.cached_value.invalidate()
+        return self.publisher.publish()
+
+    def get_notify_value(self) -> dbus.Array:
+        return self.get_value()
+
     @dbus.service.method(DBUS_PROP_IFACE,
                          in_signature='s',
                          out_signature='a{sv}')
@@ -126,8 +298,7 @@ class GattCharacteristic(dbus.service.Object):
                         in_signature='a{sv}',
                         out_signature='ay')
     def ReadValue(self, options):
-        logger.warning('Default ReadValue called, returning error')
-        raise NotSupportedException()
+        return self.get_value()
 
     @dbus.service.method(GATT_CHRC_IFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
@@ -159,20 +330,31 @@ class Descriptor(dbus.service.Object):
         self.uuid = uuid
         self.flags = flags
         self.chrc = characteristic
+        self.properties = None
+        self.cached_value = CachedValue(self.get_value_bytes)
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
-        return {
-                GATT_DESC_IFACE: {
-                        'Characteristic': self.chrc.get_path(),
-                        'UUID': self.uuid,
-                        'Flags': self.flags,
-                }
-        }
+        if self.properties is None:
+            self.properties = {
+                    GATT_DESC_IFACE: dbus.Dictionary({
+                            'Characteristic': self.chrc.get_path(),
+                            'UUID': self.uuid,
+                            'Flags': self.flags,
+                    }, signature='sv')
+            }
+        return self.properties
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
+    def get_value_bytes(self) -> bytes:
+        logger.warning('Default ReadValue called, returning error')
+        raise NotSupportedException()
+
+    def get_value(self) -> dbus.Array:
+        return self.cached_value.get()
+
     @dbus.service.method(DBUS_PROP_IFACE,
                          in_signature='s',
                          out_signature='a{sv}')
@@ -186,8 +368,7 @@ class Descriptor(dbus.service.Object):
                         in_signature='a{sv}',
                         out_signature='ay')
     def ReadValue(self, options):
-        logger.warning('Default ReadValue called, returning error')
-        raise NotSupportedException()
+        return self.get_value()
 
     @dbus.service.method(GATT_DESC_IFACE, in_signature='aya{sv}')
     def WriteValue(self, value, options):
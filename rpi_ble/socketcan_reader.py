@@ -0,0 +1,321 @@
+import json
+import logging
+import os
+import select
+import socket
+import struct
+import time
+from threading import Event, Thread
+
+from rpi_ble.elm327 import PID_DECODERS, split_mode_01
+from rpi_ble.event_defs import ExitApplicationEvent, OBDConnectedEvent, OBDDisconnectedEvent
+from rpi_ble.interfaces import ObdReceiver
+from rpi_ble.metrics import Telemetry, registry
+from rpi_ble.obd_reader import ObdReader, PollSchedule
+
+logger = logging.getLogger(__name__)
+
+# struct can_frame : id, length, 3 bytes padding, 8 bytes data
+CAN_FRAME = struct.Struct('=IB3x8s')
+CAN_EFF_FLAG = 0x80000000
+CAN_EFF_MASK = 0x1FFFFFFF
+
+# 11 bit OBD ids : functional request, and the range ECUs respond from
+OBD_REQUEST_ID = 0x7DF
+OBD_RESPONSE_IDS = range(0x7E8, 0x7F0)
+# physical ids are 8 below the response ids, flow control goes there
+OBD_PHYSICAL_OFFSET = 8
+
+# ISO-TP frame types
+ISOTP_SINGLE = 0
+ISOTP_FIRST = 1
+ISOTP_CONSECUTIVE = 2
+# continue to send, no block limit, no separation time
+ISOTP_FLOW_CONTROL = bytes([0x30, 0x00, 0x00, 0, 0, 0, 0, 0])
+
+
+def can_interface_present(interface: str) -> bool:
+    return os.path.exists(f"/sys/class/net/{interface}")
+
+
+def parse_candump_line(line: str):
+    """
+    Parse a line of `candump -L` output, "(1436509052.249713) vcan0 7E8#03410D32",
+    into (timestamp, can id, data). Returns None for anything else.
+    """
+    parts = line.split()
+    if len(parts) != 3 or not parts[0].startswith('('):
+        return None
+    can_id, _, data = parts[2].partition('#')
+    try:
+        return float(parts[0][1:-1]), int(can_id, 16), bytes.fromhex(data)
+    except ValueError:
+        return None
+
+
+def replay_candump(sock: socket.socket, path: str, speed: float = 1.0):
+    """
+    Send the frames in a candump -L log out of sock, keeping their original
+    spacing (divided by speed, 0 for as fast as possible)
+    """
+    first = None
+    start = time.monotonic()
+    with open(path) as f:
+        for line in f:
+            frame = parse_candump_line(line)
+            if frame is None:
+                continue
+            tstamp, can_id, data = frame
+            if first is None:
+                first = tstamp
+            if speed:
+                delay = (tstamp - first) / speed - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            if can_id > 0x7FF:
+                can_id |= CAN_EFF_FLAG
+            sock.send(CAN_FRAME.pack(can_id, len(data), data))
+
+
+class CanSignal:
+    """
+    A value broadcast on the bus : raw = the length bytes at start in frames with
+    can_id, value = raw * scale + offset, passed on to the receiver method for
+    target
+    """
+
+    TARGETS = {
+        'temp_f': 'set_temp_f',
+        'fuel_percent': 'set_fuel_percent_remaining',
+    }
+
+    def __init__(self, name: str, can_id: int, start: int, length: int, target: str,
+                 scale: float = 1.0, offset: float = 0.0, signed: bool = False, byte_order: str = 'big'):
+        if target not in CanSignal.TARGETS:
+            raise ValueError(f"unknown signal target {target}")
+        self.name = name
+        self.can_id = can_id
+        self.start = start
+        self.length = length
+        self.target = target
+        self.scale = scale
+        self.offset = offset
+        self.signed = signed
+        self.byte_order = byte_order
+
+    def decode(self, data: bytes):
+        if len(data) < self.start + self.length:
+            return None
+        raw = int.from_bytes(data[self.start:self.start + self.length], self.byte_order, signed=self.signed)
+        return int(raw * self.scale + self.offset)
+
+
+def load_signal_map(path: str) -> dict:
+    """
+    Read a json list of signals, e.g.
+    [{"name": "coolant", "id": "0x3D0", "start": 1, "length": 1, "scale": 1.8, "offset": -40, "target": "temp_f"}]
+    into {can id: [CanSignal]}
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    signal_map = {}
+    for entry in entries:
+        can_id = entry['id']
+        signal = CanSignal(entry['name'], int(can_id, 0) if isinstance(can_id, str) else can_id,
+                           entry['start'], entry['length'], entry['target'],
+                           entry.get('scale', 1.0), entry.get('offset', 0.0),
+                           entry.get('signed', False), entry.get('byte_order', 'big'))
+        signal_map.setdefault(signal.can_id, []).append(signal)
+    return signal_map
+
+
+class SocketCanReader(Thread):
+    """
+    OBD data straight off a native CAN interface, rather than through an ELM327.
+
+    Mode 01 PIDs from ObdReader.refresh_rate are requested over ISO-TP on the
+    functional OBD id, batched as ObdReader does. Frames matching the signal map
+    are decoded as they go past, with no request needed.
+    """
+
+    MAX_PIDS_PER_REQUEST = 6
+    RESPONSE_TIMEOUT = 0.2
+    TELEMETRY_INTERVAL = 60.0
+
+    # pid : receiver method
+    PID_TARGETS = {
+        0x05: 'set_temp_f',
+        0x2F: 'set_fuel_percent_remaining',
+    }
+
+    def __init__(self, receiver: ObdReceiver, interface: str = 'can0', signal_map: dict = None,
+                 poll_obd: bool = True):
+        Thread.__init__(self, daemon=True)
+        self.receiver = receiver
+        self.interface = interface
+        self.signal_map = signal_map or {}
+        self.poll_obd = poll_obd
+        self.sock = None
+        self.working = False
+        self.finished = False
+        self.wakeup = Event()
+        # can id : [expected length, data so far, next sequence number]
+        self.isotp = {}
+        # pid : poll awaiting a response
+        self.pending = {}
+        self.pending_deadline = 0.0
+        self.schedule = None
+        self.frames_received = registry.counter('can.frames_received')
+        self.frames_decoded = registry.counter('can.frames_decoded')
+        # the same as ObdReader's, whichever driver is reading the car
+        self.queries = registry.counter('obd.queries')
+        self.no_data = registry.counter('obd.no_data')
+        self.connected = registry.gauge('obd.connected')
+        ExitApplicationEvent.register_handler(self)
+
+    def handle_event(self, event, **kwargs):
+        if event == ExitApplicationEvent:
+            self.finished = True
+            self.wakeup.set()
+
+    def run(self) -> None:
+        while not self.finished:
+            try:
+                self.open()
+                self.read_bus()
+            except OSError:
+                logger.exception("issue with CAN interface %s, reconnecting.", self.interface)
+                if self.working:
+                    self.working = False
+                    self.connected.set(0)
+                    OBDDisconnectedEvent.emit()
+                self.wakeup.wait(10)
+            finally:
+                self.close()
+
+    def open(self):
+        self.sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+        self.sock.bind((self.interface,))
+        self.isotp = {}
+        self.pending = {}
+        self.schedule = PollSchedule()
+        if self.poll_obd:
+            for cmd, (period, priority) in ObdReader.refresh_rate.items():
+                if cmd.mode == 1:
+                    self.schedule.add(cmd, period, priority, ObdReader.adaptive_rate.get(cmd))
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def read_bus(self):
+        telemetry = Telemetry(['can.frames_received', 'can.frames_decoded', 'obd.queries', 'obd.no_data'],
+                              self.TELEMETRY_INTERVAL)
+        while not self.finished:
+            timeout = self.next_poll()
+            readable, _, _ = select.select([self.sock], [], [], timeout)
+            if readable:
+                can_id, length, data = CAN_FRAME.unpack(self.sock.recv(CAN_FRAME.size))
+                self.handle_frame(can_id & CAN_EFF_MASK, data[:length])
+            rates = telemetry.rates()
+            if rates:
+                self.log_telemetry(rates)
+
+    def next_poll(self) -> float:
+        """
+        Send the next request if one is due and none is outstanding, returns how
+        long we can wait for frames before we need to do this again
+        """
+        now = time.monotonic()
+        if self.pending and now >= self.pending_deadline:
+            for poll in self.pending.values():
+                self.schedule.failed(poll)
+            self.no_data.inc(len(self.pending))
+            self.pending = {}
+        if not self.pending and self.schedule.heap:
+            polls = self.schedule.next_due_batch(self.MAX_PIDS_PER_REQUEST)
+            if polls:
+                pids = bytes(poll.cmd.pid for poll in polls)
+                self.send_frame(OBD_REQUEST_ID, bytes([1 + len(pids), 0x01]) + pids)
+                self.pending = {poll.cmd.pid: poll for poll in polls}
+                self.queries.inc(len(polls))
+                self.pending_deadline = now + self.RESPONSE_TIMEOUT
+        if self.pending:
+            return max(0.0, self.pending_deadline - now)
+        if self.schedule.heap:
+            return self.schedule.time_until_next()
+        return 1.0
+
+    def send_frame(self, can_id: int, data: bytes):
+        self.sock.send(CAN_FRAME.pack(can_id, 8, data.ljust(8, b'\x00')))
+
+    def handle_frame(self, can_id: int, data: bytes):
+        self.frames_received.inc()
+        if can_id in OBD_RESPONSE_IDS:
+            payload = self.handle_isotp(can_id, data)
+            if payload:
+                self.handle_obd_response(payload)
+        for signal in self.signal_map.get(can_id, ()):
+            value = signal.decode(data)
+            if value is not None:
+                self.frames_decoded.inc()
+                getattr(self.receiver, CanSignal.TARGETS[signal.target])(value)
+                self.set_working()
+
+    def handle_isotp(self, can_id: int, data: bytes):
+        """
+        Returns the complete payload once a response has been reassembled
+        """
+        if not data:
+            return None
+        frame_type = data[0] >> 4
+        if frame_type == ISOTP_SINGLE:
+            return data[1:1 + (data[0] & 0x0F)]
+        if frame_type == ISOTP_FIRST:
+            length = ((data[0] & 0x0F) << 8) | data[1]
+            self.isotp[can_id] = [length, bytearray(data[2:]), 1]
+            self.send_frame(can_id - OBD_PHYSICAL_OFFSET, ISOTP_FLOW_CONTROL)
+            return None
+        if frame_type == ISOTP_CONSECUTIVE and can_id in self.isotp:
+            length, payload, sequence = self.isotp[can_id]
+            if data[0] & 0x0F != sequence & 0x0F:
+                logger.debug(f"lost ISO-TP frame from {can_id:X}")
+                del self.isotp[can_id]
+                return None
+            payload += data[1:]
+            if len(payload) >= length:
+                del self.isotp[can_id]
+                return bytes(payload[:length])
+            self.isotp[can_id][2] = sequence + 1
+        return None
+
+    def handle_obd_response(self, payload: bytes):
+        for pid, data in split_mode_01(payload).items():
+            poll = self.pending.pop(pid, None)
+            if poll is None:
+                continue
+            self.frames_decoded.inc()
+            value = PID_DECODERS[pid](data) if pid in PID_DECODERS else None
+            self.schedule.succeeded(poll, value)
+            target = self.PID_TARGETS.get(pid)
+            if target and value is not None:
+                getattr(self.receiver, target)(value)
+            self.set_working()
+
+    def set_working(self):
+        if not self.working:
+            self.working = True
+            self.connected.set(1)
+            OBDConnectedEvent.emit()
+
+    def log_telemetry(self, rates: dict):
+        logger.info(f"CAN Telemetry: received {rates['can.frames_received']:.1f} frames/sec, "
+                    f"decoded {rates['can.frames_decoded']:.1f} values/sec")
+        if self.schedule.heap:
+            logger.info(f"OBD Telemetry: {rates['obd.queries']:.2f} pids/sec, "
+                        f"{rates['obd.no_data']:.2f} without data")
+            ObdReader.log_telemetry(self.schedule)
+
+    def is_working(self) -> bool:
+        return self.working
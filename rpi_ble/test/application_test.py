@@ -17,4 +17,20 @@ class TestApplication(unittest.TestCase):
         bus = Mock()
         app = GattApplication(bus)
         props = app.GetManagedObjects()
-        self.assertEqual(18, len(props))
+        self.assertEqual(21, len(props))
+
+    def test_managed_objects_cached(self):
+        bus = Mock()
+        app = GattApplication(bus)
+        props = app.GetManagedObjects()
+        self.assertIs(props, app.GetManagedObjects())
+        gps_service = app.get_gps_service()
+        self.assertIs(gps_service.get_properties(), gps_service.get_properties())
+
+        app.remove_service(gps_service)
+        props = app.GetManagedObjects()
+        self.assertEqual(21 - 7, len(props))
+        self.assertNotIn(gps_service.get_path(), props)
+
+        app.add_service(gps_service)
+        self.assertEqual(21, len(app.GetManagedObjects()))
@@ -0,0 +1,68 @@
+import unittest
+from unittest.mock import Mock
+
+import obd
+
+from rpi_ble.elm327 import Elm327, Elm327Reader, parse_response, split_mode_01
+from rpi_ble.elm327_emulator import Elm327Emulator
+from rpi_ble.obd_reader import PollSchedule
+
+
+class TestElm327Parsing(unittest.TestCase):
+
+    def test_single_frame(self):
+        self.assertEqual(bytes.fromhex('410C1AF8'), parse_response(['SEARCHING...', '410C1AF8']))
+        self.assertEqual(b'', parse_response(['NO DATA']))
+
+    def test_multi_frame(self):
+        data = parse_response(['00A', '0:410C1AF80D32', '1:11400582000000'])
+        self.assertEqual(bytes.fromhex('410C1AF80D3211400582'), data)
+        self.assertEqual({0x0C: b'\x1a\xf8', 0x0D: b'\x32', 0x11: b'\x40', 0x05: b'\x82'}, split_mode_01(data))
+
+    def test_unknown_pid_stops_split(self):
+        self.assertEqual({0x0D: b'\x32'}, split_mode_01(bytes.fromhex('410D32FF0102')))
+
+
+class TestElm327(unittest.TestCase):
+
+    def setUp(self):
+        self.emulator = Elm327Emulator()
+        self.emulator.start()
+        self.elm = Elm327(self.emulator.port)
+        self.assertTrue(self.elm.open())
+
+    def tearDown(self):
+        self.elm.close()
+        self.emulator.close()
+
+    def test_open_configures_adapter(self):
+        self.assertEqual(obd.OBDStatus.CAR_CONNECTED, self.elm.status())
+        self.assertFalse(self.emulator.echo)
+        self.assertFalse(self.emulator.spaces)
+        self.assertFalse(self.emulator.headers)
+
+    def test_read_pids(self):
+        self.assertEqual({0x05: 194}, self.elm.read_pids([0x05]))
+        # once the response size is known the request says how many lines to wait for
+        self.elm.read_pids([0x05])
+        self.assertEqual('01051', self.emulator.last_command)
+        self.assertEqual({0x0C: 1726, 0x0D: 50, 0x11: 25, 0x05: 194, 0x2F: 74},
+                         self.elm.read_pids([0x0C, 0x0D, 0x11, 0x05, 0x2F]))
+
+    def test_reader_falls_back_to_single_pids(self):
+        self.emulator.multi_pid = False
+        receiver = Mock()
+        reader = Elm327Reader(receiver)
+        schedule = PollSchedule()
+        polls = [schedule.add(cmd, 1) for cmd in (obd.commands.COOLANT_TEMP, obd.commands.FUEL_LEVEL)]
+        responses = reader.query(self.elm, polls)
+        self.assertFalse(reader.batching)
+        self.assertEqual([194, 74], [response.value for _, response in responses])
+        for poll, response in responses:
+            reader.process_result(poll.cmd, response)
+        receiver.set_temp_f.assert_called_once_with(194)
+        receiver.set_fuel_percent_remaining.assert_called_once_with(74)
+
+
+if __name__ == '__main__':
+    unittest.main()
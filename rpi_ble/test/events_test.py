@@ -0,0 +1,176 @@
+import threading
+import unittest
+from unittest.mock import patch
+
+from rpi_ble.events import Event, EventHandler, EventDispatcher, Delivery, ValueEvent, event_stats
+
+TestEvent = Event("Test-Event")
+
+
+class RecordingHandler(EventHandler):
+
+    def __init__(self, delay: float = 0):
+        self.events = []
+        self.threads = []
+        self.delay = delay
+        self.received = threading.Event()
+
+    def handle_event(self, event, **kwargs):
+        if self.delay:
+            threading.Event().wait(self.delay)
+        self.events.append(kwargs.get('n'))
+        self.threads.append(threading.current_thread())
+        self.received.set()
+
+
+class TestEventDelivery(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = EventDispatcher(max_queued=4)
+        patcher = patch('rpi_ble.events.dispatcher', self.dispatcher)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.idle_callbacks = []
+        self.handler = RecordingHandler()
+
+    def tearDown(self):
+        TestEvent.deregister_handler(RecordingHandler)
+
+    def test_emitter_delivery_is_synchronous(self):
+        TestEvent.register_handler(self.handler)
+        TestEvent.emit(n=1)
+        self.assertEqual([1], self.handler.events)
+        self.assertEqual([threading.current_thread()], self.handler.threads)
+
+    def test_dispatcher_thread_doesnt_block_emitter(self):
+        slow = RecordingHandler(delay=0.5)
+        TestEvent.register_handler(slow, Delivery.DISPATCHER)
+        TestEvent.emit(n=1)
+        self.assertEqual([], slow.events)
+        self.assertTrue(slow.received.wait(2))
+        self.assertEqual([1], slow.events)
+        self.assertEqual('event-dispatcher', slow.threads[0].name)
+
+    def test_main_loop_delivery_is_batched(self):
+        self.dispatcher.use_main_loop(self.idle_callbacks.append)
+        TestEvent.register_handler(self.handler, Delivery.MAIN_LOOP)
+        for n in range(3):
+            TestEvent.emit(n=n)
+        self.assertEqual([], self.handler.events)
+        # one idle callback delivers the lot, in order
+        self.assertEqual(1, len(self.idle_callbacks))
+        self.assertFalse(self.idle_callbacks.pop()())
+        self.assertEqual([0, 1, 2], self.handler.events)
+        TestEvent.emit(n=3)
+        self.assertEqual(1, len(self.idle_callbacks))
+
+    def test_main_loop_overflow_is_counted(self):
+        self.dispatcher.use_main_loop(self.idle_callbacks.append)
+        TestEvent.register_handler(self.handler, Delivery.MAIN_LOOP)
+        for n in range(6):
+            TestEvent.emit(n=n)
+        stats = self.dispatcher.stats()['main_loop']
+        self.assertEqual((4, 2, 4), (stats['queued'], stats['dropped'], stats['high_water']))
+        # without a main loop anything still queued goes out straight away
+        self.dispatcher.use_main_loop(None)
+        self.assertEqual([0, 1, 2, 3], self.handler.events)
+        TestEvent.emit(n=6)
+        self.assertEqual(6, self.handler.events[-1])
+
+    def test_handler_exception_doesnt_stop_delivery(self):
+        class Broken(EventHandler):
+            def handle_event(self, event, **kwargs):
+                raise ValueError()
+
+        self.dispatcher.use_main_loop(self.idle_callbacks.append)
+        TestEvent.register_handler(Broken(), Delivery.MAIN_LOOP)
+        TestEvent.register_handler(self.handler, Delivery.MAIN_LOOP)
+        TestEvent.emit(n=1)
+        self.idle_callbacks.pop()()
+        self.assertEqual([1], self.handler.events)
+        TestEvent.deregister_handler(Broken)
+
+
+SlowEvent = Event("Slow-Event", slow_handler_threshold=0.01)
+FailingEvent = Event("Failing-Event")
+
+
+class TestEventStats(unittest.TestCase):
+
+    def tearDown(self):
+        SlowEvent.deregister_handler(RecordingHandler)
+
+    def test_handler_timing_and_slow_warning(self):
+        SlowEvent.register_handler(RecordingHandler(delay=0.02))
+        with self.assertLogs('rpi_ble.events', 'WARNING') as logs:
+            SlowEvent.emit(n=1)
+        self.assertIn("RecordingHandler took", logs.output[0])
+        stats = event_stats()['events']['Slow-Event']
+        self.assertEqual(1, stats['emitted'])
+        handler = stats['handlers']['RecordingHandler']
+        self.assertEqual((1, 0), (handler['calls'], handler['exceptions']))
+        self.assertGreaterEqual(handler['max_ms'], 20)
+        self.assertEqual(1, sum(handler['histogram_ms'].values()))
+
+    def test_exceptions_counted_per_handler_class(self):
+        class Broken(EventHandler):
+            def handle_event(self, event, **kwargs):
+                raise ValueError()
+
+        FailingEvent.register_handler(Broken())
+        FailingEvent.emit()
+        FailingEvent.emit()
+        FailingEvent.deregister_handler(Broken)
+        self.assertEqual(2, FailingEvent.stats()['handlers']['Broken']['exceptions'])
+
+
+SpeedEvent = ValueEvent("Test-Speed", int)
+
+
+class TestValueEvent(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = EventDispatcher(max_queued=4)
+        patcher = patch('rpi_ble.events.dispatcher', self.dispatcher)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.idle_callbacks = []
+        self.dispatcher.use_main_loop(self.idle_callbacks.append)
+        self.fast = []
+        self.slow = []
+        SpeedEvent.subscribe(self.fast.append)
+        SpeedEvent.subscribe(self.slow.append, Delivery.MAIN_LOOP)
+
+    def tearDown(self):
+        SpeedEvent.unsubscribe(self.fast.append)
+        SpeedEvent.unsubscribe(self.slow.append)
+
+    def test_fan_out_with_latest_value_wins(self):
+        for speed in range(100):
+            SpeedEvent.emit(speed)
+        self.assertEqual(list(range(100)), self.fast)
+        # the slow subscriber has one delivery queued, which gets the newest value
+        self.assertEqual(1, len(self.idle_callbacks))
+        self.assertEqual(1, self.dispatcher.stats()['main_loop']['queued'])
+        self.idle_callbacks.pop()()
+        self.assertEqual([99], self.slow)
+        SpeedEvent.emit(100)
+        self.idle_callbacks.pop()()
+        self.assertEqual([99, 100], self.slow)
+        self.assertEqual(99, SpeedEvent.subscriptions[1].coalesced)
+
+    def test_values_are_typed(self):
+        with self.assertRaises(TypeError):
+            SpeedEvent.emit(1.5)
+        self.assertEqual([], self.fast)
+
+    def test_dropped_delivery_doesnt_stall_subscriber(self):
+        with patch.object(self.dispatcher.main_loop_queue, 'put', return_value=False):
+            SpeedEvent.emit(1)
+        SpeedEvent.emit(2)
+        self.idle_callbacks.pop()()
+        self.assertEqual([2], self.slow)
+
+
+if __name__ == '__main__':
+    unittest.main()
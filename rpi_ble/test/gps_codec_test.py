@@ -0,0 +1,100 @@
+import math
+import time
+import unittest
+
+from rpi_ble import gps_codec
+
+
+class TestGpsCodec(unittest.TestCase):
+
+    def test_fits_in_default_mtu(self):
+        # 23 byte ATT MTU less the 3 byte notification header
+        self.assertLessEqual(gps_codec.ABSOLUTE_SIZE, 20)
+        self.assertEqual(gps_codec.ABSOLUTE_SIZE, len(gps_codec.encode(0, 0, 0, 0, 0, 0, 0)))
+
+    def test_round_trip(self):
+        now = time.time()
+        data = gps_codec.encode(37.7749295, -122.4194155, 271, now, 87, 1.23, 0.98)
+        fix = gps_codec.decode(data)
+        self.assertAlmostEqual(37.7749295, fix.lat, places=7)
+        self.assertAlmostEqual(-122.4194155, fix.long, places=7)
+        self.assertEqual(271, fix.heading)
+        self.assertEqual(87, fix.speed)
+        self.assertAlmostEqual(1.2, fix.gdop)
+        self.assertAlmostEqual(1.0, fix.pdop)
+        now_ms = int(now * 1000)
+        self.assertEqual(now_ms, gps_codec.expand_timestamp(fix.tstamp_ms, now_ms + 5000))
+
+    def test_clamping(self):
+        fix = gps_codec.decode(gps_codec.encode(-90, 180, 360, 0, 999, 99.0, -1.0))
+        self.assertEqual(-90, fix.lat)
+        self.assertEqual(180, fix.long)
+        self.assertEqual(0, fix.heading)
+        self.assertEqual(255, fix.speed)
+        self.assertAlmostEqual(25.5, fix.gdop)
+        self.assertEqual(0, fix.pdop)
+
+    def test_nan_dop(self):
+        fix = gps_codec.decode(gps_codec.encode(1, 1, 1, 0, 1, math.nan, math.nan))
+        self.assertEqual(0, fix.gdop)
+        self.assertEqual(0, fix.pdop)
+
+    def test_expand_timestamp_across_wrap(self):
+        wrap = 1 << 32
+        tstamp_ms = 5 * wrap + 10
+        # the receiver's clock has already wrapped, the fix has not
+        self.assertEqual(tstamp_ms - 20, gps_codec.expand_timestamp((tstamp_ms - 20) % wrap, tstamp_ms))
+        # the fix has wrapped, the receiver's clock lags behind
+        self.assertEqual(tstamp_ms, gps_codec.expand_timestamp(tstamp_ms % wrap, tstamp_ms - 20))
+
+    def test_rejects_bad_frames(self):
+        with self.assertRaises(gps_codec.GpsCodecException):
+            gps_codec.decode(b'\x01\x02')
+        with self.assertRaises(gps_codec.GpsCodecException):
+            gps_codec.decode(b'\x7f' + bytes(gps_codec.ABSOLUTE_SIZE - 1))
+
+    def test_delta_stream(self):
+        encoder = gps_codec.GpsDeltaEncoder(keyframe_interval=5)
+        decoder = gps_codec.GpsDeltaDecoder()
+        start = 1700000000.0
+        frames = []
+        for i in range(12):
+            fix = (37.77 + i * 0.00005, -122.41 - i * 0.00003, (355 + i * 2) % 360, start + i * 0.1, 90, 1.1, 0.9)
+            frame = encoder.encode(*fix)
+            frames.append(frame)
+            decoded = decoder.decode(frame)
+            self.assertAlmostEqual(fix[0], decoded.lat, places=7)
+            self.assertAlmostEqual(fix[1], decoded.long, places=7)
+            self.assertEqual(fix[2], decoded.heading)
+            self.assertEqual(int(fix[3] * 1000) & 0xFFFFFFFF, decoded.tstamp_ms)
+        frame_types = [frame[0] for frame in frames]
+        keyframes = [i for i, t in enumerate(frame_types) if t == gps_codec.FRAME_KEYFRAME]
+        self.assertEqual([0, 5, 10], keyframes)
+        self.assertEqual(gps_codec.DELTA_SIZE, len(frames[1]))
+        self.assertLess(gps_codec.DELTA_SIZE, gps_codec.ABSOLUTE_SIZE)
+
+    def test_delta_gap_needs_keyframe(self):
+        encoder = gps_codec.GpsDeltaEncoder()
+        decoder = gps_codec.GpsDeltaDecoder()
+        decoder.decode(encoder.encode(1.0, 1.0, 0, 100.0, 10, 1, 1))
+        encoder.encode(1.00001, 1.0, 0, 100.1, 10, 1, 1)  # lost in transit
+        self.assertIsNone(decoder.decode(encoder.encode(1.00002, 1.0, 0, 100.2, 10, 1, 1)))
+        self.assertTrue(decoder.needs_keyframe)
+        self.assertEqual(1, decoder.gaps)
+        encoder.request_keyframe()
+        fix = decoder.decode(encoder.encode(1.00003, 1.0, 0, 100.3, 10, 1, 1))
+        self.assertAlmostEqual(1.00003, fix.lat, places=7)
+        self.assertFalse(decoder.needs_keyframe)
+
+    def test_large_jump_falls_back_to_keyframe(self):
+        encoder = gps_codec.GpsDeltaEncoder()
+        encoder.encode(1.0, 1.0, 0, 100.0, 10, 1, 1)
+        self.assertEqual(gps_codec.FRAME_DELTA, encoder.encode(1.0001, 1.0, 0, 100.1, 10, 1, 1)[0])
+        # ~1km jump
+        self.assertEqual(gps_codec.FRAME_KEYFRAME, encoder.encode(1.01, 1.0, 0, 100.2, 10, 1, 1)[0])
+        # more than 65s since the last frame
+        self.assertEqual(gps_codec.FRAME_KEYFRAME, encoder.encode(1.01, 1.0, 0, 200.0, 10, 1, 1)[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
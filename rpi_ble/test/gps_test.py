@@ -1,7 +1,8 @@
 import time
+import tracemalloc
 import unittest
-from json import JSONDecoder
-from unittest.mock import Mock
+from json import JSONDecoder, JSONEncoder
+from unittest.mock import Mock, patch
 
 import sys
 
@@ -13,7 +14,9 @@ sys.modules['gpiozero'] = Mock()
 
 from rpi_ble.service import GattCharacteristic, Descriptor
 
-from rpi_ble.gps_gatt_service import GpsGattService, GpsChrc, GpsPos
+from rpi_ble import gps_codec
+from rpi_ble.event_defs import GpsFix, GpsFixEvent
+from rpi_ble.gps_gatt_service import GpsGattService, GpsChrc, GpsBinaryChrc, GpsPos
 
 
 class TestGps(unittest.TestCase):
@@ -48,9 +51,10 @@ class TestGps(unittest.TestCase):
         gps_chr: GpsChrc = service.characteristics[0]
         self.assertEqual(expected, gps_chr.gps_pos)
         gps_ser = gps_chr.ReadValue(None)
-        result_str = ''.join(str(byte_string) for byte_string in gps_ser)
+        result_str = bytes(gps_ser).decode()
         result = JSONDecoder().decode(result_str)
-        print(result)
+        self.assertEqual(32.2, result['lat'])
+        self.assertEqual(int(now * 1000), result['tstamp'])
 
     def test_gps_serialization2(self):
         bus = Mock()
@@ -61,6 +65,94 @@ class TestGps(unittest.TestCase):
         gps_chr: GpsChrc = service.characteristics[0]
         self.assertEqual(expected, gps_chr.gps_pos)
         gps_ser = gps_chr.ReadValue(None)
-        result_str = ''.join(str(byte_string) for byte_string in gps_ser)
+        result_str = bytes(gps_ser).decode()
         result = JSONDecoder().decode(result_str)
-        print(result)
\ No newline at end of file
+        self.assertEqual(32.2, result['lat'])
+        self.assertEqual(int(now * 1000), result['tstamp'])
+
+    def test_gps_pos_json_matches_encoder(self):
+        pos = GpsPos(37.7749, -122.4194, 271, 1714564801.123, 95, 1.23, math.nan)
+        expected = JSONEncoder().encode({'lat': 37.7749, 'long': -122.4194, 'hdg': 271, 'tstamp': 1714564801123,
+                                         'spd': 95, 'gdop': 1.23, 'pdop': 0.0})
+        self.assertEqual(expected, pos.toJSON())
+
+    def test_gps_pos_updated_in_place(self):
+        bus = Mock()
+        service = GpsGattService(bus, 0)
+        gps_chr: GpsChrc = service.characteristics[0]
+        pos = gps_chr.gps_pos
+        now = time.time()
+        service.set_gps_position(32.2, -32.2, 0.5, now, 10, 1.2, 1.5)
+        self.assertIs(pos, gps_chr.gps_pos)
+        self.assertEqual(GpsPos(32.2, -32.2, 0.5, now, 10, 1.2, 1.5), pos)
+        self.assertNotEqual(GpsPos(32.2, -32.2, 0.5, now + 1, 10, 1.2, 1.5), pos)
+
+    def test_allocations_per_fix(self):
+        bus = Mock()
+        service = GpsGattService(bus, 0)
+        gps_chr: GpsChrc = service.characteristics[0]
+        now = time.time()
+        fixes = [(32.2 + i * 1e-6, -32.2, 0.5, now + i / 10, 10, 1.2, 1.5) for i in range(1000)]
+        # warm up, so caches and the first encoded value are already in place
+        for fix in fixes[:100]:
+            service.set_gps_position(*fix)
+            gps_chr.get_value_bytes()
+
+        tracemalloc.start()
+        try:
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            for fix in fixes:
+                service.set_gps_position(*fix)
+                gps_chr.get_value_bytes()
+            after, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        # nothing is retained per fix, and only the encoded value exists at any one time
+        self.assertLess(after - before, 1024)
+        self.assertLess(peak - before, 1024)
+
+
+    def test_resubscribe_starts_with_keyframe(self):
+        bus = Mock()
+        service = GpsGattService(bus, 0)
+        binary_chr: GpsBinaryChrc = service.characteristics[1]
+        binary_chr.delta_mode = True
+        binary_chr.PropertiesChanged = Mock()
+        notify_descriptor = binary_chr.descriptors[1]
+        now = time.time()
+        binary_chr.set_gps_position(32.2, -32.2, 0.5, now, 10, 1.2, 1.5)
+        frame_types = []
+        for enabled in (1, 0, 1):
+            notify_descriptor.WriteValue([enabled], {})
+            if enabled:
+                frame_types.append(binary_chr.PropertiesChanged.call_args[0][1]['Value'][0])
+                for i in range(3):
+                    binary_chr.set_gps_position(32.2 + i * 1e-5, -32.2, 0.5, now + i / 10, 10, 1.2, 1.5)
+                    frame_types.append(binary_chr.get_notify_value()[0])
+        # re-enabled through the descriptor, the first frame is a keyframe again
+        self.assertEqual([gps_codec.FRAME_KEYFRAME] + [gps_codec.FRAME_DELTA] * 3, frame_types[:4])
+        self.assertEqual(gps_codec.FRAME_KEYFRAME, frame_types[4])
+
+    def test_services_only_update_their_own_characteristics(self):
+        first = GpsGattService(Mock(), 0)
+        second = GpsGattService(Mock(), 1)
+        now = time.time()
+        first.set_gps_position(32.2, -32.2, 0.5, now, 10, 1.2, 1.5)
+        self.assertEqual(GpsPos(32.2, -32.2, 0.5, now, 10, 1.2, 1.5), first.gps_characteristic.gps_pos)
+        self.assertEqual(GpsPos(0, 0, 0, 0, 0, 0, 0), second.gps_characteristic.gps_pos)
+        self.assertEqual(GpsPos(0, 0, 0, 0, 0, 0, 0), second.gps_binary_characteristic.gps_cell.get())
+
+    def test_fix_event_only_built_for_subscribers(self):
+        service = GpsGattService(Mock(), 0)
+        now = time.time()
+        with patch.object(GpsFixEvent, 'subscriptions', ()), patch('rpi_ble.gps_gatt_service.GpsFix') as gps_fix:
+            service.set_gps_position(32.2, -32.2, 0.5, now, 10, 1.2, 1.5)
+        gps_fix.assert_not_called()
+
+        fixes = []
+        GpsFixEvent.subscribe(fixes.append)
+        self.addCleanup(GpsFixEvent.unsubscribe, fixes.append)
+        service.set_gps_position(32.2, -32.2, 0.5, now, 10, 1.2, 1.5)
+        self.assertEqual([GpsFix(32.2, -32.2, 0.5, now, 10, 1.2, 1.5)], fixes)
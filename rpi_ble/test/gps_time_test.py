@@ -0,0 +1,42 @@
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from dateutil import parser
+
+from rpi_ble.gps_time import gps_time_ms, MIN_VALID_TIME_MS
+
+
+def isoparse_ms(value: str) -> int:
+    return round(parser.isoparse(value).astimezone().timestamp() * 1000)
+
+
+class TestGpsTime(unittest.TestCase):
+
+    def test_matches_dateutil(self):
+        # 10Hz across the end of a leap day, a year end and a minute with odd milliseconds
+        starts = [datetime(2024, 2, 29, 23, 59, 58, tzinfo=timezone.utc),
+                  datetime(2025, 12, 31, 23, 59, 59, 500000, tzinfo=timezone.utc),
+                  datetime(2026, 6, 1, 8, 30, 0, 7000, tzinfo=timezone.utc)]
+        for start in starts:
+            for i in range(50):
+                t = start + timedelta(milliseconds=100 * i)
+                value = t.strftime('%Y-%m-%dT%H:%M:%S.') + f"{t.microsecond // 1000:03d}Z"
+                self.assertEqual(isoparse_ms(value), gps_time_ms(value), value)
+
+    def test_falls_back_for_other_formats(self):
+        for value in ['2024-05-01T12:00:01Z', '2024-05-01T12:00:01.5Z', '2024-05-01T12:00:01.123456Z',
+                      '2024-05-01T14:00:01.000+02:00']:
+            self.assertEqual(isoparse_ms(value), gps_time_ms(value), value)
+
+    def test_rejects_garbage(self):
+        for value in ['', 'nan', '2024-13-01T12:00:01.000Z', '2024-05-01T12:00:01.x00Z']:
+            with self.assertRaises(ValueError, msg=value):
+                gps_time_ms(value)
+
+    def test_min_valid_time(self):
+        self.assertLess(gps_time_ms('2020-12-31T23:59:59.999Z'), MIN_VALID_TIME_MS)
+        self.assertEqual(MIN_VALID_TIME_MS, gps_time_ms('2021-01-01T00:00:00.000Z'))
+
+
+if __name__ == '__main__':
+    unittest.main()
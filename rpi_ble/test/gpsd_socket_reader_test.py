@@ -0,0 +1,162 @@
+import select
+import socket
+import threading
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+import sys
+
+sys.modules['gi.repository'] = Mock()
+
+from rpi_ble.gpsd_socket_reader import GpsdSocketReader
+
+VERSION = b'{"class":"VERSION","release":"3.22","rev":"3.22","proto_major":3,"proto_minor":14}\r\n'
+DEVICES = b'{"class":"DEVICES","devices":[{"class":"DEVICE","path":"/dev/ttyACM0","driver":"u-blox","native":0}]}\r\n'
+SKY = b'{"class":"SKY","device":"/dev/ttyACM0","gdop":1.23,"pdop":0.98,"satellites":[]}\r\n'
+NO_FIX = b'{"class":"TPV","device":"/dev/ttyACM0","mode":1,"time":"2024-05-01T12:00:00.000Z"}\r\n'
+TPV = (b'{"class":"TPV","device":"/dev/ttyACM0","mode":3,"time":"2024-05-01T12:00:01.000Z",'
+       b'"lat":37.7749,"lon":-122.4194,"track":271.5,"speed":42.5}\r\n')
+
+
+class FakeGpsd(threading.Thread):
+    """
+    Accepts one client, records what it sends and replays canned reports
+    """
+
+    def __init__(self, reports):
+        threading.Thread.__init__(self, daemon=True)
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.port = self.server.getsockname()[1]
+        self.reports = reports
+        self.received = b''
+        self.done = threading.Event()
+
+    def run(self):
+        conn, _ = self.server.accept()
+        with conn:
+            self.received = conn.recv(1024)
+            for report in self.reports:
+                conn.sendall(report)
+            self.done.wait(5)
+        self.server.close()
+
+
+class TestGpsdSocketReader(unittest.TestCase):
+
+    def finish_connect(self, reader: GpsdSocketReader, glib):
+        # stands in for the main loop dispatching the connect watch
+        on_connected = glib.io_add_watch.call_args[0][3]
+        self.assertEqual(reader._on_connected, on_connected)
+        select.select([], [reader.sock], [], 5)
+        self.assertFalse(on_connected(reader.sock.fileno(), None))
+
+    def pump(self, reader: GpsdSocketReader, calls: int):
+        # stands in for the main loop dispatching the io watch
+        for _ in range(calls):
+            select.select([reader.sock], [], [], 5)
+            if not reader._on_readable(reader.sock.fileno(), None):
+                return False
+        return True
+
+    @patch('rpi_ble.gpsd_socket_reader.GLib')
+    def test_reads_tpv_from_gpsd(self, glib):
+        # the fix is split across two writes to check partial lines are buffered
+        gpsd = FakeGpsd([VERSION, DEVICES, SKY, NO_FIX, TPV[:40], TPV[40:]])
+        gpsd.start()
+        receiver = Mock()
+        reader = GpsdSocketReader(receiver, port=gpsd.port)
+        reader.start()
+        try:
+            self.finish_connect(reader, glib)
+            # connected in time, so the timeout is gone
+            glib.source_remove.assert_called_once_with(glib.timeout_add.return_value)
+            self.assertEqual(2, glib.io_add_watch.call_count)
+            self.assertEqual(reader._on_readable, glib.io_add_watch.call_args[0][3])
+            while not receiver.set_gps_position.called:
+                self.assertTrue(self.pump(reader, 1))
+            self.assertIn(b'?WATCH={"enable":true,"json":true}', gpsd.received)
+            receiver.set_gps_position.assert_called_once()
+            lat, long, heading, tstamp, speed, gdop, pdop = receiver.set_gps_position.call_args[0]
+            self.assertEqual(37.7749, lat)
+            self.assertEqual(-122.4194, long)
+            self.assertEqual(271, heading)
+            self.assertEqual(1714564801.0, tstamp)
+            self.assertEqual(95, speed)
+            self.assertEqual((1.23, 0.98), (gdop, pdop))
+            self.assertTrue(reader.is_working())
+        finally:
+            gpsd.done.set()
+
+    @patch('rpi_ble.gpsd_socket_reader.GLib')
+    def test_reconnects_when_gpsd_goes_away(self, glib):
+        gpsd = FakeGpsd([TPV])
+        gpsd.start()
+        reader = GpsdSocketReader(Mock(), port=gpsd.port)
+        reader.start()
+        self.finish_connect(reader, glib)
+        self.pump(reader, 1)
+        self.assertTrue(reader.is_working())
+        gpsd.done.set()
+        gpsd.join()
+        self.assertFalse(self.pump(reader, 2))
+        self.assertFalse(reader.is_working())
+        self.assertIsNone(reader.sock)
+        glib.timeout_add.assert_called_with(GpsdSocketReader.RECONNECT_DELAY_MS, reader.start)
+
+    @patch('rpi_ble.gpsd_socket_reader.GLib')
+    def test_retries_when_gpsd_not_running(self, glib):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        port = server.getsockname()[1]
+        server.close()
+        reader = GpsdSocketReader(Mock(), port=port)
+        start = time.monotonic()
+        self.assertFalse(reader.start())
+        self.assertLess(time.monotonic() - start, 0.1)
+        # refused straight away, or once the connect finishes
+        if reader.sock:
+            self.finish_connect(reader, glib)
+        glib.io_add_watch.assert_called_once()
+        self.assertIsNone(reader.sock)
+        glib.timeout_add.assert_called_with(GpsdSocketReader.RECONNECT_DELAY_MS, reader.start)
+
+    @patch('rpi_ble.gpsd_socket_reader.GLib')
+    def test_connect_timeout(self, glib):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        reader = GpsdSocketReader(Mock(), port=server.getsockname()[1])
+        try:
+            reader.start()
+            self.assertEqual(reader._on_connect_timeout, glib.timeout_add.call_args[0][1])
+            self.assertFalse(reader._on_connect_timeout())
+            self.assertIsNone(reader.sock)
+            glib.source_remove.assert_called_once_with(glib.io_add_watch.return_value)
+            glib.timeout_add.assert_called_with(GpsdSocketReader.RECONNECT_DELAY_MS, reader.start)
+        finally:
+            server.close()
+
+    def test_slow_handling_is_timed(self):
+        receiver = Mock()
+        receiver.set_gps_position.side_effect = lambda *args: time.sleep(0.06)
+        reader = GpsdSocketReader(receiver)
+        fixes = reader.handling_time.count
+        with self.assertLogs('rpi_ble.gpsd_socket_reader', 'WARNING') as logs:
+            reader.handle_data(TPV)
+        self.assertIn("position handling took", logs.output[0])
+        self.assertEqual(fixes + 1, reader.handling_time.count)
+
+    def test_ignores_other_reports(self):
+        receiver = Mock()
+        reader = GpsdSocketReader(receiver)
+        reader.handle_data(VERSION + NO_FIX + b'{"class":"PPS","device":"/dev/ttyACM0"}\r\n')
+        receiver.set_gps_position.assert_not_called()
+        self.assertFalse(reader.is_working())
+        self.assertEqual(b'', reader.buffer)
+
+
+if __name__ == '__main__':
+    unittest.main()
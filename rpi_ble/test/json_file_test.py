@@ -0,0 +1,35 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from rpi_ble.json_file import save_json
+
+
+class TestSaveJson(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache', 'devices.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_replaces_existing_file(self):
+        save_json(self.path, {'a': 1})
+        save_json(self.path, {'b': 2}, indent=1)
+        with open(self.path) as f:
+            self.assertEqual({'b': 2}, json.load(f))
+        self.assertEqual(['devices.json'], os.listdir(os.path.dirname(self.path)))
+
+    def test_failed_write_keeps_old_file(self):
+        save_json(self.path, {'a': 1})
+        with self.assertRaises(TypeError):
+            save_json(self.path, {'a': object()})
+        with open(self.path) as f:
+            self.assertEqual({'a': 1}, json.load(f))
+
+
+if __name__ == '__main__':
+    unittest.main()
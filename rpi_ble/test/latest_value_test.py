@@ -0,0 +1,82 @@
+import sys
+import threading
+import unittest
+
+from rpi_ble.latest_value import LatestValue
+
+
+def fill(value: list, n: int):
+    # deliberately slow, element at a time, so an unsynchronised reader would
+    # see a mix of old and new values
+    for i in range(len(value)):
+        value[i] = n
+
+
+class TestLatestValue(unittest.TestCase):
+
+    def test_publish_and_read(self):
+        cell = LatestValue(1)
+        version, value = cell.read()
+        self.assertEqual(1, value)
+        cell.publish(2)
+        self.assertEqual(2, cell.get())
+        self.assertGreater(cell.version, version)
+        self.assertEqual(0, cell.version % 2)
+
+    def test_update_in_place(self):
+        cell = LatestValue([0, 0])
+        cell.update(fill, 5)
+        self.assertEqual((5, 5), cell.read(tuple)[1])
+
+    def test_failed_update_leaves_cell_readable(self):
+        def explode(value):
+            raise ValueError()
+
+        cell = LatestValue([0])
+        with self.assertRaises(ValueError):
+            cell.update(explode)
+        self.assertEqual([0], cell.get())
+
+    def test_no_torn_reads_under_contention(self):
+        cell = LatestValue([0] * 16)
+        writers = 4
+        readers = 4
+        writes_per_writer = 3000
+        reads_per_reader = 3000
+        torn = []
+        versions_went_backwards = []
+
+        def writer(offset):
+            for n in range(writes_per_writer):
+                cell.update(fill, offset + n)
+
+        def reader():
+            last_version = -1
+            for _ in range(reads_per_reader):
+                version, snapshot = cell.read(tuple)
+                if len(set(snapshot)) != 1:
+                    torn.append(snapshot)
+                if version < last_version:
+                    versions_went_backwards.append((last_version, version))
+                last_version = version
+
+        switch_interval = sys.getswitchinterval()
+        # switch threads as often as possible to provoke overlapping reads and writes
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=writer, args=(i * writes_per_writer,)) for i in range(writers)]
+            threads += [threading.Thread(target=reader) for _ in range(readers)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            sys.setswitchinterval(switch_interval)
+
+        self.assertEqual([], torn)
+        self.assertEqual([], versions_went_backwards)
+        self.assertEqual(2 * writers * writes_per_writer, cell.version)
+
+
+if __name__ == '__main__':
+    unittest.main()
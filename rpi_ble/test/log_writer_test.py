@@ -0,0 +1,87 @@
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from rpi_ble.log_writer import BatchingFileHandler
+
+# logs then exits straight away, leaving logging.shutdown() to close the handler
+EXITING_SCRIPT = '''
+import logging, sys
+from rpi_ble.log_writer import BatchingFileHandler
+handler = BatchingFileHandler(sys.argv[1], maxBytes=1000000, backupCount=1, flush_interval=10)
+log = logging.getLogger('exiting')
+log.addHandler(handler)
+for i in range(6):
+    log.warning("line %d", i)
+'''
+
+def make_record(msg, *args):
+    return logging.LogRecord('rpi_ble.test', logging.INFO, __file__, 1, msg, args, None)
+
+
+class TestBatchingFileHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'test.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read_lines(self, path=None):
+        with open(path or self.path) as f:
+            return f.read().splitlines()
+
+    def test_synced_within_flush_interval(self):
+        handler = BatchingFileHandler(self.path, flush_interval=0.05)
+        args = ['original']
+        handler.handle(make_record("position handling took %d ms %s", 12, args))
+        # changing the args once logged doesn't change what's written
+        args[0] = 'changed'
+        deadline = time.time() + 2
+        while handler.syncs == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(["position handling took 12 ms ['original']"], self.read_lines())
+        handler.close()
+        self.assertEqual((1, 1), (handler.stats()['queued'], handler.stats()['written']))
+
+    def test_batches_records(self):
+        handler = BatchingFileHandler(self.path, flush_interval=10)
+        for i in range(100):
+            handler.handle(make_record("record %d", i))
+        handler.close()
+        self.assertEqual(100, len(self.read_lines()))
+        # one sync for the lot, when closing
+        self.assertEqual(1, handler.syncs)
+
+    def test_rollover(self):
+        handler = BatchingFileHandler(self.path, maxBytes=100, backupCount=2, flush_interval=10)
+        for i in range(10):
+            handler.handle(make_record("twenty byte record %d", i))
+        handler.close()
+        self.assertEqual(["twenty byte record 8", "twenty byte record 9"], self.read_lines())
+        self.assertEqual(4, len(self.read_lines(self.path + '.1')))
+
+    def test_overflow_is_counted(self):
+        handler = BatchingFileHandler(self.path, flush_interval=10, max_queued=2)
+        for i in range(5):
+            handler.handle(make_record("record %d", i))
+        handler.close()
+        self.assertEqual(3, handler.dropped)
+        self.assertEqual(["record 0", "record 1", "dropped (3) log records"], self.read_lines())
+
+    def test_written_by_logging_shutdown(self):
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        result = subprocess.run([sys.executable, '-c', EXITING_SCRIPT, self.path], cwd=root,
+                                env=dict(os.environ, PYTHONPATH=root), capture_output=True, text=True, timeout=10)
+        self.assertEqual('', result.stderr)
+        self.assertEqual([f"line {i}" for i in range(6)], self.read_lines())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+from rpi_ble.metrics import MetricsRegistry, Telemetry
+
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def test_metrics_are_shared_by_name(self):
+        registry = MetricsRegistry()
+        registry.counter('gps.updates').inc()
+        registry.counter('gps.updates').inc(2)
+        registry.gauge('ble.clients').set(1)
+        self.assertEqual({'gps.updates': 3, 'ble.clients': 1}, registry.snapshot())
+        self.assertEqual({'gps.updates': 3}, registry.snapshot('gps.'))
+        with self.assertRaises(TypeError):
+            registry.gauge('gps.updates')
+
+    def test_histogram(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram('obd.query_ms', (10, 100))
+        for value in (1, 10, 11, 500):
+            histogram.observe(value)
+        self.assertEqual((2, 1, 1), registry.snapshot()['obd.query_ms'])
+        self.assertEqual({'<=10': 2, '<=100': 1, '>100': 1}, histogram.to_dict())
+        self.assertEqual((4, 522, 500), (histogram.count, histogram.total, histogram.max))
+
+    def test_observed(self):
+        registry = MetricsRegistry()
+        counts = {'emitted': 5}
+        registry.observe('ble.GpsChrc.emitted', lambda: counts['emitted'])
+        counts['emitted'] = 7
+        self.assertEqual(7, registry.value('ble.GpsChrc.emitted'))
+        self.assertEqual(0, registry.value('unknown'))
+
+
+class TestTelemetry(unittest.TestCase):
+
+    def test_rates_once_per_interval(self):
+        registry = MetricsRegistry()
+        updates = registry.counter('gps.updates')
+        now = [0.0]
+        telemetry = Telemetry(['gps.updates'], 60, registry, clock=lambda: now[0])
+        updates.inc(300)
+        now[0] = 30
+        self.assertIsNone(telemetry.rates())
+        updates.inc(300)
+        now[0] = 60
+        self.assertEqual({'gps.updates': 10.0}, telemetry.rates())
+        now[0] = 100
+        self.assertIsNone(telemetry.rates())
+        now[0] = 120
+        self.assertEqual({'gps.updates': 0.0}, telemetry.rates())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import Mock, patch
+
+import obd
+
+from rpi_ble.elm327_emulator import Elm327Emulator
+from rpi_ble.obd_profile import ObdProfile, ObdProfileCache, ProfiledOBD
+from rpi_ble.obd_reader import ObdReader
+
+VIN = '1FA6P8CF5H5123456'
+
+
+class TestObdProfileCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache', 'profiles.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_lookup_most_recent_for_adapter(self):
+        cache = ObdProfileCache(self.path)
+        self.assertIsNone(cache.lookup('elm'))
+        cache.store(ObdProfile('elm', 'VIN1', '6', 38400, {'PIDS_A': 'BE3FA813'}))
+        cache.store(ObdProfile('elm', 'VIN2', '3'))
+        cache.store(ObdProfile('other', 'VIN3', '6'))
+        profile = ObdProfileCache(self.path).lookup('elm')
+        self.assertEqual(('VIN2', '3'), (profile.vin, profile.protocol))
+
+    def test_unreadable_cache_is_ignored(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('{"elm|": {"adapter": "elm"')
+        self.assertIsNone(ObdProfileCache(self.path).lookup('elm'))
+
+    def test_commands_from_bitmaps(self):
+        # 0x05 and 0x0C, and PIDS_B is supported
+        profile = ObdProfile('elm', VIN, '6', bitmaps={'PIDS_A': '08100001', 'PIDS_B': '00000000'})
+        commands = profile.commands()
+        self.assertIn(obd.commands.COOLANT_TEMP, commands)
+        self.assertIn(obd.commands.RPM, commands)
+        self.assertIn(obd.commands.PIDS_B, commands)
+        self.assertNotIn(obd.commands.SPEED, commands)
+
+
+@patch('rpi_ble.obd_reader.UsbDetector')
+class TestProfiledConnect(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.emulator = Elm327Emulator(vin=VIN)
+        self.emulator.start()
+        self.profiles = ObdProfileCache(os.path.join(self.dir, 'profiles.json'))
+        self.reader = ObdReader(Mock(), self.profiles)
+
+    def tearDown(self):
+        self.emulator.close()
+        shutil.rmtree(self.dir)
+
+    def connect(self, usb_detector):
+        usb_detector.detected.return_value = True
+        usb_detector.get.return_value = self.emulator.port
+        requests = self.emulator.requests
+        connection = self.reader.connect(None)
+        self.assertIsNotNone(connection)
+        self.assertEqual(obd.OBDStatus.CAR_CONNECTED, connection.status())
+        return connection, self.emulator.requests - requests
+
+    def test_second_connect_uses_profile(self, usb_detector):
+        connection, probe_requests = self.connect(usb_detector)
+        connection.close()
+        profile = self.profiles.lookup(self.emulator.port)
+        self.assertEqual((VIN, '6'), (profile.vin, profile.protocol))
+        self.assertIsNone(self.reader.unverified_profile)
+
+        connection, cached_requests = self.connect(usb_detector)
+        self.assertIsInstance(connection, ProfiledOBD)
+        self.assertIsNotNone(profile.baudrate)
+        self.assertLess(cached_requests, probe_requests)
+        self.assertTrue(connection.supports(obd.commands.RPM))
+        self.assertFalse(connection.supports(obd.commands.MAF))
+
+        # the car changed its mind, revalidation notices
+        self.emulator.pids[0x10] = bytes([0, 100])
+        self.reader.revalidate_profile(connection)
+        self.assertIsNone(self.reader.unverified_profile)
+        self.assertTrue(connection.supports(obd.commands.MAF))
+        self.assertIn(obd.commands.MAF, ObdProfileCache(self.profiles.path).lookup(self.emulator.port).commands())
+        connection.close()
+
+    def test_failed_profile_falls_back_to_probe(self, usb_detector):
+        self.profiles.store(ObdProfile(self.emulator.port, VIN, '3', bitmaps={'PIDS_A': '08000000'}))
+        connection, _ = self.connect(usb_detector)
+        self.assertNotIsInstance(connection, ProfiledOBD)
+        self.assertEqual('6', self.profiles.lookup(self.emulator.port).protocol)
+        connection.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,267 @@
+import threading
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+import obd
+
+from obd import OBDResponse
+from obd.protocols import ECU
+from obd.protocols.protocol import Message
+
+from rpi_ble.elm327_emulator import Elm327Emulator
+from rpi_ble.event_defs import ExitApplicationEvent, OBDConnectedEvent
+from rpi_ble.obd_reader import AdaptiveRate, PollSchedule, ObdReader, ReconnectBackoff, batch_command, split_batch_response
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestPollSchedule(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.schedule = PollSchedule(clock=self.clock)
+
+    def test_waits_for_next_deadline(self):
+        poll = self.schedule.add(obd.commands.RPM, 0.1)
+        self.assertIs(poll, self.schedule.next_due())
+        self.schedule.succeeded(poll)
+        self.assertIsNone(self.schedule.next_due())
+        self.assertAlmostEqual(0.1, self.schedule.time_until_next())
+        self.clock.now += 0.1
+        self.assertIs(poll, self.schedule.next_due())
+
+    def test_priority_when_several_due(self):
+        coolant = self.schedule.add(obd.commands.COOLANT_TEMP, 10, priority=2)
+        rpm = self.schedule.add(obd.commands.RPM, 0.1, priority=0)
+        speed = self.schedule.add(obd.commands.SPEED, 0.2, priority=1)
+        self.assertIs(rpm, self.schedule.next_due())
+        self.schedule.succeeded(rpm)
+        self.assertIs(speed, self.schedule.next_due())
+        self.schedule.succeeded(speed)
+        self.assertIs(coolant, self.schedule.next_due())
+
+    def test_failing_pid_backs_off_alone(self):
+        rpm = self.schedule.add(obd.commands.RPM, 0.1, priority=0)
+        fuel = self.schedule.add(obd.commands.FUEL_LEVEL, 1, priority=1)
+        fuel_queries = 0
+        # 10 seconds of polling at 10ms steps with fuel never answering
+        for _ in range(1000):
+            poll = self.schedule.next_due()
+            while poll:
+                if poll is fuel:
+                    fuel_queries += 1
+                    self.schedule.failed(poll)
+                else:
+                    self.schedule.succeeded(poll)
+                poll = self.schedule.next_due()
+            self.clock.now += 0.01
+        # 0, 2, 6 seconds in
+        self.assertEqual(3, fuel_queries)
+        self.assertEqual(3, fuel.failures)
+        requested, achieved, attempts = self.schedule.report()['RPM']
+        self.assertEqual(10, requested)
+        self.assertAlmostEqual(10, achieved, delta=0.2)
+        self.assertEqual(0, self.schedule.report()['RPM'][2])
+
+    def test_batches_due_mode_01_pids(self):
+        rpm = self.schedule.add(obd.commands.RPM, 0.1, priority=0)
+        vin = self.schedule.add(obd.commands.VIN, 60, priority=1)
+        speed = self.schedule.add(obd.commands.SPEED, 0.2, priority=2)
+        coolant = self.schedule.add(obd.commands.COOLANT_TEMP, 10, priority=3)
+        self.assertEqual([rpm, speed], self.schedule.next_due_batch(2))
+        # mode 09 goes on its own
+        self.assertEqual([vin], self.schedule.next_due_batch(6))
+        self.assertEqual([coolant], self.schedule.next_due_batch(6))
+        self.assertEqual([], self.schedule.next_due_batch(6))
+
+    def test_backoff_is_capped_and_reset(self):
+        poll = self.schedule.add(obd.commands.RPM, 10)
+        # 20, 40, then capped at 60 seconds
+        for _ in range(5):
+            self.clock.now = poll.deadline
+            self.assertIs(poll, self.schedule.next_due())
+            self.schedule.failed(poll)
+        self.assertEqual(PollSchedule.MAX_BACKOFF, self.schedule.time_until_next())
+        self.clock.now = poll.deadline
+        self.schedule.next_due()
+        self.schedule.succeeded(poll)
+        self.assertEqual(0, poll.failures)
+        self.assertEqual(10, self.schedule.time_until_next())
+
+    def read(self, poll, value):
+        self.clock.now = poll.deadline
+        self.assertIs(poll, self.schedule.next_due())
+        self.schedule.succeeded(poll, value)
+
+    def test_adaptive_period_follows_value(self):
+        poll = self.schedule.add(obd.commands.COOLANT_TEMP, 10, adaptive=AdaptiveRate(2, 30, 2, high=230, margin=15))
+        # warming up at 1F a second, polled often enough to see 2F steps
+        for temp in (100, 110, 120, 130):
+            self.read(poll, temp)
+        self.assertEqual(2, poll.period)
+        # warm and steady, backs off to the maximum
+        for _ in range(10):
+            self.read(poll, 190)
+        self.assertEqual({'COOLANT_TEMP': 30}, self.schedule.intervals())
+        # close to overheating, even though it's moving slowly
+        self.read(poll, 216)
+        self.assertEqual(2, poll.period)
+
+    def test_period_starts_within_bounds(self):
+        poll = self.schedule.add(obd.commands.FUEL_LEVEL, 120, adaptive=AdaptiveRate(5, 60, 1))
+        self.assertEqual(60, poll.period)
+        self.read(poll, 50)
+        self.assertEqual(60, poll.period)
+
+
+class TestObdReaderPoll(unittest.TestCase):
+
+    def test_poll_until_disconnected(self):
+        receiver = Mock()
+        reader = ObdReader(receiver)
+        reader.wakeup.wait = Mock()
+        response = Mock()
+        response.is_null.return_value = False
+        response.value = obd.Unit.Quantity(194, obd.Unit.degF)
+        connection = Mock()
+        connection.query.return_value = response
+        # connected for two passes of the loop
+        connection.status.side_effect = [obd.OBDStatus.CAR_CONNECTED] * 2 + [obd.OBDStatus.NOT_CONNECTED]
+        reader.poll(connection)
+        connection.query.assert_called_once_with(obd.commands.COOLANT_TEMP)
+        # then waited for the next reading to come due
+        self.assertAlmostEqual(10, reader.wakeup.wait.call_args[0][0], places=1)
+        receiver.set_temp_f.assert_called_once_with(194)
+        self.assertTrue(reader.is_working())
+
+    def test_exit_interrupts_wait(self):
+        reader = ObdReader(Mock())
+        reader.wakeup.wait = Mock(side_effect=lambda timeout: reader.handle_event(ExitApplicationEvent))
+        connection = Mock()
+        connection.status.return_value = obd.OBDStatus.CAR_CONNECTED
+        connection.query.return_value.is_null.return_value = True
+        reader.poll(connection)
+        # backed off after the failure, and woken up rather than waiting it out
+        connection.query.assert_called_once()
+        self.assertAlmostEqual(20, reader.wakeup.wait.call_args[0][0], places=1)
+
+
+
+class TestReconnect(unittest.TestCase):
+
+    def test_backoff(self):
+        clock = FakeClock()
+        backoff = ReconnectBackoff(clock)
+        self.assertEqual([0.25, 0.5, 1, 2, 4, 8, 16, 30, 30], [backoff.next_delay() for _ in range(9)])
+        clock.now += 5
+        self.assertEqual((5, 9), backoff.connected())
+        # the first connection isn't a recovery
+        self.assertEqual(0, backoff.outages)
+        clock.now += 100
+        backoff.disconnected()
+        # only the first failure starts an outage
+        clock.now += 1
+        backoff.disconnected()
+        self.assertEqual(0.25, backoff.next_delay())
+        clock.now += 2
+        self.assertEqual((3, 1), backoff.connected())
+        self.assertEqual(1, backoff.outages)
+
+    @patch('rpi_ble.obd_reader.UsbDetector')
+    def test_run_backs_off_until_connected(self, usb_detector):
+        reader = ObdReader(Mock())
+        connection = Mock()
+        connection.status.return_value = obd.OBDStatus.NOT_CONNECTED
+        reader.connect = Mock(side_effect=[None, None, connection, None])
+        reader.poll = Mock()
+        delays = []
+
+        def wait(delay):
+            delays.append(delay)
+            if len(delays) == 3:
+                reader.finished = True
+        reader.wait_for_reconnect = wait
+        with self.assertLogs('rpi_ble.obd_reader', 'INFO') as logs:
+            reader.run()
+        self.assertFalse(any("recovered" in line for line in logs.output))
+        # starts again from the shortest delay once the car is lost
+        self.assertEqual([0.25, 0.5, 0.25], delays)
+        reader.poll.assert_called_once_with(connection)
+        connection.close.assert_called_once()
+
+    @patch('rpi_ble.obd_reader.UsbDetector')
+    def test_wait_cut_short(self, usb_detector):
+        usb_detector.detected.return_value = False
+        reader = ObdReader(Mock())
+        threading.Timer(0.1, OBDConnectedEvent.emit).start()
+        start = time.monotonic()
+        reader.wait_for_reconnect(10)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertFalse(reader.wakeup.is_set())
+
+        # nothing to cut it short
+        start = time.monotonic()
+        reader.wait_for_reconnect(0.2)
+        self.assertGreaterEqual(time.monotonic() - start, 0.2)
+
+
+class TestBatchedQueries(unittest.TestCase):
+
+    CMDS = (obd.commands.RPM, obd.commands.SPEED, obd.commands.COOLANT_TEMP)
+
+    @classmethod
+    def setUpClass(cls):
+        cls.emulator = Elm327Emulator()
+        cls.emulator.start()
+        cls.connection = obd.OBD(cls.emulator.port, fast=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.connection.close()
+        cls.emulator.close()
+
+    def setUp(self):
+        self.emulator.multi_pid = True
+
+    def test_split_batch_response(self):
+        message = Message([])
+        message.ecu = ECU.ENGINE
+        message.data = bytearray([0x41, 0x0C, 0x1A, 0xF8, 0x0D, 0x32, 0x05, 0x82])
+        response = OBDResponse(batch_command(self.CMDS), [message])
+        response.value = [message]
+        responses = split_batch_response(self.CMDS, response)
+        self.assertEqual(1726, responses[obd.commands.RPM].value.magnitude)
+        self.assertEqual(50, responses[obd.commands.SPEED].value.magnitude)
+        self.assertEqual(90, responses[obd.commands.COOLANT_TEMP].value.magnitude)
+
+    def test_batched_matches_single_queries(self):
+        reader = ObdReader(Mock())
+        schedule = PollSchedule()
+        polls = [schedule.add(cmd, 1) for cmd in self.CMDS]
+        requests = self.emulator.requests
+        batched = reader.query(self.connection, polls)
+        self.assertEqual(1, self.emulator.requests - requests)
+        self.assertTrue(reader.batching)
+        for poll, response in batched:
+            self.assertEqual(self.connection.query(poll.cmd).value, response.value)
+
+    def test_falls_back_to_single_queries(self):
+        self.emulator.multi_pid = False
+        reader = ObdReader(Mock())
+        schedule = PollSchedule()
+        polls = [schedule.add(cmd, 1) for cmd in self.CMDS]
+        responses = reader.query(self.connection, polls)
+        self.assertFalse(reader.batching)
+        self.assertEqual([1726, 50, 90], [response.value.magnitude for _, response in responses])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+from unittest.mock import Mock, patch
+
+import sys
+
+sys.modules['gi.repository'] = Mock()
+
+from rpi_ble.service import GattCharacteristic, GATT_CHRC_IFACE
+
+
+class CounterChrc(GattCharacteristic):
+
+    def __init__(self, bus, service):
+        GattCharacteristic.__init__(self, bus, 0, "1234", ['notify', 'read'], service)
+        self.notifying = False
+        self.count = 0
+        self.encodes = 0
+        self.PropertiesChanged = Mock()
+
+    def set_count(self, count):
+        self.count = count
+        return self.notify_value_changed()
+
+    def get_value_bytes(self) -> bytes:
+        self.encodes += 1
+        return bytes((self.count,))
+
+
+class TestNotificationPublisher(unittest.TestCase):
+
+    def setUp(self):
+        service = Mock()
+        service.path = "/org/bluez/lemonpi/service0"
+        self.chrc = CounterChrc(Mock(), service)
+
+    @patch('rpi_ble.service.GLib')
+    def test_suppressed_without_subscriber(self, glib):
+        self.assertFalse(self.chrc.set_count(1))
+        self.assertFalse(self.chrc.set_count(2))
+        glib.idle_add.assert_not_called()
+        self.chrc.PropertiesChanged.assert_not_called()
+        self.assertEqual(0, self.chrc.encodes)
+        self.assertEqual({'emitted': 0, 'suppressed': 2, 'dropped': 0}, self.chrc.publisher.stats())
+
+    @patch('rpi_ble.service.GLib')
+    def test_subscribe_pushes_latest_value(self, glib):
+        self.chrc.set_count(7)
+        self.chrc.notifying = True
+        self.chrc.PropertiesChanged.assert_called_once_with(GATT_CHRC_IFACE, {'Value': [7]}, [])
+        glib.idle_add.assert_not_called()
+        self.assertEqual(1, self.chrc.publisher.emitted)
+
+    @patch('rpi_ble.service.GLib')
+    def test_subscribe_before_any_value(self, glib):
+        self.chrc.notifying = True
+        self.chrc.PropertiesChanged.assert_not_called()
+        self.chrc.set_count(7)
+        glib.idle_add.call_args[0][0]()
+        self.chrc.PropertiesChanged.assert_called_once_with(GATT_CHRC_IFACE, {'Value': [7]}, [])
+
+    @patch('rpi_ble.service.GLib')
+    def test_coalesces_to_newest_value(self, glib):
+        self.chrc.notifying = True
+        self.chrc.PropertiesChanged.reset_mock()
+        self.assertTrue(self.chrc.set_count(1))
+        self.assertTrue(self.chrc.set_count(2))
+        self.assertTrue(self.chrc.set_count(3))
+        glib.idle_add.assert_called_once()
+        # run the idle callback the way the main loop would
+        callback = glib.idle_add.call_args[0][0]
+        self.assertFalse(callback())
+        self.chrc.PropertiesChanged.assert_called_once_with(GATT_CHRC_IFACE, {'Value': [3]}, [])
+        self.assertEqual(2, self.chrc.publisher.dropped)
+        # a read after the notification reuses the encoded value
+        encodes = self.chrc.encodes
+        self.assertEqual([3], self.chrc.ReadValue(None))
+        self.assertEqual(encodes, self.chrc.encodes)
+
+    @patch('rpi_ble.service.time')
+    @patch('rpi_ble.service.GLib')
+    def test_rate_limit(self, glib, mock_time):
+        service = Mock()
+        service.path = "/org/bluez/lemonpi/service0"
+        chrc = CounterChrc(Mock(), service)
+        chrc.publisher.interval = 0.1
+        mock_time.monotonic.return_value = 100.0
+        chrc.set_count(0)
+        chrc.notifying = True
+        # 40ms after the push on subscribe : wait out the rest of the interval
+        mock_time.monotonic.return_value = 100.04
+        chrc.set_count(1)
+        glib.idle_add.assert_not_called()
+        self.assertEqual(60, glib.timeout_add.call_args[0][0])
+        chrc.set_count(2)
+        self.assertEqual(1, chrc.publisher.dropped)
+        mock_time.monotonic.return_value = 100.1
+        glib.timeout_add.call_args[0][1]()
+        chrc.PropertiesChanged.assert_called_with(GATT_CHRC_IFACE, {'Value': [2]}, [])
+        # well after the interval : straight onto the main loop
+        mock_time.monotonic.return_value = 101.0
+        chrc.set_count(3)
+        glib.idle_add.assert_called_once()
+
+    def test_max_rate(self):
+        service = Mock()
+        service.path = "/org/bluez/lemonpi/service0"
+        chrc = GattCharacteristic(Mock(), 1, "1234", ['notify'], service, min_notify_interval=0.01, max_notify_rate=20)
+        self.assertEqual(0.05, chrc.publisher.interval)
+
+    @patch('rpi_ble.service.GLib')
+    def test_unsubscribe_drops_pending(self, glib):
+        self.chrc.notifying = True
+        self.chrc.PropertiesChanged.reset_mock()
+        self.chrc.set_count(1)
+        self.chrc.notifying = False
+        glib.idle_add.call_args[0][0]()
+        self.chrc.PropertiesChanged.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import json
+import os
+import socket
+import tempfile
+import time
+import unittest
+from unittest.mock import Mock
+
+import obd
+
+from rpi_ble.event_defs import ExitApplicationEvent
+from rpi_ble.obd_reader import PollSchedule
+from rpi_ble.socketcan_reader import SocketCanReader, CanSignal, CAN_FRAME, OBD_REQUEST_ID, \
+    can_interface_present, load_signal_map, parse_candump_line, replay_candump
+
+# a short hand written log : a broadcast coolant temp frame, then fuel level, then coolant again
+CANDUMP_LOG = """\
+(1700000000.000000) vcan0 3D0#0082000000000000
+(1700000000.010000) vcan0 123#DEADBEEF
+(1700000000.020000) vcan0 3D1#00BF
+(1700000000.030000) vcan0 3D0#0087000000000000
+"""
+
+SIGNALS = [
+    {"name": "coolant", "id": "0x3D0", "start": 1, "length": 1, "scale": 1.8, "offset": -40, "target": "temp_f"},
+    {"name": "fuel", "id": 977, "start": 1, "length": 1, "scale": 0.392, "target": "fuel_percent"},
+]
+
+
+def write_file(content: str) -> str:
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    return path
+
+
+class TestSocketCanReader(unittest.TestCase):
+
+    def setUp(self):
+        path = write_file(json.dumps(SIGNALS))
+        self.signal_map = load_signal_map(path)
+        os.remove(path)
+        self.receiver = Mock()
+        self.reader = SocketCanReader(self.receiver, 'vcan0', self.signal_map)
+
+    def test_parse_candump_line(self):
+        self.assertEqual((1700000000.0, 0x3D1, b'\x00\xbf'),
+                         parse_candump_line("(1700000000.000000) vcan0 3D1#00BF\n"))
+        self.assertIsNone(parse_candump_line("interface = vcan0"))
+
+    def test_decodes_broadcast_signals(self):
+        # the counters are in the shared metrics registry
+        received, decoded = self.reader.frames_received.value, self.reader.frames_decoded.value
+        for line in CANDUMP_LOG.splitlines():
+            _, can_id, data = parse_candump_line(line)
+            self.reader.handle_frame(can_id, data)
+        self.assertEqual([194, 203], [c[0][0] for c in self.receiver.set_temp_f.call_args_list])
+        self.receiver.set_fuel_percent_remaining.assert_called_once_with(74)
+        self.assertEqual(4, self.reader.frames_received.value - received)
+        self.assertEqual(3, self.reader.frames_decoded.value - decoded)
+        self.assertTrue(self.reader.is_working())
+
+    def test_signal_byte_order(self):
+        signal = CanSignal('rpm', 0x100, 0, 2, 'temp_f', byte_order='little')
+        self.assertEqual(0x1234, signal.decode(b'\x34\x12'))
+        self.assertIsNone(signal.decode(b'\x34'))
+        with self.assertRaises(ValueError):
+            CanSignal('x', 0x100, 0, 1, 'nowhere')
+
+    def test_obd_request_and_multi_frame_response(self):
+        self.reader.sock = Mock()
+        self.reader.schedule = PollSchedule()
+        for cmd in (obd.commands.COOLANT_TEMP, obd.commands.RPM, obd.commands.SPEED, obd.commands.FUEL_LEVEL):
+            self.reader.schedule.add(cmd, 1)
+        self.assertAlmostEqual(SocketCanReader.RESPONSE_TIMEOUT, self.reader.next_poll(), places=2)
+        can_id, length, data = CAN_FRAME.unpack(self.reader.sock.send.call_args[0][0])
+        self.assertEqual(OBD_REQUEST_ID, can_id)
+        self.assertEqual(bytes([5, 0x01, 0x05, 0x0C, 0x0D, 0x2F, 0, 0]), data)
+
+        # 41 05 82 0C 1A F8 0D 32 2F BF : ten bytes, so a first frame and a consecutive frame
+        self.reader.handle_frame(0x7E8, bytes([0x10, 0x0A, 0x41, 0x05, 0x82, 0x0C, 0x1A, 0xF8]))
+        can_id, _, data = CAN_FRAME.unpack(self.reader.sock.send.call_args[0][0])
+        self.assertEqual(0x7E0, can_id)
+        self.assertEqual(0x30, data[0])
+        self.reader.handle_frame(0x7E8, bytes([0x21, 0x0D, 0x32, 0x2F, 0xBF, 0, 0, 0]))
+        self.receiver.set_temp_f.assert_called_once_with(194)
+        self.receiver.set_fuel_percent_remaining.assert_called_once_with(74)
+        self.assertEqual({}, self.reader.pending)
+
+    def test_unanswered_request_fails_poll(self):
+        self.reader.sock = Mock()
+        self.reader.schedule = PollSchedule()
+        poll = self.reader.schedule.add(obd.commands.COOLANT_TEMP, 1)
+        queries, no_data = self.reader.queries.value, self.reader.no_data.value
+        self.reader.next_poll()
+        self.reader.pending_deadline = 0
+        self.reader.next_poll()
+        self.assertEqual(1, poll.failures)
+        self.assertEqual((1, 1), (self.reader.queries.value - queries, self.reader.no_data.value - no_data))
+
+    @unittest.skipUnless(can_interface_present('vcan0'), "needs a vcan0 interface")
+    def test_replay_on_vcan0(self):
+        reader = SocketCanReader(self.receiver, 'vcan0', self.signal_map, poll_obd=False)
+        decoded = reader.frames_decoded.value
+        reader.start()
+        time.sleep(0.2)
+        path = write_file(CANDUMP_LOG)
+        try:
+            sender = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+            sender.bind(('vcan0',))
+            replay_candump(sender, path)
+            sender.close()
+            deadline = time.time() + 2
+            while reader.frames_decoded.value - decoded < 3 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            os.remove(path)
+            reader.handle_event(ExitApplicationEvent)
+        self.assertEqual(3, reader.frames_decoded.value - decoded)
+        self.receiver.set_fuel_percent_remaining.assert_called_once_with(74)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+import os
+import select
+import shutil
+import tempfile
+import time
+import tty
+import unittest
+from threading import Thread
+from unittest.mock import patch, MagicMock, Mock
+
+from rpi_ble.metrics import registry
+from rpi_ble.usb_detector import DeviceIdentityCache, UsbDetector, UsbDevice
+
+
+class FakeSerialDevice(Thread):
+    """
+    A pseudo terminal that answers atz with reply, or stays silent
+    """
+
+    def __init__(self, reply: bytes = None):
+        Thread.__init__(self, daemon=True)
+        self.reply = reply
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.received = b''
+        self.finished = False
+        self.start()
+
+    def run(self):
+        while not self.finished:
+            readable, _, _ = select.select([self.master], [], [], 0.1)
+            if readable:
+                data = os.read(self.master, 64)
+                self.received += data
+                if self.reply and b'atz' in data:
+                    os.write(self.master, self.reply)
+
+    def close(self):
+        self.finished = True
+        self.join(1)
+        os.close(self.master)
+        os.close(self.slave)
+
+
+class TestUsbDetector(unittest.TestCase):
+
+    def setUp(self):
+        self.gps = FakeSerialDevice()
+        self.silent = [FakeSerialDevice() for _ in range(3)]
+        self.elm = FakeSerialDevice(b'atz\r\rELM327 v1.5\r\r>')
+        self.devices = [self.gps] + self.silent[:2] + [self.elm] + self.silent[2:]
+
+    def tearDown(self):
+        for device in self.devices:
+            device.close()
+
+    def gpsd_session(self):
+        session = MagicMock()
+        session.read.return_value = 0
+        session.data = {'devices': [{'path': self.gps.port}]}
+        return session
+
+    def scan(self, **gps):
+        with patch.object(UsbDetector, 'get_connected_serial_devices',
+                          return_value=[device.port for device in self.devices]), \
+                patch('rpi_ble.usb_detector.gps', **gps):
+            detector = UsbDetector()
+            detector.__scan__()
+        return detector
+
+    def test_probes_concurrently(self):
+        start = time.monotonic()
+        detector = self.scan(return_value=self.gpsd_session())
+        # one at a time the four silent devices would take 10s between them
+        self.assertLess(time.monotonic() - start, 2 * (UsbDetector.PROBE_SETTLE_TIME + UsbDetector.PROBE_READ_TIMEOUT))
+        self.assertAlmostEqual(time.monotonic() - start, detector.scan_duration, delta=0.1)
+        self.assertEqual(round(detector.scan_duration, 3), registry.value('usb.scan_duration'))
+        self.assertEqual({UsbDevice.GPS: self.gps.port, UsbDevice.OBD: self.elm.port}, detector.usb_map)
+        self.assertEqual(UsbDevice.GPS, detector.device_map[self.gps.port])
+        self.assertEqual(UsbDevice.OBD, detector.device_map[self.elm.port])
+        self.assertEqual(2, len(detector.device_map))
+        # nothing is written to the port gpsd is using
+        self.assertEqual(b'', self.gps.received)
+
+    def test_best_guess_without_elm(self):
+        self.devices.remove(self.elm)
+        self.elm.close()
+        detector = self.scan(return_value=self.gpsd_session())
+        # the last device that isn't the gps
+        self.assertEqual(self.silent[2].port, detector.usb_map[UsbDevice.OBD])
+
+    def test_no_gpsd(self):
+        detector = self.scan(side_effect=ConnectionRefusedError)
+        self.assertEqual({UsbDevice.OBD: self.elm.port}, detector.usb_map)
+
+
+
+def fake_identity(device):
+    return 'usb-' + os.path.basename(device)
+
+
+@patch('rpi_ble.usb_detector.device_identity', fake_identity)
+class TestDeviceIdentityCache(unittest.TestCase):
+
+    def setUp(self):
+        self.gps = FakeSerialDevice()
+        self.elm = FakeSerialDevice(b'atz\r\rELM327 v1.5\r\r>')
+        self.other = FakeSerialDevice()
+        self.devices = [self.gps, self.elm, self.other]
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'usb_devices.json')
+        session = self.session = MagicMock()
+        session.read.return_value = 0
+        session.data = {'devices': [{'path': self.gps.port}]}
+        self.patches = [
+            patch.object(UsbDetector, 'get_connected_serial_devices',
+                         return_value=[device.port for device in self.devices]),
+            patch('rpi_ble.usb_detector.gps', return_value=session),
+        ]
+        self.connected_devices = self.patches[0].start()
+        self.patches[1].start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        for device in self.devices:
+            device.close()
+        shutil.rmtree(self.dir)
+
+    def init(self):
+        UsbDetector.init(DeviceIdentityCache(self.path))
+        return UsbDetector.get_instance()
+
+    def wait_for_confirmation(self, detector):
+        deadline = time.monotonic() + 2
+        while UsbDevice.GPS in detector.unconfirmed and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_cached_devices_are_not_probed(self):
+        first = self.init()
+        self.assertEqual({fake_identity(self.gps.port): UsbDevice.GPS, fake_identity(self.elm.port): UsbDevice.OBD},
+                         DeviceIdentityCache(self.path).identities)
+
+        self.connected_devices.return_value = [self.gps.port, self.elm.port]
+        with patch.object(UsbDetector, 'probe_serial') as probe:
+            start = time.monotonic()
+            detector = self.init()
+            self.assertLess(time.monotonic() - start, UsbDetector.PROBE_SETTLE_TIME)
+        probe.assert_not_called()
+        self.assertEqual(first.usb_map, detector.usb_map)
+        # gpsd confirms the gps in the background
+        self.wait_for_confirmation(detector)
+        self.assertEqual({UsbDevice.OBD}, detector.unconfirmed)
+        UsbDetector.confirm(UsbDevice.OBD)
+        self.assertEqual(set(), detector.unconfirmed)
+
+    def test_rescan_plugged_in_device(self):
+        self.connected_devices.return_value = [self.gps.port]
+        detector = self.init()
+        self.assertEqual({UsbDevice.GPS: self.gps.port}, detector.usb_map)
+        # plugged in now, as far as its ctime goes
+        time.sleep(0.01)
+        os.chmod(self.elm.port, os.stat(self.elm.port).st_mode)
+        self.connected_devices.return_value = [self.gps.port, self.elm.port]
+        self.assertEqual([UsbDevice.OBD], UsbDetector.rescan())
+        self.assertEqual(self.elm.port, UsbDetector.get(UsbDevice.OBD))
+        self.assertEqual([UsbDevice.OBD], UsbDetector.device_removed(self.elm.port))
+        self.assertEqual([], UsbDetector.device_removed(self.elm.port))
+        self.assertFalse(UsbDetector.detected(UsbDevice.OBD))
+        self.assertNotIn(self.elm.port, detector.device_map)
+
+    def test_unidentified_device_is_scanned_again(self):
+        # gpsd hasn't got round to the GPS yet, and the probe gets nothing from it
+        self.session.data = {'devices': []}
+        self.connected_devices.return_value = [self.gps.port]
+        detector = self.init()
+        self.assertEqual({}, detector.usb_map)
+        self.assertTrue(UsbDetector.has_unclassified())
+        # its ctime is from before the last scan, which doesn't rule it out
+        self.session.data = {'devices': [{'path': self.gps.port}]}
+        self.assertEqual([UsbDevice.GPS], UsbDetector.rescan())
+        self.assertFalse(UsbDetector.has_unclassified())
+        self.assertEqual([UsbDevice.GPS], UsbDetector.device_removed(self.gps.port))
+
+    def test_wrong_cache_entry_is_probed_again(self):
+        cache = DeviceIdentityCache(self.path)
+        cache.put(fake_identity(self.other.port), UsbDevice.OBD)
+        cache.put(fake_identity(self.elm.port), UsbDevice.GPS)
+        detector = self.init()
+        # gpsd puts the gps right, the probe finds the ELM
+        self.assertEqual({UsbDevice.GPS: self.gps.port, UsbDevice.OBD: self.other.port}, detector.usb_map)
+        UsbDetector.reject(UsbDevice.OBD)
+        self.assertEqual({UsbDevice.GPS: self.gps.port, UsbDevice.OBD: self.elm.port}, detector.usb_map)
+        self.assertEqual({fake_identity(self.gps.port): UsbDevice.GPS, fake_identity(self.elm.port): UsbDevice.OBD},
+                         DeviceIdentityCache(self.path).identities)
+
+
+if __name__ == '__main__':
+    unittest.main()
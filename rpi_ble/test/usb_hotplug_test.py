@@ -0,0 +1,102 @@
+import os
+import select
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from unittest.mock import Mock, patch
+
+sys.modules['gi.repository'] = Mock()
+
+from rpi_ble.usb_detector import UsbDevice
+from rpi_ble.usb_hotplug import UsbHotplugWatcher
+
+
+@patch('rpi_ble.usb_hotplug.UsbDetector')
+@patch('rpi_ble.usb_hotplug.GLib')
+class TestUsbHotplugWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.on_detected = Mock()
+        self.on_removed = Mock()
+        self.watcher = UsbHotplugWatcher(self.on_detected, self.dir, self.on_removed)
+
+    def tearDown(self):
+        self.watcher.stop()
+        shutil.rmtree(self.dir)
+
+    def pump(self):
+        # stands in for the main loop dispatching the io watch
+        select.select([self.watcher.fd], [], [], 2)
+        self.assertTrue(self.watcher._on_readable(self.watcher.fd, None))
+
+    def test_new_device_is_scanned(self, glib, usb_detector):
+        usb_detector.rescan.return_value = [UsbDevice.OBD]
+        usb_detector.has_unclassified.return_value = False
+        glib.timeout_add.return_value = 7
+        self.assertTrue(self.watcher.start())
+        self.assertEqual(self.watcher._on_readable, glib.io_add_watch.call_args[0][3])
+
+        open(os.path.join(self.dir, 'ttyS0'), 'w').close()
+        open(os.path.join(self.dir, 'ttyUSB1'), 'w').close()
+        open(os.path.join(self.dir, 'ttyACM0'), 'w').close()
+        self.pump()
+        # both serial devices, one scan
+        glib.timeout_add.assert_called_once_with(UsbHotplugWatcher.SETTLE_MS, self.watcher._start_rescan)
+
+        self.assertFalse(self.watcher._start_rescan())
+        deadline = time.monotonic() + 2
+        while not glib.idle_add.called and time.monotonic() < deadline:
+            time.sleep(0.01)
+        usb_detector.rescan.assert_called_once()
+        callback, detected = glib.idle_add.call_args[0]
+        self.assertFalse(callback(detected))
+        self.on_detected.assert_called_once_with([UsbDevice.OBD])
+        self.assertFalse(self.watcher.scanning)
+        # everything was identified, so no retry
+        glib.timeout_add.assert_called_once()
+
+    def test_device_removed(self, glib, usb_detector):
+        usb_detector.device_removed.return_value = [UsbDevice.GPS]
+        path = os.path.join(self.dir, 'ttyUSB0')
+        open(path, 'w').close()
+        self.assertTrue(self.watcher.start())
+        os.remove(path)
+        self.pump()
+        usb_detector.device_removed.assert_called_once_with(path)
+        self.on_removed.assert_called_once_with([UsbDevice.GPS])
+        glib.timeout_add.assert_not_called()
+
+    def test_plugged_in_during_scan(self, glib, usb_detector):
+        self.watcher.scanning = True
+        self.watcher._start_rescan()
+        self.assertTrue(self.watcher.rescan_pending)
+        self.watcher._finish_rescan([])
+        self.on_detected.assert_not_called()
+        glib.timeout_add.assert_called_once()
+
+    def test_unclassified_devices_are_retried(self, glib, usb_detector):
+        usb_detector.has_unclassified.return_value = True
+        glib.timeout_add.return_value = 9
+        for _ in range(UsbHotplugWatcher.MAX_RETRIES):
+            self.watcher.scanning = True
+            self.watcher._finish_rescan([])
+            glib.timeout_add.assert_called_with(UsbHotplugWatcher.RETRY_MS, self.watcher._retry_rescan)
+            self.watcher.retry_id = None
+        self.watcher._finish_rescan([])
+        self.assertEqual(UsbHotplugWatcher.MAX_RETRIES, glib.timeout_add.call_count)
+
+        # plugging in another device starts over
+        self.watcher.retry_id = 9
+        self.assertTrue(self.watcher.start())
+        open(os.path.join(self.dir, 'ttyUSB2'), 'w').close()
+        self.pump()
+        glib.source_remove.assert_called_with(9)
+        self.assertEqual(0, self.watcher.retries)
+        glib.timeout_add.assert_called_with(UsbHotplugWatcher.SETTLE_MS, self.watcher._start_rescan)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from rpi_ble.event_defs import ExitApplicationEvent, GpsFix
+from rpi_ble.events import ValueEvent
+from rpi_ble.metrics import MetricsRegistry
+from rpi_ble.value_recorder import ValueRecorder, ValueMetrics
+
+TempEvent = ValueEvent("Recorder-Temp", int)
+FixEvent = ValueEvent("Recorder-Fix", GpsFix)
+
+
+class TestValueRecorder(unittest.TestCase):
+
+    def test_records_values_as_json_lines(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        recorder = ValueRecorder(path, [TempEvent, FixEvent])
+        TempEvent.emit(194)
+        FixEvent.emit(GpsFix(37.7749, -122.4194, 271, 1714564801.1, 95, 1.2, 1.5))
+        ExitApplicationEvent.emit()
+        deadline = time.time() + 2
+        while recorder.file and time.time() < deadline:
+            time.sleep(0.01)
+        ExitApplicationEvent.deregister_handler(ValueRecorder)
+
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual(['Recorder-Temp', 'Recorder-Fix'], [line['name'] for line in lines])
+        self.assertEqual(194, lines[0]['value'])
+        self.assertEqual(-122.4194, lines[1]['value']['long'])
+
+
+class TestValueMetrics(unittest.TestCase):
+
+    def test_latest_values_as_gauges(self):
+        registry = MetricsRegistry()
+        value_metrics = ValueMetrics([TempEvent, FixEvent], registry)
+        fix = GpsFix(37.7749, -122.4194, 271, 1714564801.1, 95, 1.2, 1.5)
+        TempEvent.emit(190)
+        TempEvent.emit(194)
+        FixEvent.emit(fix)
+        value_metrics.close()
+        # not seen once closed
+        TempEvent.emit(200)
+        self.assertEqual({'values.Recorder-Temp': 194, 'values.Recorder-Fix': fix}, registry.snapshot())
+
+
+if __name__ == '__main__':
+    unittest.main()
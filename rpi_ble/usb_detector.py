@@ -4,10 +4,16 @@ import glob
 import os
 import logging
 import serial
+import json
 import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait
+from threading import Lock, RLock, Thread
 from gps import gps
 from enum import Enum
 
+from rpi_ble.json_file import save_json
+from rpi_ble.metrics import registry
+
 logger = logging.getLogger(__name__)
 
 
@@ -18,6 +24,78 @@ class UsbDevice(Enum):
     ARDUINO = 4
 
 
+def device_identity(device: str):
+    """
+    A name for the USB device behind a serial port that stays the same whichever
+    port it comes up on : its /dev/serial/by-id link, or vendor:product:serial
+    from sysfs. None if it has neither.
+    """
+    real = os.path.realpath(device)
+    by_id = '/dev/serial/by-id'
+    try:
+        for name in sorted(os.listdir(by_id)):
+            if os.path.realpath(os.path.join(by_id, name)) == real:
+                return name
+    except OSError:
+        pass
+    # the tty's device is a usb interface (ACM) or a port under one (usb-serial)
+    usb = os.path.realpath(f"/sys/class/tty/{os.path.basename(real)}/device")
+    for _ in range(3):
+        usb = os.path.dirname(usb)
+        try:
+            with open(os.path.join(usb, 'idVendor')) as f:
+                vendor = f.read().strip()
+            with open(os.path.join(usb, 'idProduct')) as f:
+                product = f.read().strip()
+        except OSError:
+            continue
+        try:
+            with open(os.path.join(usb, 'serial')) as f:
+                serial_number = f.read().strip()
+        except OSError:
+            serial_number = ''
+        return f"{vendor}:{product}:{serial_number}"
+    return None
+
+
+class DeviceIdentityCache:
+    """
+    What each USB device turned out to be, on disk and keyed by device_identity
+    """
+
+    DEFAULT_PATH = os.path.expanduser('~/.cache/rpi-ble/usb_devices.json')
+
+    def __init__(self, path: str = DEFAULT_PATH):
+        self.path = path
+        # identity : UsbDevice name
+        self.identities = {}
+        try:
+            with open(path) as f:
+                self.identities = {identity: UsbDevice[name] for identity, name in json.load(f).items()}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, AttributeError):
+            logger.warning(f"ignoring unreadable USB device cache {path}")
+
+    def get(self, identity: str):
+        return self.identities.get(identity)
+
+    def put(self, identity: str, device_type: UsbDevice):
+        if self.identities.get(identity) != device_type:
+            self.identities[identity] = device_type
+            self.save()
+
+    def forget(self, identity: str):
+        if self.identities.pop(identity, None):
+            self.save()
+
+    def save(self):
+        try:
+            save_json(self.path, {identity: device_type.name for identity, device_type in self.identities.items()})
+        except OSError:
+            logger.exception(f"unable to save USB device cache {self.path}")
+
+
 # it's hard to tell which device is plugged into the computer ... either on
 # Raspian or on Mac.
 #
@@ -27,15 +105,176 @@ class UsbDetector:
 
     __instance = None
 
-    def __init__(self):
+    # the gpsd query and the serial probes run side by side on this many threads
+    MAX_PROBE_WORKERS = 4
+    # a probe writes atz, waits this long, then reads with PROBE_READ_TIMEOUT
+    PROBE_SETTLE_TIME = 0.5
+    PROBE_READ_TIMEOUT = 2
+    # longest a single probe or the gpsd query is waited for
+    PROBE_DEADLINE = 3.0
+
+    def __init__(self, cache: DeviceIdentityCache = None):
         self.usb_map: {UsbDevice, str} = {}
         self.device_map: {str, UsbDevice} = {}
         self.last_scan_time = 0
+        # how long the last scan took, in seconds
+        self.scan_duration = 0.0
+        self.scan_duration_gauge = registry.gauge('usb.scan_duration')
+        self.cache = cache
+        # device types mapped from the cache or by a best guess, and not yet
+        # confirmed by talking to the device
+        self.unconfirmed = set()
+        self.from_cache = set()
+        # devices a scan couldn't identify, looked at again by the next one even
+        # though they were plugged in before it, e.g. a gps gpsd hadn't got to yet
+        self.unclassified = set()
+        # the hotplug thread, the main loop and ObdReader all change the mappings,
+        # they hold lock to do so. scan_lock keeps scans one at a time, without
+        # holding up the others while a scan probes.
+        self.lock = RLock()
+        self.scan_lock = Lock()
+
+    @classmethod
+    def init(cls, cache: DeviceIdentityCache = None):
+        """
+        Devices the cache knows are mapped straight away and only the others are
+        probed. The gps mapping is then confirmed with gpsd in the background, the
+        OBD one by ObdReader connecting to it.
+        """
+        instance = UsbDetector(cache if cache is not None else DeviceIdentityCache())
+        UsbDetector.__instance = instance
+        devices = instance.get_connected_serial_devices()
+        instance.apply_cache(devices)
+        if len(instance.device_map) < len(devices):
+            instance.__scan__()
+        instance.save_cache()
+        if UsbDevice.GPS in instance.from_cache:
+            Thread(target=instance.confirm_gps, daemon=True).start()
+
+    def apply_cache(self, devices):
+        for device in devices:
+            identity = device_identity(device)
+            device_type = self.cache.get(identity) if identity else None
+            if device_type:
+                logger.info(f"associated {device} with {device_type.name}, from cache")
+                self.map_device(device_type, device, confirmed=False)
+                self.from_cache.add(device_type)
+
+    def map_device(self, device_type: UsbDevice, device: str, confirmed: bool = True):
+        if device_type in self.from_cache:
+            # what a probe found overrides what the cache said
+            self.device_map.pop(self.usb_map.get(device_type), None)
+            self.from_cache.discard(device_type)
+        self.usb_map[device_type] = device
+        self.device_map[device] = device_type
+        if confirmed:
+            self.unconfirmed.discard(device_type)
+        else:
+            self.unconfirmed.add(device_type)
+
+    def save_cache(self):
+        for device_type, device in list(self.usb_map.items()):
+            identity = device_identity(device)
+            if identity and device_type not in self.unconfirmed:
+                self.cache.put(identity, device_type)
+
+    def confirm_gps(self):
+        gps_devices = self.query_gpsd()
+        if self.usb_map.get(UsbDevice.GPS) in gps_devices:
+            self.confirm_mapping(UsbDevice.GPS)
+        elif gps_devices:
+            self.reject_mapping(UsbDevice.GPS)
+
+    def confirm_mapping(self, device_type: UsbDevice):
+        with self.lock:
+            if device_type in self.unconfirmed:
+                logger.info(f"confirmed {self.usb_map.get(device_type)} is {device_type.name}")
+                self.unconfirmed.discard(device_type)
+                self.from_cache.discard(device_type)
+                if self.cache:
+                    self.save_cache()
+
+    def reject_mapping(self, device_type: UsbDevice):
+        # only a cached mapping is worth probing again for, a best guess would
+        # just be guessed again
+        with self.lock:
+            if device_type not in self.from_cache:
+                return
+            device = self.usb_map.pop(device_type, None)
+            logger.info(f"cached mapping of {device} to {device_type.name} was wrong, probing again")
+            self.device_map.pop(device, None)
+            self.unconfirmed.discard(device_type)
+            self.from_cache.discard(device_type)
+            identity = device_identity(device) if device else None
+            if identity:
+                self.cache.forget(identity)
+            self.last_scan_time = 0
+        self.__scan__()
+        with self.lock:
+            self.save_cache()
 
     @classmethod
-    def init(cls):
-        UsbDetector.__instance = UsbDetector()
-        UsbDetector.__instance.__scan__()
+    def confirm(cls, device_type: UsbDevice):
+        """
+        Something talked to the device and it was what we thought
+        """
+        if UsbDetector.__instance:
+            UsbDetector.__instance.confirm_mapping(device_type)
+
+    @classmethod
+    def reject(cls, device_type: UsbDevice):
+        """
+        The device wasn't what the cache said it was
+        """
+        if UsbDetector.__instance:
+            UsbDetector.__instance.reject_mapping(device_type)
+
+    @classmethod
+    def rescan(cls) -> list:
+        """
+        Identify the devices plugged in since the last scan, returns the device
+        types that are newly mapped
+        """
+        instance = UsbDetector.__instance
+        with instance.lock:
+            before = dict(instance.usb_map)
+            if instance.cache:
+                instance.apply_cache([device for device in instance.get_connected_serial_devices()
+                                      if device not in instance.device_map])
+        instance.__scan__()
+        with instance.lock:
+            if instance.cache:
+                instance.save_cache()
+            return [device_type for device_type, device in instance.usb_map.items()
+                    if before.get(device_type) != device]
+
+    @classmethod
+    def has_unclassified(cls) -> bool:
+        """
+        Whether the last scan left devices it couldn't identify
+        """
+        instance = UsbDetector.__instance
+        return bool(instance and instance.unclassified)
+
+    @classmethod
+    def device_removed(cls, device: str) -> list:
+        """
+        Forget a device that's been unplugged, returns the device types that are
+        no longer mapped
+        """
+        removed = []
+        instance = UsbDetector.__instance
+        if not instance:
+            return removed
+        with instance.lock:
+            instance.unclassified.discard(device)
+            if instance.device_map.pop(device, None):
+                for device_type, mapped in list(instance.usb_map.items()):
+                    if mapped == device:
+                        logger.info(f"{device_type.name} device {device} removed")
+                        del instance.usb_map[device_type]
+                        removed.append(device_type)
+        return removed
 
     @classmethod
     def get_instance(cls):
@@ -50,69 +289,134 @@ class UsbDetector:
         return UsbDetector.__instance.usb_map.get(device_type) is not None
 
     def __scan__(self):
+        with self.scan_lock:
+            self.scan_devices()
+
+    def scan_devices(self):
+        scan_start = time.monotonic()
         devices = self.get_connected_serial_devices()
         logger.info(f"found usb serial devices : {devices}")
 
         # step 0 ... throw out already classified
-        for device in devices:
-            if os.path.getctime(device) < self.last_scan_time:
+        for device in list(devices):
+            if os.path.getctime(device) < self.last_scan_time and device not in self.unclassified:
                 logger.info(f"already mapped : {device}")
                 devices.remove(device)
 
-        # step 1 ... throw out the gps
+        # step 1 ... ask gpsd which is the gps, while probing for an ELM327 on
+        # everything else. gpsd may not have opened its device yet, and root can
+        # open it regardless, so each probe waits for gpsd's answer before
+        # writing anything and leaves the gps alone
+        gps_devices = []
+        probes = {}
         if devices:
-            session = None
-            try:
-                session = gps()
-                logger.info("gpsd is running")
-                session.read()  # needed to get past version info
-                session.send('?DEVICES;')
-                code = session.read()
-                if code == 0:
-                    for gps_device in session.data['devices']:
-                        device_path = gps_device['path']
-                        self.usb_map[UsbDevice.GPS] = device_path
-                        self.device_map[device_path] = UsbDevice.GPS
-                        logger.info(f"associated {device_path} with GPS")
-                        # MacOS maps two devices to the same thing
-                        if device_path.startswith('/dev/tty.usbmodem'):
-                            alt_name = '/dev/cu.' + device_path[9:]
-                            self.device_map[alt_name] = UsbDevice.GPS
-            except Exception as e:
-                logger.exception("didn't find connected GPS device")
-            finally:
-                if session:
-                    session.close()
-
-        # step 2 obd
-        logger.info("detecting OBD devices")
-        best_guess_obd_device = None
-        for device in devices:
-            if self.device_map.get(device):
-                # it's been identified
-                continue
-            logger.info(f"trying to identify {device}")
-            with serial.Serial(device, baudrate=38400, timeout=2) as ser:
-                try:
-                    ser.write("atz\r\r".encode("UTF-8"))
-                    time.sleep(0.5)
-                    resp_bytes = ser.readline(10)
-                    logger.info(resp_bytes)
-                    if "ELM" in str(resp_bytes):
-                        self.usb_map[UsbDevice.OBD] = device
-                        self.device_map[device] = UsbDevice.OBD
-                        logger.info(f"associated {device} with OBD")
-                except serial.SerialException:
-                    pass
-            best_guess_obd_device = device
-        logger.info("finished USB scan")
-        # if we've found GPS, but not found OBD but have a leftover USB device, try selecting it
-        if UsbDevice.OBD not in self.usb_map and best_guess_obd_device is not None and UsbDevice.GPS in self.usb_map:
-            logger.info(f"best guess is to use {best_guess_obd_device} as OBD device")
-            self.usb_map[UsbDevice.OBD] = best_guess_obd_device
-            self.device_map[best_guess_obd_device] = UsbDevice.OBD
-
-        self.last_scan_time = time.time()
+            executor = ThreadPoolExecutor(max_workers=self.MAX_PROBE_WORKERS, thread_name_prefix='usb-probe')
+            # submitted first, so it's always running before a probe waits on it
+            gps_future = executor.submit(self.query_gpsd)
+            logger.info("detecting OBD devices")
+            probes = {device: executor.submit(self.probe_unless_gps, device, gps_future)
+                      for device in devices if not self.device_map.get(device)}
+            # the probes queue for workers, so the deadline is per batch of them
+            batches = (len(probes) + 1 + self.MAX_PROBE_WORKERS - 1) // self.MAX_PROBE_WORKERS
+            wait([gps_future], timeout=self.PROBE_DEADLINE)
+            wait(list(probes.values()), timeout=self.PROBE_DEADLINE * batches)
+            executor.shutdown(wait=False, cancel_futures=True)
+            if gps_future.done():
+                gps_devices = gps_future.result()
+            else:
+                logger.warning("no answer from gpsd in time")
+
+        with self.lock:
+            for device_path in gps_devices:
+                self.map_device(UsbDevice.GPS, device_path)
+                logger.info(f"associated {device_path} with GPS")
+                # MacOS maps two devices to the same thing
+                for alt_name in self.alt_names(device_path):
+                    self.device_map[alt_name] = UsbDevice.GPS
+
+            # step 2 obd
+            best_guess_obd_device = None
+            for device in devices:
+                if self.device_map.get(device):
+                    # it's been identified
+                    continue
+                probe = probes.get(device)
+                if probe is None or not probe.done():
+                    logger.info(f"no answer probing {device} in time")
+                elif probe.result():
+                    self.map_device(UsbDevice.OBD, device)
+                    logger.info(f"associated {device} with OBD")
+                best_guess_obd_device = device
+            self.scan_duration = time.monotonic() - scan_start
+            self.scan_duration_gauge.set(round(self.scan_duration, 3))
+            logger.info(f"finished USB scan in {self.scan_duration:.2f}s")
+            # if we've found GPS, but not found OBD but have a leftover USB device, try selecting it
+            if UsbDevice.OBD not in self.usb_map and best_guess_obd_device is not None and UsbDevice.GPS in self.usb_map:
+                logger.info(f"best guess is to use {best_guess_obd_device} as OBD device")
+                self.map_device(UsbDevice.OBD, best_guess_obd_device, confirmed=False)
+
+            self.unclassified = {device for device in devices if device not in self.device_map}
+            if self.unclassified:
+                logger.info(f"couldn't identify {sorted(self.unclassified)}, they'll be scanned again")
+            self.last_scan_time = time.time()
+
+    @staticmethod
+    def query_gpsd():
+        """
+        Returns the paths of the devices gpsd is using
+        """
+        session = None
+        try:
+            session = gps()
+            logger.info("gpsd is running")
+            session.read()  # needed to get past version info
+            session.send('?DEVICES;')
+            code = session.read()
+            if code == 0:
+                return [gps_device['path'] for gps_device in session.data['devices']]
+        except Exception as e:
+            logger.exception("didn't find connected GPS device")
+        finally:
+            if session:
+                session.close()
+        return []
+
+    @staticmethod
+    def alt_names(device_path: str) -> list:
+        if device_path.startswith('/dev/tty.usbmodem'):
+            return ['/dev/cu.' + device_path[9:]]
+        return []
+
+    def probe_unless_gps(self, device, gps_future) -> bool:
+        """
+        probe_serial, once gpsd has answered, unless gpsd says device is the gps.
+        gpsd is a local socket so that's a few ms, if it doesn't answer in time
+        the device is probed anyway.
+        """
+        try:
+            gps_devices = gps_future.result(timeout=self.PROBE_DEADLINE)
+        except FutureTimeoutError:
+            gps_devices = []
+        if any(device == path or device in self.alt_names(path) for path in gps_devices):
+            return False
+        return self.probe_serial(device)
+
+    @classmethod
+    def probe_serial(cls, device) -> bool:
+        """
+        Whether there's an ELM327 on device
+        """
+        logger.info(f"trying to identify {device}")
+        try:
+            with serial.Serial(device, baudrate=38400, timeout=cls.PROBE_READ_TIMEOUT) as ser:
+                ser.write("atz\r\r".encode("UTF-8"))
+                time.sleep(cls.PROBE_SETTLE_TIME)
+                resp_bytes = ser.readline(10)
+                logger.info(resp_bytes)
+                return "ELM" in str(resp_bytes)
+        except (serial.SerialException, OSError):
+            logger.info(f"unable to probe {device}")
+            return False
 
     @staticmethod
     def get_connected_serial_devices():
@@ -0,0 +1,159 @@
+import ctypes
+import ctypes.util
+import fnmatch
+import logging
+import os
+import struct
+from threading import Thread
+
+from gi.repository import GLib
+
+from rpi_ble.usb_detector import UsbDetector
+
+logger = logging.getLogger(__name__)
+
+# from <sys/inotify.h>
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# struct inotify_event : wd, mask, cookie, len, then len bytes of name
+INOTIFY_EVENT = struct.Struct('iIII')
+
+SERIAL_DEVICE_PATTERNS = ('ttyUSB*', 'ttyACM*')
+
+
+class UsbHotplugWatcher:
+    """
+    Watches /dev with inotify, on the GLib main loop, for USB serial devices
+    coming and going. A new device gets an incremental UsbDetector scan on a
+    worker thread, as probing blocks; whatever that finds is handed to
+    on_detected on the main loop. The device types a removed device was mapped
+    to are handed to on_removed. Devices the scan couldn't identify, say a GPS
+    gpsd hasn't picked up yet, are scanned again a few times.
+    """
+
+    # udev creates the node before it has set the permissions, so wait a little
+    SETTLE_MS = 500
+    RETRY_MS = 5000
+    MAX_RETRIES = 3
+
+    def __init__(self, on_detected, directory: str = '/dev', on_removed=None):
+        self.on_detected = on_detected
+        self.on_removed = on_removed
+        self.directory = directory
+        self.fd = None
+        self.watch_id = None
+        self.rescan_id = None
+        self.retry_id = None
+        self.retries = 0
+        self.scanning = False
+        self.rescan_pending = False
+
+    def start(self) -> bool:
+        libc_name = ctypes.util.find_library('c')
+        try:
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            logger.info("no inotify, USB devices plugged in later won't be noticed")
+            return False
+        if fd < 0 or libc.inotify_add_watch(fd, self.directory.encode(), IN_CREATE | IN_DELETE) < 0:
+            logger.error(f"unable to watch {self.directory} : {os.strerror(ctypes.get_errno())}")
+            if fd >= 0:
+                os.close(fd)
+            return False
+        self.fd = fd
+        self.watch_id = GLib.io_add_watch(fd, GLib.PRIORITY_DEFAULT, GLib.IO_IN, self._on_readable)
+        logger.info(f"watching {self.directory} for USB serial devices")
+        return True
+
+    def stop(self):
+        if self.watch_id:
+            GLib.source_remove(self.watch_id)
+            self.watch_id = None
+        if self.rescan_id:
+            GLib.source_remove(self.rescan_id)
+            self.rescan_id = None
+        self.cancel_retry()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _on_readable(self, fd, condition):
+        try:
+            data = os.read(fd, 4096)
+        except BlockingIOError:
+            return True
+        except OSError:
+            logger.exception("error reading inotify events")
+            self.watch_id = None
+            return False
+        self.handle_events(data)
+        return True
+
+    def handle_events(self, data: bytes):
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            if not any(fnmatch.fnmatch(name, pattern) for pattern in SERIAL_DEVICE_PATTERNS):
+                continue
+            path = os.path.join(self.directory, name)
+            if mask & IN_CREATE:
+                logger.info(f"{path} plugged in")
+                # a fresh device gets the full set of retries, and doesn't wait for one
+                self.cancel_retry()
+                self.retries = 0
+                self.schedule_rescan()
+            elif mask & IN_DELETE:
+                logger.info(f"{path} unplugged")
+                removed = UsbDetector.device_removed(path)
+                if removed and self.on_removed:
+                    self.on_removed(removed)
+
+    def schedule_rescan(self):
+        # several devices arriving together get one scan
+        if not self.rescan_id:
+            self.rescan_id = GLib.timeout_add(self.SETTLE_MS, self._start_rescan)
+
+    def cancel_retry(self):
+        if self.retry_id:
+            GLib.source_remove(self.retry_id)
+            self.retry_id = None
+
+    def _retry_rescan(self):
+        self.retry_id = None
+        return self._start_rescan()
+
+    def _start_rescan(self):
+        self.rescan_id = None
+        if self.scanning:
+            self.rescan_pending = True
+        else:
+            self.scanning = True
+            Thread(target=self._rescan, name="usb-rescan", daemon=True).start()
+        return False
+
+    def _rescan(self):
+        detected = []
+        try:
+            detected = UsbDetector.rescan()
+        except Exception:
+            logger.exception("USB rescan failed")
+        GLib.idle_add(self._finish_rescan, detected)
+
+    def _finish_rescan(self, detected: list):
+        self.scanning = False
+        if detected:
+            self.on_detected(detected)
+        if self.rescan_pending:
+            self.rescan_pending = False
+            self.schedule_rescan()
+        elif UsbDetector.has_unclassified() and self.retries < self.MAX_RETRIES:
+            self.retries += 1
+            logger.info(f"unidentified USB devices, scanning again in {self.RETRY_MS} ms")
+            self.retry_id = GLib.timeout_add(self.RETRY_MS, self._retry_rescan)
+        return False
@@ -0,0 +1,65 @@
+import json
+import logging
+import time
+from functools import partial
+
+from rpi_ble.event_defs import ExitApplicationEvent
+from rpi_ble.events import EventHandler, Delivery
+from rpi_ble.metrics import MetricsRegistry, registry
+
+logger = logging.getLogger(__name__)
+
+
+class ValueRecorder(EventHandler):
+    """
+    Writes sensor value events to a file, one json object per line :
+    {"t": unix time, "name": event name, "value": value}
+
+    Runs on the event dispatcher thread, so a slow card costs us samples, the
+    newest is kept, rather than holding up the readers.
+    """
+
+    def __init__(self, path: str, events: list):
+        self.path = path
+        self.file = open(path, 'a', buffering=1)
+        self.events = events
+        self.recorded = 0
+        for event in events:
+            event.subscribe(partial(self.record, event.name), Delivery.DISPATCHER)
+        # in order with the samples, so nothing is written after the file is closed
+        ExitApplicationEvent.register_handler(self, Delivery.DISPATCHER)
+        logger.info(f"recording {', '.join(e.name for e in events)} to {path}")
+
+    def record(self, name: str, value):
+        if self.file is None:
+            return
+        if hasattr(value, '_asdict'):
+            value = value._asdict()
+        self.file.write(json.dumps({'t': round(time.time(), 3), 'name': name, 'value': value}) + '\n')
+        self.recorded += 1
+
+    def handle_event(self, event, **kwargs):
+        if event == ExitApplicationEvent and self.file:
+            self.file.close()
+            self.file = None
+            logger.info(f"recorded {self.recorded} values to {self.path}")
+
+
+class ValueMetrics:
+    """
+    Keeps the latest sample of each value event as a gauge, values.<event name>,
+    so the metrics snapshot has the last value of everything we read
+    """
+
+    def __init__(self, events: list, metrics: MetricsRegistry = None):
+        self.subscriptions = []
+        for event in events:
+            gauge = (metrics or registry).gauge(f"values.{event.name}")
+            # setting a gauge is cheap enough to do on the reader's thread
+            event.subscribe(gauge.set)
+            self.subscriptions.append((event, gauge.set))
+
+    def close(self):
+        for event, callback in self.subscriptions:
+            event.unsubscribe(callback)
+        self.subscriptions = []